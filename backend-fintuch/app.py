@@ -1,18 +1,72 @@
-from flask import Flask, request, jsonify
+from flask import Flask, current_app, g, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, verify_jwt_in_request
 from flask_cors import CORS
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
+import contextlib
+import functools
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+from ingest import FORWARDED, BatchEntryTicket, OrderIngest, OrderRejected, ShardedIngest
+from candles import INTERVALS, CandleStore, rollup, wall_clock
+from idempotency import ClientOrderIndex
+from journal import BookJournal, cancel_records, order_records, reduce_records
+from ledger import BalanceLedger
+from leaderboard import Leaderboard
+from marketdata import MarketDataFeed
+from metrics import Metrics, SlowRequestProfiler
+from migrations import migrate
+from money import from_units, notional, notional_units, price_from_units, price_to_units, to_units
+from orderbook import BookOrder, DepthMirror, MatchingEngine, book_levels
+from pairs import PairRegistry, default_rows
+from passwords import PasswordHasher
+import storage
+from usercache import UserCache
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///cex.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('CEX_DATABASE_URI', 'sqlite:///cex.db')
+# pool sizes, statement caches and SQLite pragmas; see storage.py
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'your-secret-key'
-CORS(app, origins=['http://localhost:3000'])
+# 0 matches every currency on threads of this process; N > 0 forks N
+# matching processes and spreads the currencies across them
+MATCHING_PROCESSES = int(os.environ.get('CEX_MATCHING_PROCESSES', 0))
+# directory for the order book journal and snapshots; unset keeps books
+# loaded from the orders table only
+JOURNAL_DIR = os.environ.get('CEX_JOURNAL_DIR')
+# 0 skips the fsync of each journal batch before its commit; a crash can
+# then lose the journal's tail, and startup rebuilds those books from the table
+JOURNAL_FSYNC = int(os.environ.get('CEX_JOURNAL_FSYNC', 1))
+# bcrypt work factor for new hashes; older hashes are upgraded at login
+BCRYPT_ROUNDS = int(os.environ.get('CEX_BCRYPT_ROUNDS', 12))
+# processes hashing passwords; 0 hashes on a thread pool of this process
+AUTH_PROCESSES = int(os.environ.get('CEX_AUTH_PROCESSES', 1))
+CORS(app, origins=['http://localhost:3000'], expose_headers=['X-Next-Cursor'])
 
 db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
+metrics = Metrics()
+with app.app_context():
+    storage.attach(db.engine)
+    metrics.watch(db.engine)
+# CEX_PROFILE_SLOW_MS=<ms> samples request stacks and writes those of
+# requests at least that slow to CEX_PROFILE_DIR as flame graph input
+profiler = (SlowRequestProfiler(os.environ.get('CEX_PROFILE_DIR', 'profiles'),
+                                float(os.environ['CEX_PROFILE_SLOW_MS']) / 1000,
+                                float(os.environ.get('CEX_PROFILE_INTERVAL_MS', 5)) / 1000)
+            if os.environ.get('CEX_PROFILE_SLOW_MS') else None)
+passwords = PasswordHasher(BCRYPT_ROUNDS, AUTH_PROCESSES,
+                           max_pending=int(os.environ.get('CEX_AUTH_QUEUE', 64)),
+                           failure_ttl=int(os.environ.get('CEX_LOGIN_FAILURE_TTL', 30)))
 jwt = JWTManager(app)
 
 class User(db.Model):
@@ -23,11 +77,11 @@ class User(db.Model):
 
     @staticmethod
     def hash_password(password):
-        return bcrypt.generate_password_hash(password).decode('utf-8')
+        return passwords.hash(password)
 
     @staticmethod
     def check_password(hash, password):
-        return bcrypt.check_password_hash(hash, password)
+        return passwords.check(hash, password)
     
 
 class Wallet(db.Model):
@@ -35,29 +89,60 @@ class Wallet(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     currency = db.Column(db.String(10), nullable=False)
-    balance = db.Column(db.Float, default=0)
+    balance = db.Column(db.BigInteger, default=0)
+
+    __table_args__ = (
+        db.Index('uq_wallets_user_currency', 'user_id', 'currency', unique=True),
+    )
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     currency = db.Column(db.String(10), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    amount = db.Column(db.BigInteger, nullable=False)
+    price = db.Column(db.BigInteger, nullable=False)
     type = db.Column(db.String(4), nullable=False) 
     date = db.Column(db.String(20), nullable=False) 
 
+    __table_args__ = (
+        db.Index('ix_transactions_user_date', 'user_id', 'date'),
+        db.Index('ix_transactions_user_id', 'user_id', 'id'),
+        db.Index('ix_transactions_user_currency', 'user_id', 'currency', 'id'),
+    )
+
 
 class Order(db.Model):
     __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     currency = db.Column(db.String(10), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    amount = db.Column(db.BigInteger, nullable=False)
+    price = db.Column(db.BigInteger, nullable=False)
     type = db.Column(db.String(4), nullable=False) 
     status = db.Column(db.String(10), nullable=False, default='active') 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    client_order_id = db.Column(db.String(64), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_orders_book', 'currency', 'type', 'status', 'price'),
+        db.Index('ix_orders_status', 'status', 'currency'),
+        db.Index('ix_orders_user_status', 'user_id', 'status', 'currency'),
+        db.Index('uq_orders_user_client_order', 'user_id', 'client_order_id', unique=True),
+    )
+
+class Candle(db.Model):
+    __tablename__ = 'candles'
+    currency = db.Column(db.String(10), primary_key=True)
+    interval = db.Column(db.Integer, primary_key=True)
+    start = db.Column(db.BigInteger, primary_key=True)
+    open = db.Column(db.BigInteger, nullable=False)
+    high = db.Column(db.BigInteger, nullable=False)
+    low = db.Column(db.BigInteger, nullable=False)
+    close = db.Column(db.BigInteger, nullable=False)
+    volume = db.Column(db.BigInteger, nullable=False)
+
+    __table_args__ = {'sqlite_with_rowid': False}
 
 class UserPoints(db.Model):
     __tablename__ = 'user_points'
@@ -65,8 +150,257 @@ class UserPoints(db.Model):
     points = db.Column(db.Integer, default=0)
     total_trades = db.Column(db.Integer, default=0)
 
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    buy_volume = db.Column(db.BigInteger, nullable=False, default=0)
+    sell_volume = db.Column(db.BigInteger, nullable=False, default=0)
+    buy_trades = db.Column(db.Integer, nullable=False, default=0)
+    sell_trades = db.Column(db.Integer, nullable=False, default=0)
+
+class UserTradeDay(db.Model):
+    __tablename__ = 'user_trade_days'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    day = db.Column(db.String(10), primary_key=True)
+    trades = db.Column(db.Integer, nullable=False, default=0)
+
+# sequence of the last journal batch committed for each book; see load_books
+class JournalMark(db.Model):
+    __tablename__ = 'journal_marks'
+    currency = db.Column(db.String(10), primary_key=True)
+    sequence = db.Column(db.BigInteger, nullable=False)
+
+# changes made to orders on nobody's request, e.g. by a migration
+class OrderAudit(db.Model):
+    __tablename__ = 'order_audit'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(10), nullable=False)
+    type = db.Column(db.String(4), nullable=False)
+    amount = db.Column(db.BigInteger, nullable=False)
+    price = db.Column(db.BigInteger, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    reason = db.Column(db.String(120), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class TradingPair(db.Model):
+    __tablename__ = 'trading_pairs'
+    symbol = db.Column(db.String(10), primary_key=True)
+    base = db.Column(db.String(10), nullable=False)
+    quote = db.Column(db.String(10), nullable=False)
+    tick_size = db.Column(db.BigInteger, nullable=False)
+    lot_size = db.Column(db.BigInteger, nullable=False)
+
+# balance deltas a matcher committed for wallets another matcher keeps, as
+# JSON [[user_id, delta], ...]; the keeper deletes the row as it applies them
+class Transfer(db.Model):
+    __tablename__ = 'transfers'
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(10), nullable=False)
+    balances = db.Column(db.Text, nullable=False)
+
+engine = MatchingEngine()
+feed = MarketDataFeed()
+# in a matching process, hands changed levels to the API process's depth mirrors
+mirror_levels = None
+ranking = Leaderboard()
+journal = BookJournal(JOURNAL_DIR, fsync=bool(JOURNAL_FSYNC)) if JOURNAL_DIR else None
+# SQLite lets one connection write at a time and parks the others in its
+# sleeping busy handler; matching threads take turns here instead
+database_writes = (threading.Lock() if storage.is_sqlite(app.config['SQLALCHEMY_DATABASE_URI'])
+                   else contextlib.nullcontext())
+# .currency is the matcher running on this thread; off the matchers, e.g. in
+# benchmarks and CLI commands, every wallet is written directly
+matching = threading.local()
+
+def keeps(currency):
+    """Whether this thread writes `currency`'s wallets, rather than sending transfers to their matcher."""
+    owner = getattr(matching, 'currency', None)
+    return owner is None or owner == currency
+
+def wallet_balances(currency, user_ids):
+    """{user_id: balance} of the existing `currency` wallets of `user_ids`, with one IN query."""
+    return dict(db.session.query(Wallet.user_id, Wallet.balance).filter(
+        Wallet.currency == currency, Wallet.user_id.in_(user_ids)))
+
+def registered_pairs():
+    return db.session.query(TradingPair.symbol, TradingPair.base, TradingPair.quote,
+                            TradingPair.tick_size, TradingPair.lot_size).all()
+
+pairs = PairRegistry(registered_pairs)
+ledger = BalanceLedger(wallet_balances, pairs.pair)
+candles = CandleStore()
+
+def load_user_context(user_id):
+    """Email, wallet balances, points and trade stats of `user_id`, or None for an unknown id.
+
+    Trade days go back a little over the profile's week so a cached
+    context still covers it until it expires.
+    """
+    user = db.session.query(
+        User.email, UserPoints.points, UserPoints.total_trades, UserStats.buy_volume, UserStats.sell_volume
+    ).outerjoin(UserPoints, User.id == UserPoints.user_id).outerjoin(
+        UserStats, User.id == UserStats.user_id).filter(User.id == user_id).first()
+    if user is None:
+        return None
+    since = (datetime.utcnow() - timedelta(days=8)).strftime('%Y-%m-%d')
+    return {
+        "email": user.email,
+        "wallets": dict(db.session.query(Wallet.currency, Wallet.balance).filter_by(
+            user_id=user_id).order_by(Wallet.id)),
+        "points": user.points or 0,
+        "total_trades": user.total_trades or 0,
+        "buy_volume": user.buy_volume or 0,
+        "sell_volume": user.sell_volume or 0,
+        "trade_days": dict(db.session.query(UserTradeDay.day, UserTradeDay.trades).filter(
+            UserTradeDay.user_id == user_id, UserTradeDay.day >= since))
+    }
+
+# cached per process; matchers invalidate users once their writes commit
+user_contexts = UserCache(load_user_context, ttl=60)
+
+def load_pairs():
+    """Load the trading pair registry, registering the default pairs in an empty table first."""
+    if db.session.query(TradingPair.symbol).first() is None:
+        db.session.execute(db.insert(TradingPair), default_rows())
+        db.session.commit()
+    pairs.reload()
+
+def active_orders(currency=None):
+    query = Order.query.filter_by(status='active')
+    if currency is not None:
+        query = query.filter_by(currency=currency)
+    return query.order_by(Order.id)
+
+def load_books():
+    """Build the resident books, from the journal when one is configured.
+
+    A recovered book is used as is when its last journal batch is the one
+    whose sequence the database committed with the book's last change.
+    Any other book, e.g. one whose journal lost its tail or has batches
+    that were never committed, or one changed without the journal, is
+    reloaded from the database, snapshotted and marked afresh.
+    """
+    apply_pending_transfers()
+    marks = dict(db.session.query(JournalMark.currency, JournalMark.sequence))
+    if journal is None:
+        if marks:
+            # changes made now move no marks, so a journal enabled later must not trust its old ones
+            db.session.execute(db.delete(JournalMark))
+            db.session.commit()
+        engine.load(active_orders())
+        ledger.reset(engine.books.values())
+        return
+    engine.restore(journal.recover())
+    for currency in set(pairs.symbols()) | set(engine.books) | set(marks):
+        if currency in engine.books and journal.sequences.get(currency) == marks.get(currency):
+            continue
+        journal.snapshot(engine.reload(currency, active_orders(currency)))
+        save_journal_mark(currency, journal.sequences.get(currency, 0))
+    db.session.commit()
+    ledger.reset(engine.books.values())
+
+def save_journal_mark(currency, sequence):
+    """Record `sequence` as the book's last journal batch, in the current transaction."""
+    marked = db.session.execute(db.update(JournalMark).where(JournalMark.currency == currency)
+                                .values(sequence=sequence)).rowcount
+    if not marked:
+        db.session.add(JournalMark(currency=currency, sequence=sequence))
+
+def apply_pending_transfers():
+    """Apply the transfers matchers committed that their receivers had not applied when the process stopped."""
+    transfers = Transfer.query.order_by(Transfer.id).all()
+    for transfer in transfers:
+        balances = dict(json.loads(transfer.balances))
+        save_balances(transfer.currency, balances)
+        ledger.apply(transfer.currency, balances)
+        db.session.delete(transfer)
+    if transfers:
+        db.session.commit()
+        print('Applied %d pending transfers' % len(transfers))
+
+def stored_candles(currency, seconds, since=None, limit=None):
+    """Stored candles of one series, oldest first: the newest `limit`, or those from `since` on."""
+    query = db.session.query(Candle.start, Candle.open, Candle.high, Candle.low, Candle.close, Candle.volume) \
+        .filter_by(currency=currency, interval=seconds)
+    if since is not None:
+        return query.filter(Candle.start >= since).order_by(Candle.start).all()
+    return query.order_by(Candle.start.desc()).limit(limit).all()[::-1]
+
+def load_candles(currency):
+    candles.load(currency, [(seconds, candle) for seconds in INTERVALS.values()
+                            for candle in stored_candles(currency, seconds, limit=candles.capacity)])
+
+def load_all_candles():
+    candles.clear()
+    for (currency,) in db.session.query(Candle.currency).distinct():
+        load_candles(currency)
+
+def save_candles(currency):
+    """Write the candles the store changed since the last save."""
+    created, updated = candles.take_changes(currency)
+    rows = [[{
+        "currency": currency,
+        "interval": seconds,
+        "start": start,
+        "open": open,
+        "high": high,
+        "low": low,
+        "close": close,
+        "volume": volume
+    } for seconds, (start, open, high, low, close, volume) in changes] for changes in (created, updated)]
+    if rows[0]:
+        db.session.execute(db.insert(Candle), rows[0])
+    if rows[1]:
+        db.session.execute(db.update(Candle), rows[1])
+
 with app.app_context():
+    migrate(db.engine)
     db.create_all()
+    load_pairs()
+    load_books()
+    load_all_candles()
+    ranking.load(db.session.query(User.id, UserPoints.points).outerjoin(UserPoints, User.id == UserPoints.user_id))
+
+def jwt_required():
+    """flask_jwt_extended's jwt_required, with token checking timed as its own stage."""
+    def wrapper(fn):
+        @functools.wraps(fn)
+        def decorator(*args, **kwargs):
+            with metrics.span('jwt'):
+                verify_jwt_in_request()
+            return current_app.ensure_sync(fn)(*args, **kwargs)
+        return decorator
+    return wrapper
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.take_queries()
+    if profiler is not None:
+        profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    seconds = time.perf_counter() - g.request_started
+    metrics.observe('cex_request_seconds', seconds, endpoint=endpoint)
+    metrics.observe('cex_request_queries', metrics.take_queries(), endpoint=endpoint)
+    metrics.inc('cex_responses_total', endpoint=endpoint, status=response.status_code)
+    if profiler is not None:
+        profiler.finish(request.method + endpoint, seconds)
+    return response
+
+def internal_error(e):
+    """The 500 answered for an unexpected error, counted by endpoint and exception type."""
+    metrics.error(request.url_rule.rule if request.url_rule else 'unmatched', e)
+    return jsonify({"error": "Internal server error"}), 500
+
+def auth_busy():
+    response = jsonify({'error': 'Too many logins in progress, retry later'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 @app.route('/api/auth/register', methods=['POST'])
 def register():
@@ -81,15 +415,20 @@ def register():
         if User.query.filter_by(email=email).first():
             return jsonify({'error': 'Email is already registered'}), 400
         
+        db.session.close()
         hashed_password = User.hash_password(password)
         new_user = User(email=email, password=hashed_password)
         db.session.add(new_user)
         db.session.commit()
+        passwords.forget(email)
+        ranking.award(new_user.id, 0)
 
         return jsonify({'message': 'User registered successfully'}), 201
 
+    except queue.Full:
+        return auth_busy()
     except Exception as e:
-        return jsonify({'error': 'Internal server error'}), 500
+        return internal_error(e)
 
 @app.route('/api/auth/login', methods=['POST'])
 def login():
@@ -101,22 +440,37 @@ def login():
         if not email or not password:
             return jsonify({'error': 'Email and password are required'}), 400
 
-        user = User.query.filter_by(email=email).first()
+        if passwords.failed_recently(email, password):
+            return jsonify({'error': 'Invalid credentials'}), 401
+
+        user = db.session.query(User.id, User.password).filter_by(email=email).first()
+        # the connection is not needed while the password is checked
+        db.session.close()
         if not user or not User.check_password(user.password, password):
+            passwords.record_failure(email, password)
             return jsonify({'error': 'Invalid credentials'}), 401
 
+        if passwords.needs_rehash(user.password):
+            db.session.query(User).filter_by(id=user.id, password=user.password).update(
+                {"password": User.hash_password(password)})
+            db.session.commit()
+
         access_token = create_access_token(identity=user.id)
         return jsonify({'token': access_token}), 200
 
+    except queue.Full:
+        return auth_busy()
     except Exception as e:
-        return jsonify({'error': 'Internal server error'}), 500
+        return internal_error(e)
     
 @app.route('/api/wallet', methods=['GET'])
 @jwt_required()
 def get_wallet():
-    user_id = get_jwt_identity()
-    wallet = Wallet.query.filter_by(user_id=user_id).all()
-    wallet_data = [{"currency": item.currency, "balance": item.balance} for item in wallet]
+    context = user_contexts.get(get_jwt_identity())
+    if context is None:
+        return user_not_found()
+    wallet_data = [{"currency": currency, "balance": from_units(balance, currency)}
+                   for currency, balance in context["wallets"].items()]
     return jsonify(wallet_data), 200
 
 @app.route('/api/check', methods=['GET'])
@@ -125,28 +479,145 @@ def check_tocken():
     user_id = get_jwt_identity()
     return jsonify({"user_id": user_id}), 200
 
+TRANSACTIONS_PAGE_SIZE = 100
+MAX_TRANSACTIONS_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+TRANSACTION_FIELDS = ['id', 'currency', 'amount', 'price', 'type', 'date']
+
+def transaction_filters(user_id, args):
+    """Filter clauses for the transaction history endpoints; ValueError on bad input."""
+    clauses = [Transaction.user_id == user_id]
+    if args.get('currency'):
+        clauses.append(Transaction.currency == args['currency'])
+    if args.get('type'):
+        if args['type'] not in ('buy', 'sell'):
+            raise ValueError('type must be buy or sell')
+        clauses.append(Transaction.type == args['type'])
+    # dates are stored as 'YYYY-MM-DD HH:MM:SS' strings, so ISO bounds compare correctly
+    if args.get('since'):
+        datetime.fromisoformat(args['since'])
+        clauses.append(Transaction.date >= args['since'])
+    if args.get('until'):
+        datetime.fromisoformat(args['until'])
+        clauses.append(Transaction.date < args['until'])
+    return clauses
+
+def transaction_rows(clauses):
+    return db.session.query(
+        Transaction.id, Transaction.currency, Transaction.amount,
+        Transaction.price, Transaction.type, Transaction.date
+    ).filter(*clauses)
+
+def transaction_json(row):
+    return {
+        "id": row.id,
+        "currency": row.currency,
+        "amount": from_units(row.amount, row.currency),
+        "price": price_from_units(row.price),
+        "type": row.type,
+        "date": row.date
+    }
+
 @app.route('/api/transactions', methods=['GET'])
 @jwt_required()
 def get_transactions():
+    """Newest first, one page at a time; pass X-Next-Cursor back as ?cursor= for the next page."""
     user_id = get_jwt_identity()
-    transactions = Transaction.query.filter_by(user_id=user_id).all()
-    transaction_data = [{
-        "id": item.id,
-        "currency": item.currency,
-        "amount": item.amount,
-        "price": item.price,
-        "type": item.type,
-        "date": item.date
-    } for item in transactions]
-    return jsonify(transaction_data), 200
+    try:
+        clauses = transaction_filters(user_id, request.args)
+        limit = int(request.args.get('limit', TRANSACTIONS_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        if cursor:
+            clauses.append(Transaction.id < int(cursor))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = max(1, min(limit, MAX_TRANSACTIONS_PAGE_SIZE))
+
+    rows = transaction_rows(clauses).order_by(Transaction.id.desc()).limit(limit + 1).all()
+    response = jsonify([transaction_json(row) for row in rows[:limit]])
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = str(rows[limit - 1].id)
+    return response, 200
+
+@app.route('/api/transactions/export', methods=['GET'])
+@jwt_required()
+def export_transactions():
+    """Stream the whole (filtered) history oldest first as NDJSON or CSV."""
+    user_id = get_jwt_identity()
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        clauses = transaction_filters(user_id, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def chunks():
+        last_id = 0
+        if export_format == 'csv':
+            yield ','.join(TRANSACTION_FIELDS) + '\r\n'
+        while True:
+            rows = transaction_rows(clauses + [Transaction.id > last_id]) \
+                .order_by(Transaction.id).limit(EXPORT_CHUNK_SIZE).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in rows:
+                    item = transaction_json(row)
+                    writer.writerow([item[field] for field in TRANSACTION_FIELDS])
+                yield buffer.getvalue()
+            else:
+                yield ''.join(json.dumps(transaction_json(row)) + '\n' for row in rows)
 
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = app.response_class(stream_with_context(chunks()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=transactions.%s' % export_format
+    return response
 
 from datetime import datetime
 
+def submit_order(currency, key, user_id, item):
+    """Queue `item` for the `currency` book's matcher and return its ticket.
+
+    Orders spending a currency whose wallets another matcher keeps, such
+    as the quote of buys, go through that matcher first, which reserves
+    what they need there.
+    """
+    pair = pairs.pair(currency)
+    orders = item["items"] if item["command"] == 'batch' else [item]
+    via = sorted({pair.spends(order["type"]) for order in orders
+                  if order["command"] in ('order', 'amend')} - {currency})
+    if not via:
+        return ingest.submit(currency, key, user_id, item)
+    return ingest.submit(currency, key, user_id, {"command": 'reserve', "book": currency, "via": via[1:],
+                                                   "item": item}, via=via[0])
+
+def submit_command(currency, user_id, item):
+    """Queue a command other than a new order for the currency's matcher and return its ticket."""
+    key = '%s-%d' % (item["command"], next(command_ids))
+    return submit_order(currency, key, user_id, dict(item, user_id=user_id))
+
+def wallet_change(currency, user_id, command, units):
+    """Queue a deposit or withdrawal for the currency's matcher, which owns its balances."""
+    return submit_command(currency, user_id, {"command": command, "amount": units})
+
+def user_not_found():
+    return jsonify({"error": "User not found"}), 404
+
+def queue_full():
+    response = jsonify({"error": "Order queue is full, retry later"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route('/api/wallet/deposit', methods=['POST'])
 @jwt_required()
 def deposit():
     user_id = get_jwt_identity()
+    if user_contexts.get(user_id) is None:
+        return user_not_found()
     data = request.get_json()
     currency = data.get('currency')
     amount = data.get('amount')
@@ -154,14 +625,21 @@ def deposit():
     if not all([currency, amount]):
         return jsonify({"error": "Missing data"}), 400
 
-    wallet = Wallet.query.filter_by(user_id=user_id, currency=currency).first()
-    if wallet:
-        wallet.balance += amount
-    else:
-        wallet = Wallet(user_id=user_id, currency=currency, balance=amount)
-        db.session.add(wallet)
+    try:
+        units = to_units(amount, str(currency))
+    except ValueError:
+        return jsonify({"error": "Invalid amount"}), 400
+    if units <= 0:
+        return jsonify({"error": "Invalid amount"}), 400
 
-    db.session.commit()
+    try:
+        ticket = wallet_change(currency, user_id, 'deposit', units)
+    except queue.Full:
+        return queue_full()
+    if not ticket.wait(MAX_ORDER_WAIT):
+        return jsonify({"message": "Deposit queued", "currency": currency, "amount": amount}), 202
+    if ticket.status == 'rejected':
+        return jsonify({"error": ticket.error}), 400
     return jsonify({"message": "Deposit successful", "currency": currency, "amount": amount}), 200
 
 
@@ -175,312 +653,1613 @@ def withdraw():
 
     if not all([currency, amount]):
         return jsonify({"error": "Currency and amount are required"}), 400
-    
-    wallet = Wallet.query.filter_by(user_id=user_id, currency=currency).first()
-    if not wallet:
-        return jsonify({"error": "Wallet for the specified currency not found"}), 404
 
-    if wallet.balance < amount:
-        return jsonify({"error": "Insufficient balance"}), 400
+    try:
+        units = to_units(amount, str(currency))
+    except ValueError:
+        return jsonify({"error": "Invalid amount"}), 400
+    if units <= 0:
+        return jsonify({"error": "Invalid amount"}), 400
+
+    context = user_contexts.get(user_id)
+    if context is None:
+        return user_not_found()
+    if currency not in context["wallets"]:
+        return jsonify({"error": NO_WALLET}), 404
 
     # Уменьшить баланс
-    wallet.balance -= amount
-    db.session.commit()
-
-    return jsonify({"message": "Withdrawal successful", "currency": currency, "remaining_balance": wallet.balance}), 200
+    try:
+        ticket = wallet_change(currency, user_id, 'withdraw', units)
+    except queue.Full:
+        return queue_full()
+    if not ticket.wait(MAX_ORDER_WAIT):
+        return jsonify({"message": "Withdrawal queued", "currency": currency, "amount": amount}), 202
+    if ticket.status == 'rejected':
+        if ticket.error == NO_WALLET:
+            return jsonify({"error": ticket.error}), 404
+        return jsonify({"error": ticket.error}), 400
+
+    # the matcher invalidated the cached context before finishing the ticket
+    balance = user_contexts.get(user_id)["wallets"][currency]
+    return jsonify({"message": "Withdrawal successful", "currency": currency, "remaining_balance": from_units(balance, currency)}), 200
 
 @app.route('/api/popular_currencies', methods=['GET'])
 def get_popular_currencies():
-    popular_currencies = [
-        "BTC", "ETH", "USDC",
-    ]
-    return jsonify(popular_currencies), 200
+    return jsonify(pairs.symbols()), 200
+
+@app.route('/api/pairs', methods=['GET'])
+def get_pairs():
+    """The registered trading pairs with their tick (price step) and lot (amount step) sizes."""
+    return jsonify([{
+        "symbol": pair.symbol,
+        "base": pair.base,
+        "quote": pair.quote,
+        "tickSize": price_from_units(pair.tick),
+        "lotSize": from_units(pair.lot, pair.base)
+    } for pair in map(pairs.get, pairs.symbols())]), 200
+
+settlement_stats = {"orders": 0, "fills": 0, "commits": 0, "seconds": 0.0}
+NO_WALLET = 'Wallet for the specified currency not found'
+NOT_FILLABLE = 'Order cannot be filled in full'
+WOULD_TRADE = 'Post-only order would trade immediately'
+TIME_IN_FORCE = ('GTC', 'IOC', 'FOK', 'POST_ONLY')
+# time in force of orders whose unfilled remainder rests on the book
+RESTING = ('GTC', 'POST_ONLY')
+MARKET_BUY_PRICE = 2 ** 62
+
+def record_settlement(orders, fills, seconds):
+    settlement_stats["orders"] += orders
+    settlement_stats["fills"] += fills
+    settlement_stats["commits"] += 1
+    settlement_stats["seconds"] += seconds
+
+def save_balances(currency, deltas):
+    """Add balance deltas onto the `currency` wallets in one batched UPDATE, creating missing wallets."""
+    wallets = Wallet.__table__
+    updates = [{"b_user_id": user_id, "delta": delta} for user_id, delta in deltas.items()
+               if ledger.has_wallet(user_id, currency)]
+    if updates:
+        db.session.execute(
+            wallets.update()
+            .where(wallets.c.user_id == db.bindparam('b_user_id'), wallets.c.currency == currency)
+            .values(balance=wallets.c.balance + db.bindparam('delta')),
+            updates
+        )
+    created = [{"user_id": user_id, "currency": currency, "balance": delta} for user_id, delta in deltas.items()
+               if not ledger.has_wallet(user_id, currency)]
+    if created:
+        db.session.execute(db.insert(Wallet), created)
+
+def counterparties(book, taker):
+    """Users the taker is expected to trade with, walking the book without touching it."""
+    user_ids = {taker.user_id}
+    remaining = taker.amount
+    for maker in book.crossing(taker.type, taker.price):
+        if remaining <= 0:
+            break
+        user_ids.add(maker.user_id)
+        remaining -= maker.amount
+    return user_ids
+
+def add_trade_stats(totals, days, transaction):
+    """Fold one transaction row into per-user totals and per-day trade counts."""
+    stats = totals.setdefault(transaction["user_id"], [0, 0, 0, 0])
+    volume = notional_units(transaction["price"], transaction["amount"], transaction["currency"])
+    if transaction["type"] == 'buy':
+        stats[0] += volume
+        stats[2] += 1
+    else:
+        stats[1] += volume
+        stats[3] += 1
+    key = (transaction["user_id"], transaction["date"][:10])
+    days[key] = days.get(key, 0) + 1
+
+def save_trade_stats(totals, days):
+    """Add accumulated totals onto the user_stats and user_trade_days rows."""
+    user_ids = set(totals)
+    existing = {row.user_id: row for row in UserStats.query.filter(UserStats.user_id.in_(user_ids))}
+    for user_id, (buy_volume, sell_volume, buy_trades, sell_trades) in totals.items():
+        row = existing.get(user_id)
+        if row is None:
+            row = UserStats(user_id=user_id, buy_volume=0, sell_volume=0, buy_trades=0, sell_trades=0)
+            db.session.add(row)
+        row.buy_volume += buy_volume
+        row.sell_volume += sell_volume
+        row.buy_trades += buy_trades
+        row.sell_trades += sell_trades
+
+    existing = {(row.user_id, row.day): row for row in UserTradeDay.query.filter(
+        UserTradeDay.user_id.in_(user_ids),
+        UserTradeDay.day.in_({day for user_id, day in days})
+    )}
+    for (user_id, day), trades in days.items():
+        row = existing.get((user_id, day))
+        if row is None:
+            db.session.add(UserTradeDay(user_id=user_id, day=day, trades=trades))
+        else:
+            row.trades += trades
+
+def settle(batch, new_order, taker, fills, rests=True, reserved=None):
+    """Write the balance deltas and order updates of `fills`; trade rows and stats go in `batch`.
+
+    Buyers receive the base currency and pay price x amount of the quote
+    currency, sellers the other way round. The ledger follows straight
+    away: makers' holds shrink by what they sold or paid, and a taker's
+    unfilled remainder is held if it rests. `reserved` is what the taker
+    had reserved on the matcher of the currency it spends, which its
+    remainder's hold replaces.
+    """
+    pair = pairs.pair(taker.currency)
+    opposite_type = 'sell' if taker.type == 'buy' else 'buy'
+    deltas, quote_deltas, holds, quote_holds = {}, {}, {}, {}
+    if rests:
+        if taker.type == 'sell':
+            holds[taker.user_id] = taker.amount
+        else:
+            quote_holds[taker.user_id] = pair.cost(taker.price, taker.amount)
+    transactions = []
+    now = datetime.now()
+    date = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    for fill in fills:
+        if taker.type == 'buy':
+            buyer_id, seller_id = taker.user_id, fill.maker.user_id
+        else:
+            buyer_id, seller_id = fill.maker.user_id, taker.user_id
+        cost = pair.cost(fill.price, fill.amount)
+        deltas[buyer_id] = deltas.get(buyer_id, 0) + fill.amount
+        deltas[seller_id] = deltas.get(seller_id, 0) - fill.amount
+        quote_deltas[buyer_id] = quote_deltas.get(buyer_id, 0) - cost
+        quote_deltas[seller_id] = quote_deltas.get(seller_id, 0) + cost
+        maker = fill.maker
+        if maker.type == 'sell':
+            holds[seller_id] = holds.get(seller_id, 0) - fill.amount
+        else:
+            # what is held for the maker's remainder at its own price
+            quote_holds[buyer_id] = quote_holds.get(buyer_id, 0) - (
+                pair.cost(maker.price, maker.amount + fill.amount) - pair.cost(maker.price, maker.amount))
+
+        transactions.append({
+            "user_id": taker.user_id,
+            "currency": taker.currency,
+            "amount": fill.amount,
+            "price": fill.price,
+            "type": taker.type,
+            "date": date
+        })
+        transactions.append({
+            "user_id": fill.maker.user_id,
+            "currency": taker.currency,
+            "amount": fill.amount,
+            "price": fill.price,
+            "type": opposite_type,
+            "date": date
+        })
+
+    makers = {fill.maker.id: fill.maker for fill in fills}
+    if makers:
+        db.session.execute(db.update(Order), [{
+            "id": maker.id,
+            "amount": maker.amount,
+            "status": 'filled' if maker.amount <= 0 else 'active'
+        } for maker in makers.values()])
+    batch["transactions"] += transactions
+    for transaction in transactions:
+        add_trade_stats(batch["totals"], batch["days"], transaction)
+    if fills:
+        # candles bucket trades on the same clock their transactions are dated with
+        batch["trades"].append((wall_clock(now), [(fill.price, fill.amount) for fill in fills]))
+
+    new_order.amount = taker.amount
+    if taker.amount <= 0:
+        new_order.status = 'filled'
+    elif not rests:
+        new_order.status = 'cancelled'
+
+    if reserved is not None:
+        spent = holds if taker.type == 'sell' else quote_holds
+        spent[taker.user_id] = spent.get(taker.user_id, 0) - reserved
+    shift(batch, pair.base, deltas, holds)
+    shift(batch, pair.quote, quote_deltas, quote_holds)
+
+def shift(batch, currency, balances, holds=None):
+    """Apply balance and hold deltas, {user_id: delta}, of `currency`'s wallets for the batch.
+
+    Wallets this thread keeps are written and the ledger follows. For the
+    others the deltas are summed up in the batch and sent to their matcher
+    as a transfer once it commits.
+    """
+    if keeps(currency):
+        save_balances(currency, balances)
+        ledger.apply(currency, balances, holds)
+        batch["undo"].append((currency, holds or {}))
+        return
+    transfer = batch["transfers"].setdefault(currency, {})
+    for index, deltas in enumerate((balances, holds)):
+        for user_id, delta in (deltas or {}).items():
+            transfer.setdefault(user_id, [0, 0])[index] += delta
+
+def take_reserved(batch, currency, data):
+    """What the API reserved in `currency` for the order in `data`, or None if this thread keeps `currency`.
+
+    Settling the order uses the reservation up; if the batch fails instead,
+    it is released.
+    """
+    if keeps(currency):
+        return None
+    units = data.get("reserved", 0)
+    if units:
+        batch["reserved"].append((currency, data["user_id"], units))
+    return units
+
+def release_reserved(batch):
+    """Hand back what the API reserved for the orders of a batch that was not committed."""
+    released = {}
+    for currency, user_id, units in batch["reserved"]:
+        holds = released.setdefault(currency, {})
+        holds[user_id] = holds.get(user_id, 0) - units
+    for currency, holds in released.items():
+        send_to_matcher(currency, {"command": 'transfer', "id": None,
+                                   "balances": [[user_id, 0, held] for user_id, held in holds.items()]})
+
+def stage_transfers(batch):
+    """(currency, matcher item) of each of the batch's transfers, adding rows for their balance deltas.
+
+    The rows commit with the batch, so balances the receiver has not
+    applied yet survive a crash; it deletes the row as it applies one,
+    which makes applying it again a no-op.
+    """
+    staged = []
+    for currency, deltas in batch["transfers"].items():
+        balances = [[user_id, balance, held] for user_id, (balance, held) in deltas.items() if balance or held]
+        moved = [[user_id, balance] for user_id, balance, held in balances if balance]
+        row = Transfer(currency=currency, balances=json.dumps(moved)) if moved else None
+        if row is not None:
+            db.session.add(row)
+        if balances:
+            staged.append((currency, row, balances))
+    if any(row is not None for currency, row, balances in staged):
+        db.session.flush()
+    return [(currency, {"command": 'transfer', "id": row.id if row is not None else None, "balances": balances})
+            for currency, row, balances in staged]
+
+def send_to_matcher(currency, item):
+    """Queue `item` for `currency`'s matcher, unbounded; a matching process sends it through the API process."""
+    ingest.send(currency, item)
+
+def new_batch(book):
+    """Changes to `book` that are committed together.
+
+    The book and the ledger change as the work is done; "undo" lists the
+    ledger's hold changes for a rollback. Trade rows, stats, points and
+    transfers to other matchers are summed up here and written once, and
+    journal records appended, just before the commit; transfers, market
+    data and leaderboard points follow it.
+    """
+    return {"book": book, "transactions": [], "totals": {}, "days": {}, "awards": {}, "trades": [],
+            "records": [], "published": [], "transfers": {}, "reserved": [], "undo": [],
+            "orders": 0, "fills": 0, "started": time.perf_counter()}
+
+def save_points(awards):
+    """Add {user_id: [points, orders]} onto the user_points rows, creating missing ones."""
+    existing = {row.user_id: row for row in UserPoints.query.filter(UserPoints.user_id.in_(awards))}
+    for user_id, (points, orders) in awards.items():
+        row = existing.get(user_id)
+        if row is None:
+            db.session.add(UserPoints(user_id=user_id, points=points, total_trades=orders))
+        else:
+            row.points += points
+            row.total_trades += orders
+
+def commit_batch(batch):
+    book = batch["book"]
+    with metrics.span('commit'):
+        if batch["transactions"]:
+            db.session.execute(db.insert(Transaction), batch["transactions"])
+            save_trade_stats(batch["totals"], batch["days"])
+        if batch["awards"]:
+            save_points(batch["awards"])
+        if batch["trades"]:
+            for at, trades in batch["trades"]:
+                candles.add_trades(book.currency, trades, at)
+            save_candles(book.currency)
+        transfers = stage_transfers(batch)
+        # write-ahead: a failed commit discards the batch, which snapshots the book again
+        if journal is not None:
+            sequence = journal.append(book, batch["records"])
+            if sequence is not None:
+                save_journal_mark(book.currency, sequence)
+        db.session.commit()
+    for currency, item in transfers:
+        send_to_matcher(currency, item)
+    touched = set(batch["totals"]) | set(batch["awards"])
+    if touched:
+        user_contexts.invalidate(list(touched))
+
+    with metrics.span('publish'):
+        for publish, args in batch["published"]:
+            publish(book, *args)
+        for user_id, (points, orders) in batch["awards"].items():
+            ranking.award(user_id, points)
+    if batch["orders"]:
+        record_settlement(batch["orders"], batch["fills"], time.perf_counter() - batch["started"])
+
+def discard_batch(batch):
+    """Roll back, undo the batch's ledger changes and rebuild its book from the database."""
+    db.session.rollback()
+    currency = batch["book"].currency
+    book = engine.reload(currency, active_orders(currency))
+    ledger.revert(batch["undo"])
+    release_reserved(batch)
+    load_candles(currency)
+    if journal is not None:
+        # the journal may be missing events that did get committed
+        journal.snapshot(book)
+    feed.resync(currency)
+
+def in_batch(currency, work):
+    """Run `work(batch)` against `currency`'s book and commit everything it wrote at once.
+
+    OrderRejected is raised before anything is written; any other error
+    discards the whole batch.
+    """
+    batch = new_batch(engine.book(currency))
+    with database_writes:
+        try:
+            result = work(batch)
+            commit_batch(batch)
+            return result
+        except OrderRejected:
+            db.session.rollback()
+            release_reserved(batch)
+            raise
+        except Exception:
+            discard_batch(batch)
+            raise
+
+def funded(book, taker, reserved=None):
+    """can_fill for `taker`'s fills: the seller must still hold what it sells, the buyer what it pays.
+
+    The taker pays out of what its resting orders leave available, or out
+    of `reserved` when another matcher keeps the currency it spends. Makers
+    are backed by their holds, so their balances are enough; this only
+    catches books that predate holds, where funds back several orders.
+    Makers spending a currency kept elsewhere are backed by what they
+    reserved there.
+    """
+    pair = pairs.pair(book.currency)
+    spent = {}
+
+    def taker_funds(user_id, currency):
+        return ledger.available(user_id, currency) if keeps(currency) else reserved or 0
+
+    def maker_funds(user_id, currency):
+        return ledger.balance(user_id, currency) if keeps(currency) else math.inf
+
+    def can_fill(maker, amount):
+        cost = pair.cost(maker.price, amount)
+        if taker.type == 'buy':
+            legs = ((maker.user_id, pair.base, amount, maker_funds),
+                    (taker.user_id, pair.quote, cost, taker_funds))
+        else:
+            legs = ((taker.user_id, pair.base, amount, taker_funds),
+                    (maker.user_id, pair.quote, cost, maker_funds))
+        for user_id, currency, units, funds in legs:
+            if funds(user_id, currency) - spent.get((user_id, currency), 0) < units:
+                return False
+        for user_id, currency, units, funds in legs:
+            spent[(user_id, currency)] = spent.get((user_id, currency), 0) + units
+        return True
+    return can_fill
+
+def affordable(book, type, price, amount, budget):
+    """How much of a buy of `amount` up to `price` `budget` quote units pay for, walking the book.
+
+    All of it if the budget outlasts the book: what the book lacks is left
+    to the order's time in force.
+    """
+    pair = pairs.pair(book.currency)
+    bought = 0
+    for maker in book.crossing(type, price):
+        if bought >= amount:
+            break
+        take = min(amount - bought, maker.amount)
+        cost = pair.cost(maker.price, take)
+        if cost > budget:
+            return bought + min(take, pair.amount_for(maker.price, budget))
+        bought += take
+        budget -= cost
+    return amount
+
+def fillable(book, taker, can_fill):
+    """How much of `taker` the book would fill now, walking it without touching it."""
+    remaining = taker.amount
+    for maker in book.crossing(taker.type, taker.price):
+        if remaining <= 0:
+            break
+        amount = min(remaining, maker.amount)
+        if can_fill(maker, amount):
+            remaining -= amount
+    return taker.amount - remaining
+
+def match_order(batch, new_order, time_in_force='GTC', reserved=None):
+    """Match an order against the batch's book, settle its fills and return them.
+
+    GTC and post-only orders are flushed rows and rest what they do not
+    fill. IOC and FOK orders never rest: the remainder is cancelled, and a
+    FOK order the book cannot fill in full is rejected before anything
+    changes. `reserved` is what the order reserved on the matcher of a
+    currency it spends that this thread does not keep.
+    """
+    book = batch["book"]
+    rests = time_in_force in RESTING
+    with engine.lock(book.currency):
+        taker = BookOrder.from_row(new_order)
+        accepted = taker.amount
+        pair = pairs.pair(book.currency)
+        users = counterparties(book, taker)
+        for currency in (pair.base, pair.quote):
+            if keeps(currency):
+                ledger.fetch(currency, users)
+        if time_in_force == 'FOK' and fillable(book, taker, funded(book, taker, reserved)) < taker.amount:
+            raise OrderRejected(NOT_FILLABLE)
+
+        with metrics.span('match'):
+            fills = book.match(taker, funded(book, taker, reserved))
+        with metrics.span('settle'):
+            settle(batch, new_order, taker, fills, rests, reserved)
+        if taker.amount > 0 and rests:
+            book.add(taker)
+
+    if journal is not None:
+        batch["records"] += order_records(taker, accepted, fills)
+        if taker.amount > 0 and not rests:
+            batch["records"] += cancel_records([taker])
+    batch["published"].append((publish_market_data, (taker, fills)))
+    batch["orders"] += 1
+    batch["fills"] += len(fills)
+    return fills
 
 def match_orders(new_order):
+    """Match and commit one flushed order on its own; False if that failed."""
     try:
-        opposite_type = 'sell' if new_order.type == 'buy' else 'buy'
-        
-        if new_order.type == 'buy':
-            matching_orders = Order.query.filter_by(
-                currency=new_order.currency, 
-                type=opposite_type, 
-                status='active'
-            ).filter(Order.price <= new_order.price).order_by(Order.price.asc()).all()
-        else:
-            matching_orders = Order.query.filter_by(
-                currency=new_order.currency, 
-                type=opposite_type, 
-                status='active'
-            ).filter(Order.price >= new_order.price).order_by(Order.price.desc()).all()
-
-        remaining_amount = new_order.amount
-
-        for matching_order in matching_orders:
-            if remaining_amount <= 0:
-                break
+        in_batch(new_order.currency, lambda batch: match_order(batch, new_order))
+        return True
+    except Exception:
+        return False
 
-            if new_order.type == 'buy':
-                seller_wallet = Wallet.query.filter_by(
-                    user_id=matching_order.user_id, 
-                    currency=new_order.currency
-                ).first()
+def publish_market_data(book, taker, fills):
+    currency = book.currency
+    for fill in fills:
+        feed.publish(currency, 'trade', price=price_from_units(fill.price),
+                     amount=from_units(fill.amount, currency), side=taker.type)
+
+    changed = {(fill.maker.type, fill.maker.price) for fill in fills}
+    if taker.amount > 0 and taker.id in book:
+        changed.add((taker.type, taker.price))
+    publish_levels(book, changed)
+
+def publish_levels(book, changed):
+    """Publish the current totals of the `changed` (side, price) levels."""
+    currency = book.currency
+    if changed:
+        changes, levels = [], []
+        for side, price in sorted(changed):
+            level = book.side(side).levels.get(price)
+            total, count = (level.total, level.count) if level else (0, 0)
+            changes.append([side, price_from_units(price), from_units(total, currency)])
+            levels.append((side, price, total, count))
+        if mirror_levels is not None:
+            mirror_levels(currency, book.version, levels)
+        feed.publish(currency, 'levels', changes=changes)
+
+@app.route('/api/stats/settlement', methods=['GET'])
+def get_settlement_stats():
+    orders = settlement_stats["orders"]
+    seconds = settlement_stats["seconds"]
+    return jsonify({
+        "orders": orders,
+        "fills": settlement_stats["fills"],
+        "commits": settlement_stats["commits"],
+        "fillsPerSecond": settlement_stats["fills"] / seconds if seconds else 0,
+        "commitsPerOrder": settlement_stats["commits"] / orders if orders else 0
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of the counters, histograms and current queue and cache state."""
+    gauges = [('cex_queue_depth', {"queue": queue_name}, depth) for queue_name, depth in sorted(ingest.pending().items())]
+    gauges += [('cex_user_cache_' + name, {}, value) for name, value in user_contexts.stats().items()
+               if name != 'hitRate']
+    gauges += [('cex_settlement_' + name, {}, value) for name, value in settlement_stats.items()]
+    gauges += [('cex_client_orders_' + name, {}, value) for name, value in client_orders.stats().items()]
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats/user_cache', methods=['GET'])
+def get_user_cache_stats():
+    return jsonify(user_contexts.stats()), 200
+
+def place_order(currency, data):
+    """Persist and match one queued order on its currency's matching thread."""
+    with app.app_context():
+        return in_batch(currency, lambda batch: add_order(batch, data))
+
+def client_order_taken(data):
+    """Whether the queued order carries a client id that one of the user's orders already has."""
+    return data.get("client_order_id") is not None and db.session.query(Order.id).filter_by(
+        user_id=data["user_id"], client_order_id=data["client_order_id"]).first() is not None
+
+def add_order(batch, data):
+    """Insert and match one order; its points are added up in the batch.
+
+    IOC, FOK and market orders only get a row if they trade or carry a
+    client order id, written after matching; a market order's row has its
+    average fill price. Sells must
+    have the base amount available and limit buys its cost in the quote
+    currency; a market buy is cut down to what the buyer's quote pays for.
+    Funds in a currency this thread does not keep are what the API
+    reserved on its matcher.
+    """
+    book = batch["book"]
+    currency = book.currency
+    pair = pairs.pair(currency)
+    time_in_force = data.get("time_in_force", 'GTC')
+    amount = data["amount"]
+    spends = pair.spends(data["type"])
+    reserved = take_reserved(batch, spends, data)
+    available = ledger.available(data["user_id"], spends) if reserved is None else reserved
+    if data["type"] == 'sell':
+        if available < amount:
+            raise OrderRejected('Insufficient balance')
+    elif data.get("market"):
+        amount = affordable(book, data["type"], data["price"], amount, available)
+        if amount < data["amount"] and time_in_force == 'FOK':
+            raise OrderRejected(NOT_FILLABLE)
+        if amount <= 0:
+            raise OrderRejected('Insufficient balance')
+    elif available < pair.cost(data["price"], amount):
+        raise OrderRejected('Insufficient balance')
+    if time_in_force == 'POST_ONLY' and next(book.crossing(data["type"], data["price"]), None) is not None:
+        raise OrderRejected(WOULD_TRADE)
+    if time_in_force not in RESTING and client_order_taken(data):
+        raise OrderRejected(DUPLICATE_CLIENT_ORDER)
+
+    new_order = Order(
+        id=data["id"],
+        user_id=data["user_id"],
+        currency=currency,
+        amount=amount,
+        price=data["price"],
+        type=data["type"],
+        status='active',
+        client_order_id=data.get("client_order_id")
+    )
+    if time_in_force in RESTING:
+        with metrics.span('insert'):
+            db.session.add(new_order)
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # a retry that missed the API's index, e.g. sent to another API process
+                raise OrderRejected(DUPLICATE_CLIENT_ORDER)
+        match_order(batch, new_order, reserved=reserved)
+    else:
+        fills = match_order(batch, new_order, time_in_force, reserved)
+        if fills and data.get("market"):
+            filled = sum(fill.amount for fill in fills)
+            new_order.price = sum(fill.price * fill.amount for fill in fills) // filled
+        # a cancelled order with a client id keeps its row, so a retry past
+        # the API's index is answered from it instead of trading again
+        if fills or new_order.client_order_id is not None:
+            db.session.add(new_order)
+
+    award = batch["awards"].setdefault(data["user_id"], [0, 0])
+    award[0] += data["points"]
+    award[1] += 1
+    return new_order.status
+
+def change_balance(currency, data):
+    """Apply a queued deposit or withdrawal on its currency's matching thread."""
+    with app.app_context():
+        try:
+            user_id, units = data["user_id"], data["amount"]
+            if data["command"] == 'withdraw':
+                if not ledger.has_wallet(user_id, currency):
+                    raise OrderRejected(NO_WALLET)
+                if ledger.available(user_id, currency) < units:
+                    raise OrderRejected('Insufficient balance')
+                units = -units
+            with database_writes, metrics.span('balances'):
+                save_balances(currency, {user_id: units})
+                db.session.commit()
+            ledger.apply(currency, {user_id: units})
+            user_contexts.invalidate([user_id])
+            return 'completed'
+
+        except Exception:
+            db.session.rollback()
+            raise
+
+ORDER_NOT_OPEN = 'Order not found or no longer open'
+
+def unbook(batch, orders, release=True):
+    """Take resting `orders` off the batch's book and, with `release`, release what they held."""
+    book = batch["book"]
+    with engine.lock(book.currency):
+        for order in orders:
+            book.cancel(order.id)
+    pair = pairs.pair(book.currency)
+    holds, quote_holds = {}, {}
+    for order in orders if release else ():
+        if order.type == 'sell':
+            holds[order.user_id] = holds.get(order.user_id, 0) - order.amount
+        else:
+            quote_holds[order.user_id] = quote_holds.get(order.user_id, 0) - pair.cost(order.price, order.amount)
+    shift(batch, pair.base, {}, holds)
+    shift(batch, pair.quote, {}, quote_holds)
+    if journal is not None:
+        batch["records"] += cancel_records(orders)
+    batch["published"].append((publish_levels, ({(order.type, order.price) for order in orders},)))
+
+def cancel_resting(batch, user_id, ids):
+    """Cancel the user's listed orders; ids no longer resting are skipped."""
+    book = batch["book"]
+    orders = [order for order in map(book.get, ids) if order is not None and order.user_id == user_id]
+    if not orders:
+        raise OrderRejected(ORDER_NOT_OPEN)
+    db.session.execute(db.update(Order), [{"id": order.id, "status": 'cancelled'} for order in orders])
+    unbook(batch, orders)
+    return 'cancelled', [order.id for order in orders]
+
+def cancel_orders(currency, data):
+    with app.app_context():
+        return in_batch(currency, lambda batch: cancel_resting(batch, data["user_id"], data["ids"]))
+
+def amend_order(currency, data):
+    """Change the amount and/or price of one of the caller's resting orders.
+
+    Shrinking an order at its price keeps its place in the queue. Any other
+    change takes it off the book and matches it again at the new price, as
+    if it had just arrived.
+    """
+    with app.app_context():
+        return in_batch(currency, lambda batch: amend_resting(batch, data))
+
+def amend_resting(batch, data):
+    book = batch["book"]
+    pair = pairs.pair(book.currency)
+    spends = pair.spends(data["type"])
+    reserved = take_reserved(batch, spends, data)
+    order = book.get(data["id"])
+    if order is None or order.user_id != data["user_id"] or order.type != data["type"]:
+        raise OrderRejected(ORDER_NOT_OPEN)
+    price = pair.limit(order.type, data["price"]) if data["price"] else order.price
+    amount = data["amount"] or order.amount
+    if price <= 0:
+        raise OrderRejected('Invalid amount or price')
+
+    if price == order.price and amount <= order.amount:
+        if amount < order.amount:
+            reduced = order.amount - amount
+            db.session.execute(db.update(Order), [{"id": order.id, "amount": amount}])
+            with engine.lock(book.currency):
+                book.reduce(order.id, reduced)
+            if order.type == 'sell':
+                released = reduced
             else:
-                seller_wallet = Wallet.query.filter_by(
-                    user_id=new_order.user_id, 
-                    currency=new_order.currency
-                ).first()
-
-            if not seller_wallet or seller_wallet.balance < matching_order.amount:
+                released = pair.cost(order.price, order.amount) - pair.cost(order.price, amount)
+            shift(batch, spends, {}, {order.user_id: -released})
+            if journal is not None:
+                batch["records"] += reduce_records(order, reduced)
+            batch["published"].append((publish_levels, ({(order.type, order.price)},)))
+        if reserved:
+            shift(batch, spends, {}, {order.user_id: -reserved})
+        return 'active'
+
+    if order.type == 'sell':
+        held, needed = order.amount, amount
+    else:
+        held, needed = pair.cost(order.price, order.amount), pair.cost(price, amount)
+    available = ledger.available(order.user_id, spends) if reserved is None else reserved
+    if available + held < needed:
+        raise OrderRejected('Insufficient balance')
+    # on another matcher the order's hold stays put and backs the new order with the reservation
+    unbook(batch, [order], release=reserved is None)
+    row = db.session.get(Order, order.id)
+    row.price = price
+    row.amount = amount
+    db.session.flush()
+    match_order(batch, row, reserved=None if reserved is None else reserved + held)
+    return row.status
+
+def run_batch(currency, data):
+    """Run one currency's share of a client batch in order and commit it once.
+
+    A rejected item is reported and skipped; the others still run.
+    """
+    def work(batch):
+        results = []
+        for item in data["items"]:
+            if item.get("rejected"):
+                results.append(('rejected', item["rejected"]))
                 continue
-            trade_amount = min(remaining_amount, matching_order.amount)
-            trade_price = matching_order.price
-            
-            if not can_execute_trade(new_order, matching_order, trade_amount, trade_price):
+            reservations = len(batch["reserved"])
+            try:
+                if item["command"] == 'cancel':
+                    status = cancel_resting(batch, data["user_id"], item["ids"])[0]
+                else:
+                    # a retry racing its original, e.g. through another API process;
+                    # a failed insert would void the rest of the batch
+                    if client_order_taken(item):
+                        raise OrderRejected(DUPLICATE_CLIENT_ORDER)
+                    status = add_order(batch, item)
+                results.append((status, None))
+            except OrderRejected as e:
+                for spends, user_id, units in batch["reserved"][reservations:]:
+                    shift(batch, spends, {}, {user_id: -units})
+                results.append(('rejected', str(e)))
+        return 'completed', results
+
+    with app.app_context():
+        return in_batch(currency, work)
+
+def reserve_funds(currency, data):
+    """Hold what queued orders spend in this matcher's currency, then pass them on to their book.
+
+    A limit order reserves what it can cost, a sell its amount and a
+    market buy everything available, which its book hands back once the
+    order is settled. A batch's orders that cannot be covered are marked
+    rejected and passed on with the others.
+    """
+    with app.app_context():
+        item = data["item"]
+        pair = pairs.pair(data["book"])
+        for order in item["items"] if item["command"] == 'batch' else [item]:
+            if order["command"] == 'cancel' or pair.spends(order["type"]) != currency:
                 continue
-
-            remaining_amount -= trade_amount
-            matching_order.amount -= trade_amount
-
-            if matching_order.amount == 0:
-                matching_order.status = 'filled'
-
-            transaction1 = Transaction(
-                user_id=new_order.user_id,
-                currency=new_order.currency,
-                amount=trade_amount,
-                price=trade_price,
-                type=new_order.type,
-                date=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            )
-            
-            transaction2 = Transaction(
-                user_id=matching_order.user_id,
-                currency=matching_order.currency,
-                amount=trade_amount,
-                price=trade_price,
-                type=opposite_type,
-                date=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            )
-
-            if new_order.type == 'buy':
-                buyer_id, seller_id = new_order.user_id, matching_order.user_id
+            available = ledger.available(order["user_id"], currency)
+            if order["command"] == 'amend':
+                units = order["reserve"]
+            elif order["type"] == 'sell':
+                units = order["amount"]
+            elif order.get("market"):
+                units = max(available, 0)
             else:
-                buyer_id, seller_id = matching_order.user_id, new_order.user_id
-
-            if not update_wallets(buyer_id, seller_id, new_order.currency, trade_amount, trade_price):
-                db.session.rollback()
+                units = pair.cost(order["price"], order["amount"])
+            if units > available or (order.get("market") and units <= 0):
+                if item["command"] != 'batch':
+                    raise OrderRejected('Insufficient balance')
+                order["rejected"] = 'Insufficient balance'
                 continue
-
-            db.session.add(transaction1)
-            db.session.add(transaction2)
-
-        new_order.amount = remaining_amount
-        if remaining_amount == 0:
-            new_order.status = 'filled'
-
-        db.session.commit()
-        return True
-
-    except Exception as e:
-        db.session.rollback()
-        return False
-def can_execute_trade(new_order, matching_order, trade_amount, trade_price):
-    """Проверка возможности выполнения сделки"""
+            ledger.apply(currency, holds={order["user_id"]: units})
+            order["reserved"] = units
+        if data["via"]:
+            return FORWARDED, (data["via"][0], dict(data, via=data["via"][1:]))
+        return FORWARDED, (data["book"], item)
+
+def apply_transfer(currency, data):
+    """Apply balance and hold deltas another matcher settled for this currency's wallets.
+
+    A transfer with balance deltas has a row, committed with the batch
+    that made it; deleting it in the same transaction as the balance
+    update makes a repeat, such as the startup pass over pending rows,
+    change nothing.
+    """
+    with app.app_context():
+        try:
+            balances = {user_id: balance for user_id, balance, held in data["balances"] if balance}
+            holds = {user_id: held for user_id, balance, held in data["balances"] if held}
+            if balances:
+                with database_writes, metrics.span('balances'):
+                    deleted = db.session.execute(db.delete(Transfer).where(Transfer.id == data["id"])).rowcount
+                    if not deleted:
+                        db.session.rollback()
+                        return 'completed'
+                    save_balances(currency, balances)
+                    db.session.commit()
+            ledger.apply(currency, balances, holds)
+            if balances:
+                user_contexts.invalidate(list(balances))
+            return 'completed'
+
+        except Exception:
+            db.session.rollback()
+            raise
+
+def depth_levels(currency, data):
+    """The book's version and every level, for seeding a depth mirror in the API process."""
+    with engine.lock(currency):
+        book = engine.peek(currency)
+        return 'completed', (book.version, book_levels(book))
+
+COMMANDS = {
+    "order": place_order,
+    "deposit": change_balance,
+    "withdraw": change_balance,
+    "cancel": cancel_orders,
+    "amend": amend_order,
+    "batch": run_batch,
+    "reserve": reserve_funds,
+    "transfer": apply_transfer,
+    "depth": depth_levels
+}
+
+def run_command(currency, data):
+    """Everything that changes a currency's books or balances runs here, on its matcher."""
+    command = data["command"]
+    matching.currency = currency
+    metrics.take_queries()
+    started = time.perf_counter()
     try:
-        if new_order.type == 'buy':
-            seller_wallet = Wallet.query.filter_by(
-                user_id=matching_order.user_id,
-                currency=new_order.currency
-            ).first()
-
-            if not seller_wallet or seller_wallet.balance < trade_amount:
-                return False
+        return COMMANDS[command](currency, data)
+    except OrderRejected:
+        metrics.inc('cex_rejections_total', command=command)
+        raise
+    except Exception as e:
+        metrics.error('matcher:' + command, e)
+        raise
+    finally:
+        metrics.observe('cex_command_seconds', time.perf_counter() - started, command=command)
+        metrics.observe('cex_command_queries', metrics.take_queries(), command=command)
+        if metrics.sink is not None:
+            metrics.flush()
+
+def init_matching_process(calls):
+    """Prepare a forked matching process.
+
+    It opens its own database connections, and market data, points and
+    settlement counters are handed to the API process, which serves them.
+    """
+    global feed, mirror_levels, ranking, record_settlement, send_to_matcher, user_contexts
+    with app.app_context():
+        db.engine.dispose(close=False)
+    feed = calls
+    send_to_matcher = calls.send
+    mirror_levels = calls.mirror_levels
+    ranking = calls
+    user_contexts = calls
+    metrics.forward_to(calls.merge_metrics)
+    record_settlement = calls.record_settlement
+
+# with matching processes, the API process serves book depth from these
+# mirrors, kept up to date from the levels each matcher publishes
+depth_mirrors = {}
+
+def depth_mirror(currency):
+    mirror = depth_mirrors.get(currency)
+    if mirror is None:
+        mirror = depth_mirrors.setdefault(currency, DepthMirror(currency))
+    return mirror
+
+def update_depth_mirror(currency, version, levels):
+    with engine.lock(currency):
+        depth_mirror(currency).update(version, levels)
+
+def resync_market_data(currency):
+    """A matcher rebuilt the book: reload the mirror on its next read, resync streams now."""
+    with engine.lock(currency):
+        depth_mirror(currency).reset()
+    feed.resync(currency)
+
+def matching_ingest(processes):
+    if not processes:
+        return OrderIngest(run_command)
+    depth_mirrors.clear()
+    return ShardedIngest(run_command, processes, init_matching_process, handlers={
+        "publish": feed.publish,
+        "mirror_levels": update_depth_mirror,
+        "resync": resync_market_data,
+        "award": ranking.award,
+        "invalidate": user_contexts.invalidate,
+        "merge_metrics": metrics.merge,
+        "record_settlement": record_settlement
+    })
+
+ingest = matching_ingest(MATCHING_PROCESSES)
+MAX_ORDER_WAIT = 30
+# a retried order with the same client_order_id gets the original back:
+# from this index for CEX_CLIENT_ORDER_TTL seconds, from its row after that
+client_orders = ClientOrderIndex(ttl=int(os.environ.get('CEX_CLIENT_ORDER_TTL', 3600)),
+                                 per_user=int(os.environ.get('CEX_CLIENT_ORDERS_PER_USER', 1000)))
+MAX_CLIENT_ORDER_ID = 64
+DUPLICATE_CLIENT_ORDER = 'Duplicate client_order_id'
 
-        else:  # sell
-            seller_wallet = Wallet.query.filter_by(
-                user_id=new_order.user_id,
-                currency=new_order.currency
-            ).first()
+with app.app_context():
+    order_ids = itertools.count((db.session.query(db.func.max(Order.id)).scalar() or 0) + 1)
+command_ids = itertools.count(1)
+
+def order_status_json(order_id, status, error=None):
+    result = {"order_id": order_id, "status": status}
+    if error:
+        result["error"] = error
+    return result
+
+def client_order_id_of(data):
+    """The request's "client_order_id" as a string, or None; ValueError if it is too long or empty."""
+    client_order_id = data.get('client_order_id')
+    if client_order_id is None:
+        return None
+    client_order_id = str(client_order_id)
+    if not 0 < len(client_order_id) <= MAX_CLIENT_ORDER_ID:
+        raise ValueError('client_order_id must be 1 to %d characters' % MAX_CLIENT_ORDER_ID)
+    return client_order_id
+
+def order_item(user_id, data):
+    """(currency, matcher item) for a new order in request `data`; ValueError says what is wrong.
+
+    "currency" is a registered pair symbol. "order_type" is limit (default)
+    or market, which takes no price and trades at whatever the book offers.
+    "time_in_force" is GTC (default for limit orders), IOC (default for
+    market orders), FOK or POST_ONLY. Amounts are rounded down to the
+    pair's lot size and prices onto its tick, down for buys and up for
+    sells.
+    """
+    currency = data.get('currency')
+    order_type = data.get('type')
+    kind = data.get('order_type', 'limit')
+    if kind not in ('limit', 'market'):
+        raise ValueError('order_type must be limit or market')
+    market = kind == 'market'
+    time_in_force = str(data.get('time_in_force') or ('IOC' if market else 'GTC')).upper()
+    if time_in_force not in TIME_IN_FORCE:
+        raise ValueError('time_in_force must be one of ' + ', '.join(TIME_IN_FORCE))
+    if market and data.get('price') is not None:
+        raise ValueError('Market orders take no price')
+    if market and time_in_force not in ('IOC', 'FOK'):
+        raise ValueError('Market orders must be IOC or FOK')
+    try:
+        amount = float(data.get('amount', 0))
+        price = float(data.get('price', 0)) if not market else None
+    except (TypeError, ValueError):
+        raise ValueError('Invalid amount or price')
+    if not math.isfinite(amount) or (price is not None and not math.isfinite(price)):
+        raise ValueError('Invalid amount or price')
+
+    if not all([currency, amount, price or market, order_type]):
+        raise ValueError('Missing required fields')
+    if order_type not in ('buy', 'sell'):
+        raise ValueError('type must be buy or sell')
+    pair = pairs.get(currency)
+    if pair is None:
+        raise ValueError('Unknown trading pair')
+
+    points = int(10 * amount)
+    try:
+        amount = to_units(amount, pair.base)
+        price = price_to_units(price) if not market else None
+    except ValueError:
+        raise ValueError('Invalid amount or price')
+    if amount <= 0:
+        raise ValueError('Invalid amount or price')
+    amount = pair.lots(amount)
+    if amount <= 0:
+        raise ValueError('Amount is below the lot size of %s' % from_units(pair.lot, pair.base))
+    if market:
+        # a limit no resting order can be beyond
+        price = MARKET_BUY_PRICE if order_type == 'buy' else 1
+    else:
+        if price <= 0 or price >= MARKET_BUY_PRICE:
+            raise ValueError('Invalid amount or price')
+        price = pair.limit(order_type, price)
+
+    if price <= 0:
+        raise ValueError('Price is below the tick size of %s' % price_from_units(pair.tick))
+
+    return currency, {
+        "command": 'order',
+        "id": next(order_ids),
+        "user_id": user_id,
+        "amount": amount,
+        "price": price,
+        "type": order_type,
+        "market": market,
+        "time_in_force": time_in_force,
+        "points": points
+    }
 
-            if not seller_wallet or seller_wallet.balance < trade_amount:
-                return False
+@app.route('/api/orderbook/create', methods=['POST'])
+@jwt_required()
+def create_order():
+    """Queue an order for its currency's matcher and acknowledge it with an id.
 
-        return True
+    With ?wait=<seconds> the request also waits for the order to be matched.
+    An optional "client_order_id" makes the request safe to retry: a
+    repeat answers with the first order's id and outcome, marked
+    "duplicate", and is never matched again.
+    """
+    try:
+        user_id = get_jwt_identity()
+        context = user_contexts.get(user_id)
+        if context is None:
+            return user_not_found()
+        data = request.get_json()
+        try:
+            with metrics.span('validate'):
+                currency, item = order_item(user_id, data)
+                client_order_id = client_order_id_of(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        pair = pairs.get(currency)
+        if (pair.base if item["type"] == 'sell' else pair.quote) not in context["wallets"]:
+            return jsonify(order_status_json(item["id"], 'rejected', 'Insufficient balance')), 400
+        wait = min(request.args.get('wait', 0, type=float), MAX_ORDER_WAIT)
+
+        fields = {}
+        if client_order_id is not None:
+            fields["client_order_id"] = client_order_id
+            ticket = client_orders.get(user_id, client_order_id)
+            if ticket is not None:
+                db.session.close()
+                return order_response(ticket, wait, duplicate=True, **fields)
+            # past the index's TTL the order is only known by its row
+            row = db.session.query(Order.id, Order.status).filter_by(
+                user_id=user_id, client_order_id=client_order_id).first()
+            if row is not None:
+                return jsonify(dict(order_status_json(row.id, row.status), duplicate=True, **fields)), 201
+            item["client_order_id"] = client_order_id
+
+        try:
+            with metrics.span('submit'):
+                submit = functools.partial(submit_order, currency, item["id"], user_id, item)
+                if client_order_id is None:
+                    ticket = submit()
+                else:
+                    # a concurrent retry may have claimed the id since the lookup
+                    ticket, created = client_orders.claim(user_id, client_order_id, submit)
+                    if not created:
+                        fields["duplicate"] = True
+        except queue.Full:
+            return queue_full()
+
+        # hand the pooled connection back before blocking on the matcher,
+        # which needs one to persist this very order
+        db.session.close()
+        return order_response(ticket, wait, **fields)
 
     except Exception as e:
-        return False
-def update_wallets(buyer_id, seller_id, currency, amount, price):
+        db.session.rollback()
+        return internal_error(e)
+
+def order_response(ticket, wait, **fields):
+    """The create response for `ticket`: its outcome if it is matched within `wait` seconds."""
+    order_id = ticket.order_id
+    if wait > 0:
+        with metrics.span('wait'):
+            ticket.wait(wait)
+    if wait > 0 and ticket.done.is_set():
+        if ticket.status == 'rejected':
+            return jsonify(dict(order_status_json(order_id, ticket.status, ticket.error), **fields)), 400
+        return jsonify(dict(order_status_json(order_id, ticket.status),
+                            message="Order created and matched successfully", **fields)), 201
+
+    return jsonify(dict(order_status_json(order_id, ticket.status), message="Order accepted", **fields)), 202
+
+@app.route('/api/orderbook/order/<int:order_id>', methods=['GET'])
+@jwt_required()
+def get_order_status(order_id):
+    """Status of one of the caller's orders; ?wait=<seconds> blocks while it is queued."""
+    user_id = get_jwt_identity()
+    ticket = ingest.ticket(order_id)
+    if ticket is not None and ticket.user_id == user_id:
+        wait = min(request.args.get('wait', 0, type=float), MAX_ORDER_WAIT)
+        if wait > 0:
+            ticket.wait(wait)
+        if ticket.status != 'active':
+            return jsonify(order_status_json(order_id, ticket.status, ticket.error)), 200
+
+    order = Order.query.filter_by(id=order_id, user_id=user_id).first()
+    if order is None:
+        if ticket is not None and ticket.user_id == user_id:
+            return jsonify(order_status_json(order_id, ticket.status, ticket.error)), 200
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify(dict(order_status_json(order_id, order.status),
+                        remaining=from_units(order.amount, order.currency))), 200
+
+def order_currency(order_id, user_id):
+    """Currency of one of the caller's orders: from its ticket while that is kept, else from its row."""
+    ticket = ingest.ticket(order_id)
+    if ticket is not None and ticket.user_id == user_id:
+        return ticket.currency
+    row = db.session.query(Order.currency).filter_by(id=order_id, user_id=user_id).first()
+    return row.currency if row else None
+
+def order_command_response(order_id, ticket):
+    """Wait for a cancel or amend to run and report the order's status after it."""
+    db.session.close()
+    if not ticket.wait(MAX_ORDER_WAIT):
+        return jsonify(dict(order_status_json(order_id, 'queued'), message="Request queued")), 202
+    if ticket.status == 'rejected':
+        return jsonify({"error": ticket.error}), 404 if ticket.error == ORDER_NOT_OPEN else 400
+    return jsonify(order_status_json(order_id, ticket.status)), 200
+
+@app.route('/api/orderbook/order/<int:order_id>', methods=['DELETE'])
+@jwt_required()
+def delete_order(order_id):
+    """Cancel one of the caller's resting orders."""
     try:
-        seller_wallet = Wallet.query.filter_by(user_id=seller_id, currency=currency).first()
-        if not seller_wallet or seller_wallet.balance < amount:
-            return False
-
-        buyer_wallet = Wallet.query.filter_by(user_id=buyer_id, currency=currency).first()
-        if not buyer_wallet:
-            buyer_wallet = Wallet(user_id=buyer_id, currency=currency, balance=0)
-            db.session.add(buyer_wallet)
-
-        if not seller_wallet:
-            seller_wallet = Wallet(user_id=seller_id, currency=currency, balance=0)
-            db.session.add(seller_wallet)
-
-        if seller_wallet.balance >= amount:
-            buyer_wallet.balance += amount
-            seller_wallet.balance -= amount
-            db.session.commit()
-            return True
-
-        return False
+        user_id = get_jwt_identity()
+        currency = order_currency(order_id, user_id)
+        if currency is None:
+            return jsonify({"error": "Order not found"}), 404
+        try:
+            ticket = submit_command(currency, user_id, {"command": 'cancel', "ids": [order_id]})
+        except queue.Full:
+            return queue_full()
+        return order_command_response(order_id, ticket)
 
     except Exception as e:
         db.session.rollback()
-        return False
+        return internal_error(e)
 
-@app.route('/api/orderbook/create', methods=['POST'])
+@app.route('/api/orderbook/order/<int:order_id>', methods=['PATCH'])
 @jwt_required()
-def create_order():
+def update_order(order_id):
+    """Amend a resting order with a new "amount" (what is left to fill) and/or "price".
+
+    A smaller amount at the same price keeps the order's queue priority;
+    any other change re-queues it and may trade straight away. Both are
+    rounded to the pair's steps as for new orders. Only orders that have
+    reached the book can be amended.
+    """
     try:
         user_id = get_jwt_identity()
         data = request.get_json()
+        order = db.session.query(Order.currency, Order.type, Order.price, Order.amount).filter_by(
+            id=order_id, user_id=user_id).first()
+        if order is None:
+            return jsonify({"error": "Order not found"}), 404
+        currency = order.currency
+
+        amount = data.get('amount')
+        price = data.get('price')
+        if amount is None and price is None:
+            return jsonify({"error": "amount or price is required"}), 400
+        pair = pairs.pair(currency)
+        try:
+            amount = pair.lots(to_units(float(amount), pair.base)) if amount is not None else None
+            price = price_to_units(float(price)) if price is not None else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid amount or price"}), 400
+        if (amount is not None and amount <= 0) or (price is not None and not 0 < price < MARKET_BUY_PRICE):
+            return jsonify({"error": "Invalid amount or price"}), 400
+        # what the order needs beyond its hold, reserved first when another matcher keeps the currency it spends
+        if order.type == 'sell':
+            reserve = (amount or order.amount) - order.amount
+        else:
+            reserve = pair.cost(price or order.price, amount or order.amount) - pair.cost(order.price, order.amount)
+
+        try:
+            ticket = submit_command(currency, user_id, {
+                "command": 'amend',
+                "id": order_id,
+                "type": order.type,
+                "amount": amount,
+                "price": price,
+                "reserve": max(reserve, 0)
+            })
+        except queue.Full:
+            return queue_full()
+        return order_command_response(order_id, ticket)
 
-        currency = data.get('currency')
-        amount = float(data.get('amount', 0))
-        price = float(data.get('price', 0))
-        order_type = data.get('type')
-
-        if not all([currency, amount, price, order_type]):
-            return jsonify({"error": "Missing required fields"}), 400
-
-        if order_type == 'sell':
-            wallet = Wallet.query.filter_by(user_id=user_id, currency=currency).first()
-            if not wallet or wallet.balance < amount:
-                return jsonify({"error": "Insufficient balance"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return internal_error(e)
 
-        if amount <= 0 or price <= 0:
-            return jsonify({"error": "Invalid amount or price"}), 400
+@app.route('/api/orderbook/orders', methods=['DELETE'])
+@jwt_required()
+def delete_orders():
+    """Cancel all of the caller's resting orders, or those in ?currency=, one command per book."""
+    try:
+        user_id = get_jwt_identity()
+        query = db.session.query(Order.currency, Order.id).filter_by(user_id=user_id, status='active')
+        if request.args.get('currency'):
+            query = query.filter_by(currency=request.args['currency'])
+        open_orders = {}
+        for currency, order_id in query:
+            open_orders.setdefault(currency, []).append(order_id)
+        db.session.close()
+
+        tickets = []
+        for currency, ids in open_orders.items():
+            try:
+                tickets.append(submit_command(currency, user_id, {"command": 'cancel', "ids": ids}))
+            except queue.Full:
+                return queue_full()
+
+        deadline = time.monotonic() + MAX_ORDER_WAIT
+        cancelled = []
+        for ticket in tickets:
+            if not ticket.wait(max(0, deadline - time.monotonic())):
+                return jsonify({"message": "Cancellation queued"}), 202
+            cancelled += ticket.result or []
+        return jsonify({"cancelled": sorted(cancelled)}), 200
 
-        new_order = Order(
-            user_id=user_id,
-            currency=currency,
-            amount=amount,
-            price=price,
-            type=order_type,
-            status='active'
-        )
-        
+    except Exception as e:
+        db.session.rollback()
+        return internal_error(e)
+
+MAX_BATCH_SIZE = 100
+
+def batch_item(user_id, data):
+    """(order id, currency, matcher item) for one entry of a batch request; ValueError if invalid."""
+    if not isinstance(data, dict):
+        raise ValueError('Each entry must be an object')
+    if 'cancel' in data:
+        try:
+            order_id = int(data['cancel'])
+        except (TypeError, ValueError):
+            raise ValueError('cancel must be an order id')
+        currency = order_currency(order_id, user_id)
+        if currency is None:
+            raise ValueError('Order not found')
+        if 'client_order_id' in data:
+            raise ValueError('client_order_id is only taken by new orders')
+        return order_id, currency, {"command": 'cancel', "ids": [order_id]}
+    currency, item = order_item(user_id, data)
+    client_order_id = client_order_id_of(data)
+    if client_order_id is not None:
+        item["client_order_id"] = client_order_id
+    return item["id"], currency, item
+
+@app.route('/api/orderbook/batch', methods=['POST'])
+@jwt_required()
+def create_batch():
+    """Queue up to MAX_BATCH_SIZE new orders and {"cancel": <order_id>} entries at once.
+
+    Nothing is queued unless every entry is valid. Each currency's entries
+    run in request order on its matcher and are committed together; the
+    response has one result per entry, in request order. New orders may
+    carry a "client_order_id" as in create_order, so a timed out batch can
+    be sent again: orders already submitted under their id are answered
+    with their first outcome, marked "duplicate", instead of being queued.
+    """
+    try:
+        user_id = get_jwt_identity()
+        entries = request.get_json().get('orders')
+        if not isinstance(entries, list) or not entries:
+            return jsonify({"error": "orders must be a non-empty list"}), 400
+        if len(entries) > MAX_BATCH_SIZE:
+            return jsonify({"error": "At most %d orders per batch" % MAX_BATCH_SIZE}), 400
+
+        items, errors, client_order_ids = [], [], []
+        for index, entry in enumerate(entries):
+            try:
+                order_id, currency, item = batch_item(user_id, entry)
+                client_order_id = item.get("client_order_id")
+                if client_order_id is not None:
+                    if client_order_id in client_order_ids:
+                        raise ValueError(DUPLICATE_CLIENT_ORDER + ' within the batch')
+                    client_order_ids.append(client_order_id)
+                items.append((order_id, currency, item))
+            except ValueError as e:
+                errors.append({"index": index, "error": str(e)})
+        if errors:
+            return jsonify({"errors": errors}), 400
+
+        # past the index's TTL a retried order is only known by its row
+        rows = {}
+        if client_order_ids:
+            rows = {row.client_order_id: row for row in db.session.query(
+                Order.client_order_id, Order.id, Order.status).filter(
+                Order.user_id == user_id, Order.client_order_id.in_(client_order_ids))}
+
+        tickets = []
+        def submit(new_ids):
+            """Queue the entries that are not retries; the new ids' tickets."""
+            groups = {}
+            for index, (order_id, currency, item) in enumerate(items):
+                if item.get("client_order_id") is None or item["client_order_id"] in new_ids:
+                    groups.setdefault(currency, []).append(index)
+            kept = {}
+            for currency, indexes in groups.items():
+                ticket = submit_command(currency, user_id, {
+                    "command": 'batch',
+                    "items": [items[index][2] for index in indexes]
+                })
+                tickets.append((ticket, indexes))
+                for position, index in enumerate(indexes):
+                    if items[index][2].get("client_order_id") is not None:
+                        kept[items[index][2]["client_order_id"]] = BatchEntryTicket(ticket, position, items[index][0])
+            return kept
+
+        try:
+            if client_order_ids:
+                claimed = client_orders.claim_all(
+                    user_id, [client_order_id for client_order_id in client_order_ids if client_order_id not in rows],
+                    submit)
+            else:
+                submit(())
+        except queue.Full:
+            return queue_full()
+        db.session.close()
+
+        results = [order_status_json(order_id, 'queued') for order_id, currency, item in items]
+        deadline = time.monotonic() + MAX_ORDER_WAIT
+        finished = True
+        for ticket, indexes in tickets:
+            if not ticket.wait(max(0, deadline - time.monotonic())):
+                finished = False
+                continue
+            outcomes = ticket.result or [(ticket.status, ticket.error)] * len(indexes)
+            for index, (status, error) in zip(indexes, outcomes):
+                results[index] = order_status_json(items[index][0], status, error)
+        for index, (order_id, currency, item) in enumerate(items):
+            client_order_id = item.get("client_order_id")
+            if client_order_id is None:
+                continue
+            fields = {"client_order_id": client_order_id}
+            if client_order_id in rows:
+                row = rows[client_order_id]
+                results[index] = dict(order_status_json(row.id, row.status), duplicate=True, **fields)
+                continue
+            ticket, created = claimed[client_order_id]
+            if not created:
+                if not ticket.wait(max(0, deadline - time.monotonic())):
+                    finished = False
+                results[index] = dict(order_status_json(ticket.order_id, ticket.status, ticket.error),
+                                      duplicate=True, **fields)
+            else:
+                results[index].update(fields)
+        return jsonify({"results": results}), 200 if finished else 202
 
-        db.session.add(new_order)
+    except Exception as e:
+        db.session.rollback()
+        return internal_error(e)
+
+def unknown_pair():
+    return jsonify({"error": "Unknown trading pair"}), 404
+
+DEFAULT_DEPTH = 20
+MAX_DEPTH = 100
+BOOT_ID = '%x' % int(time.time())
+depth_snapshots = {}
+
+def resident_book(currency):
+    """`currency`'s book, or its depth mirror, as this process should serve it.
+
+    With matching processes the mirror is loaded from the currency's
+    matcher on first use and after a resync, and follows its level updates
+    in between. Raises queue.Full if the matcher cannot answer in time.
+    """
+    if not isinstance(ingest, ShardedIngest):
+        return engine.peek(currency)
+    mirror = depth_mirror(currency)
+    if mirror.loaded():
+        return mirror
+    with mirror.loading:
+        if not mirror.loaded():
+            with engine.lock(currency):
+                generation = mirror.begin_load()
+            ticket = submit_command(currency, None, {"command": 'depth'})
+            if not ticket.wait(MAX_ORDER_WAIT) or ticket.status != 'completed':
+                raise queue.Full
+            with engine.lock(currency):
+                mirror.load(generation, *ticket.result)
+    return mirror
+
+def book_depth(book, depth):
+    currency = book.currency
+    return {
+        "buy_orders": [{
+            "price": price_from_units(price),
+            "amount": from_units(amount, currency),
+            "total": notional(price, amount, currency),
+            "orders": count
+        } for price, amount, count in book.bids.depth(depth)],
+        "sell_orders": [{
+            "price": price_from_units(price),
+            "amount": from_units(amount, currency),
+            "total": notional(price, amount, currency),
+            "orders": count
+        } for price, amount, count in book.asks.depth(depth)]
+    }
+
+def depth_snapshot(currency, depth):
+    """Serialized depth view of a book, rebuilt only when the book's version moves."""
+    book = resident_book(currency)
+    version = book.version
+    key = (currency, depth)
+    snapshot = depth_snapshots.get(key)
+    if snapshot is None or snapshot[0] != version:
+        with engine.lock(currency):
+            version = book.version
+            orderbook = book_depth(book, depth)
+        etag = '%s-%s-%d-%d' % (BOOT_ID, currency, version, depth)
+        snapshot = depth_snapshots[key] = (version, etag, json.dumps(orderbook))
+    return snapshot
 
-        points = int(10 * amount)
-        user_points = UserPoints.query.filter_by(user_id=user_id).first()
-        if user_points:
-            user_points.points += points
-            user_points.total_trades += 1
+@app.route('/api/orderbook/<currency>', methods=['GET'])
+def get_orderbook(currency):
+    try:
+        if pairs.get(currency) is None:
+            return unknown_pair()
+        depth = request.args.get('depth', DEFAULT_DEPTH, type=int)
+        if not 0 < depth <= MAX_DEPTH:
+            return jsonify({"error": "depth must be between 1 and %d" % MAX_DEPTH}), 400
+
+        try:
+            version, etag, body = depth_snapshot(currency, depth)
+        except queue.Full:
+            return queue_full()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
         else:
-            user_points = UserPoints(user_id=user_id, points=points, total_trades=1)
-            db.session.add(user_points)
+            response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
-        db.session.commit()
+    except Exception as e:
+        return internal_error(e)
+
+STREAM_KEEPALIVE = 15
+
+def server_sent_event(type, data, id=None):
+    lines = [] if id is None else ['id: %d' % id]
+    lines += ['event: %s' % type, 'data: %s' % json.dumps(data), '', '']
+    return '\n'.join(lines)
+
+@app.route('/api/stream/<currency>', methods=['GET'])
+def stream_market_data(currency):
+    """Server-Sent Events: a book snapshot, then sequence-numbered level diffs and trades."""
+    if pairs.get(currency) is None:
+        return unknown_pair()
+    depth = request.args.get('depth', MAX_DEPTH, type=int)
+    if not 0 < depth <= MAX_DEPTH:
+        return jsonify({"error": "depth must be between 1 and %d" % MAX_DEPTH}), 400
+    subscriber = feed.subscribe(currency)
+
+    def events():
+        try:
+            lagging, pending = True, []
+            while True:
+                if lagging:
+                    book = resident_book(currency)
+                    with engine.lock(currency):
+                        snapshot = book_depth(book, depth)
+                        seq = snapshot["seq"] = feed.seq.get(currency, 0)
+                    yield server_sent_event('snapshot', snapshot, seq)
+                    pending = [event for event in pending if event["seq"] > seq]
+                for event in pending:
+                    yield server_sent_event(event["type"], event, event["seq"])
+                if not pending and not lagging:
+                    yield ': keepalive\n\n'
+                lagging, pending = subscriber.get(timeout=STREAM_KEEPALIVE)
+        finally:
+            feed.unsubscribe(subscriber)
+
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+DEFAULT_CANDLES = 500
+candle_loads = {}
+
+def resident_candles(currency):
+    """Bring `currency`'s candles up to date before serving them.
+
+    With matching processes the local store only reads: candles from the
+    newest one held onwards are read back once the shard finished more work.
+    """
+    if isinstance(ingest, ShardedIngest):
+        completed = ingest.completed.get(currency, 0)
+        if candle_loads.get(currency) != completed:
+            with app.app_context():
+                for seconds in INTERVALS.values():
+                    since = candles.latest(currency, seconds)
+                    if since is None:
+                        rows = stored_candles(currency, seconds, limit=candles.capacity)
+                    else:
+                        rows = stored_candles(currency, seconds, since=since)
+                    candles.refresh(currency, seconds, rows)
+            candle_loads[currency] = completed
+
+def candle_json(start, open, high, low, close, volume, currency):
+    return {
+        "time": start,
+        "date": datetime.utcfromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"),
+        "open": price_from_units(open),
+        "high": price_from_units(high),
+        "low": price_from_units(low),
+        "close": price_from_units(close),
+        "volume": from_units(volume, currency)
+    }
+
+@app.route('/api/candles/<currency>', methods=['GET'])
+def get_candles(currency):
+    """OHLCV candles, oldest first; ?interval=1m|5m|1h|1d, ?limit= newest ones, ?since=<time>."""
+    interval = request.args.get('interval', '1m')
+    if interval not in INTERVALS:
+        return jsonify({"error": "interval must be one of %s" % ', '.join(INTERVALS)}), 400
+    limit = request.args.get('limit', DEFAULT_CANDLES, type=int)
+    if not 0 < limit <= candles.capacity:
+        return jsonify({"error": "limit must be between 1 and %d" % candles.capacity}), 400
+    since = request.args.get('since', type=int)
 
-        if match_orders(new_order):
-            return jsonify({
-                "message": "Order created and matched successfully",
-                "order_id": new_order.id,
-                "status": new_order.status
-            }), 201
-        else:
-            return jsonify({"error": "Error matching orders"}), 500
+    try:
+        resident_candles(currency)
+        rows = candles.candles(currency, INTERVALS[interval], limit, since)
+        return jsonify([candle_json(*row, currency) for row in rows]), 200
 
     except Exception as e:
-        db.session.rollback()
-        return jsonify({"error": "Internal server error"}), 500
+        return internal_error(e)
 
-@app.route('/api/orderbook/<currency>', methods=['GET'])
-def get_orderbook(currency):
+@app.route('/api/ticker', methods=['GET'])
+def get_ticker():
+    """Rolling 24h ticker of every traded currency, or only ?currency=."""
     try:
-        buy_orders = Order.query.filter_by(
-            currency=currency,
-            type='buy',
-            status='active'
-        ).order_by(Order.price.desc()).all()
-
-        sell_orders = Order.query.filter_by(
-            currency=currency,
-            type='sell',
-            status='active'
-        ).order_by(Order.price.asc()).all()
-
-        orderbook = {
-            "buy_orders": [{
-                "price": order.price,
-                "amount": order.amount,
-                "total": order.price * order.amount
-            } for order in buy_orders],
-            "sell_orders": [{
-                "price": order.price,
-                "amount": order.amount,
-                "total": order.price * order.amount
-            } for order in sell_orders]
-        }
-
-        return jsonify(orderbook), 200
+        if request.args.get('currency'):
+            currencies = [request.args['currency']]
+        else:
+            currencies = set(candles.currencies())
+            if isinstance(ingest, ShardedIngest):
+                currencies |= set(ingest.completed)
+        now = wall_clock()
+        result = []
+        for currency in sorted(currencies):
+            resident_candles(currency)
+            ticker = candles.ticker(currency, now)
+            if ticker is None:
+                continue
+            result.append({
+                "currency": currency,
+                "last": price_from_units(ticker["last"]),
+                "high": price_from_units(ticker["high"]) if ticker["high"] is not None else None,
+                "low": price_from_units(ticker["low"]) if ticker["low"] is not None else None,
+                "volume": from_units(ticker["volume"], currency),
+                "change": price_from_units(ticker["change"]),
+                "changePercent": 100.0 * ticker["change"] / ticker["open"] if ticker["open"] else 0.0
+            })
+        return jsonify(result), 200
 
     except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+        return internal_error(e)
 
 @app.route('/api/leaderboard', methods=['GET'])
 def get_leaderboard():
     try:
-        leaderboard = db.session.query(
+        leaderboard = ranking.top(100)
+        users = {user.id: user for user in db.session.query(
             User.id,
             User.email.label('name'),  # Using email as name since we don't have name field
-            UserPoints.points,
-            UserPoints.total_trades,
-            db.func.rank().over(
-                order_by=UserPoints.points.desc()
-            ).label('rank')
+            UserPoints.total_trades
         ).outerjoin(
             UserPoints, User.id == UserPoints.user_id
-        ).order_by(
-            UserPoints.points.desc().nullslast()
-        ).limit(100).all()
+        ).filter(
+            User.id.in_([user_id for user_id, points, rank in leaderboard])
+        )}
 
         result = [{
-            'id': user.id,
-            'name': user.name,
-            'points': user.points or 0,
-            'totalTrades': user.total_trades or 0,
-            'rank': user.rank
-        } for user in leaderboard]
+            'id': user_id,
+            'name': users[user_id].name,
+            'points': points,
+            'totalTrades': users[user_id].total_trades or 0,
+            'rank': rank
+        } for user_id, points, rank in leaderboard]
 
         return jsonify(result), 200
 
     except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+        return internal_error(e)
 
 @app.route('/api/user/profile', methods=['GET'])
 @jwt_required()
 def get_user_profile():
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        user_points = UserPoints.query.get(user_id)
+        context = user_contexts.get(user_id)
+        if context is None:
+            return user_not_found()
         
-        week_ago = datetime.utcnow() - timedelta(days=7)
+        week_ago = (datetime.utcnow() - timedelta(days=7)).strftime('%Y-%m-%d')
+        recent_transactions = sum(trades for day, trades in context["trade_days"].items() if day >= week_ago)
         
-        transactions = Transaction.query.filter_by(user_id=user_id).all()
-        recent_transactions = Transaction.query.filter(
-            Transaction.user_id == user_id,
-            Transaction.date >= week_ago.strftime('%Y-%m-%d')
-        ).count()
-        
-        total_buy_volume = sum(t.price * t.amount for t in transactions if t.type == 'buy')
-        total_sell_volume = sum(t.price * t.amount for t in transactions if t.type == 'sell')
+        total_buy_volume = price_from_units(context["buy_volume"])
+        total_sell_volume = price_from_units(context["sell_volume"])
 
         return jsonify({
-            "email": user.email,
-            "points": user_points.points if user_points else 0,
-            "totalTrades": user_points.total_trades if user_points else 0,
+            "email": context["email"],
+            "points": context["points"],
+            "totalTrades": context["total_trades"],
             "rank": get_user_rank(user_id),
             "transactions": {
                 "totalBuyVolume": total_buy_volume,
@@ -490,20 +2269,88 @@ def get_user_profile():
         }), 200
 
     except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+        return internal_error(e)
 
 def get_user_rank(user_id):
-    try:
-        result = db.session.query(
-            db.func.rank().over(
-                order_by=UserPoints.points.desc()
-            ).label('rank')
-        ).filter(
-            UserPoints.user_id == user_id
-        ).first()
-        return result[0] if result else 0
-    except Exception:
-        return 0
+    return ranking.rank(user_id)
+
+@app.cli.command('backfill-stats')
+def backfill_stats():
+    """Rebuild user_stats and user_trade_days from the transactions table.
+
+    Run it with the server stopped: trades settled during the backfill
+    would otherwise be counted twice.
+    """
+    totals, days = {}, {}
+    rows = db.session.query(
+        Transaction.user_id, Transaction.currency, Transaction.amount,
+        Transaction.price, Transaction.type, Transaction.date
+    ).execution_options(yield_per=10000)
+    for row in rows:
+        add_trade_stats(totals, days, row._mapping)
+
+    db.session.execute(db.delete(UserStats))
+    db.session.execute(db.delete(UserTradeDay))
+    if totals:
+        db.session.execute(db.insert(UserStats), [{
+            "user_id": user_id,
+            "buy_volume": buy_volume,
+            "sell_volume": sell_volume,
+            "buy_trades": buy_trades,
+            "sell_trades": sell_trades
+        } for user_id, (buy_volume, sell_volume, buy_trades, sell_trades) in totals.items()])
+    if days:
+        db.session.execute(db.insert(UserTradeDay), [
+            {"user_id": user_id, "day": day, "trades": trades}
+            for (user_id, day), trades in days.items()
+        ])
+    db.session.commit()
+    print('Backfilled stats for %d users from %d transactions' % (
+        len(totals), sum(stats[2] + stats[3] for stats in totals.values())))
+
+@app.cli.command('backfill-candles')
+def backfill_candles():
+    """Rebuild the candles table from the transactions table.
+
+    One grouped pass over the transactions yields the 1m candles, and the
+    longer intervals are rolled up from those. Every trade is stored as a
+    buy and a sell row, so summed volumes are halved. Run it with the
+    server stopped, as with backfill-stats.
+    """
+    minute = db.func.substr(Transaction.date, 1, 16)
+    grouped = db.session.query(
+        Transaction.currency,
+        minute.label('minute'),
+        db.func.min(Transaction.id).label('first_id'),
+        db.func.max(Transaction.id).label('last_id'),
+        db.func.max(Transaction.price).label('high'),
+        db.func.min(Transaction.price).label('low'),
+        db.func.sum(Transaction.amount).label('volume')
+    ).group_by(Transaction.currency, minute).subquery()
+    opening, closing = db.aliased(Transaction), db.aliased(Transaction)
+    rows = db.session.query(
+        grouped.c.currency, grouped.c.minute, opening.price, grouped.c.high,
+        grouped.c.low, closing.price, grouped.c.volume
+    ).join(opening, opening.id == grouped.c.first_id).join(closing, closing.id == grouped.c.last_id) \
+        .order_by(grouped.c.currency, grouped.c.minute).all()
+
+    db.session.execute(db.delete(Candle))
+    stored = 0
+    for currency, group in itertools.groupby(rows, key=lambda row: row[0]):
+        minutes = [(wall_clock(datetime.strptime(row[1], '%Y-%m-%d %H:%M')),
+                    row[2], row[3], row[4], row[5], row[6] // 2) for row in group]
+        chunk = []
+        for seconds, (start, open, high, low, close, volume) in rollup(minutes):
+            chunk.append({"currency": currency, "interval": seconds, "start": start, "open": open,
+                          "high": high, "low": low, "close": close, "volume": volume})
+            if len(chunk) >= 10000:
+                db.session.execute(db.insert(Candle), chunk)
+                stored, chunk = stored + len(chunk), []
+        if chunk:
+            db.session.execute(db.insert(Candle), chunk)
+            stored += len(chunk)
+    db.session.commit()
+    print('Backfilled %d candles from %d minutes of trades' % (stored, len(rows)))
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
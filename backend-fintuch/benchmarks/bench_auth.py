@@ -0,0 +1,173 @@
+"""Login throughput, and order latency while a login storm runs.
+
+Seeds users with real bcrypt hashes, some made with a lower work factor
+than configured, then has `--clients` threads log in (a quarter of the
+attempts repeat a wrong password) while one trader keeps placing orders
+with ?wait. Runs once per `--processes` setting of the password pool (0
+hashes on threads), after a quiet run that measures order latency alone.
+Exits non-zero if a right password is refused, a wrong one accepted, or a
+low-cost hash is not upgraded by its user's login.
+
+    python benchmarks/bench_auth.py --rounds 12 --processes 0 1 2 --logins 400
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+db = app.db
+
+PASSWORD = 'correct horse'
+WRONG = 'battery staple'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def seed_passwords(user_ids, rounds, legacy):
+    """Give every user PASSWORD, hashed with `rounds`, or `rounds - 2` for the first `legacy` users."""
+    current = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds)).decode()
+    cheaper = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(max(4, rounds - 2))).decode()
+    db.session.execute(db.update(app.User), [
+        {"id": user_id, "password": cheaper if i < legacy else current}
+        for i, user_id in enumerate(user_ids)])
+    db.session.commit()
+
+
+def trade(user_id, stop, orders):
+    """Place crossing orders with ?wait until `stop` is set; latency per order."""
+    from money import from_units, price_from_units
+    client = app.app.test_client()
+    with app.app.app_context():
+        headers = {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+    latencies = []
+    for order in orders:
+        if stop.is_set():
+            break
+        body = {"currency": order["currency"], "amount": from_units(order["amount"], order["currency"]),
+                "price": price_from_units(order["price"]), "type": order["type"]}
+        started = time.perf_counter()
+        client.post('/api/orderbook/create?wait=30', json=body, headers=headers)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def log_in(users, attempts, seed):
+    """({outcome: count}, ids logged in) for `attempts` logins; 503s are retried."""
+    client = app.app.test_client()
+    rng = random.Random(seed)
+    outcomes, logged_in = {}, set()
+    for _ in range(attempts):
+        user = rng.randint(1, users)
+        right = rng.random() < 0.75
+        if not right:
+            # a few users get the same wrong password over and over
+            user = rng.randint(1, 10)
+        body = {"email": 'bench%d@example.com' % user, "password": PASSWORD if right else WRONG}
+        while True:
+            response = client.post('/api/auth/login', json=body)
+            if response.status_code != 503:
+                break
+            time.sleep(0.05)
+        outcome = '%s %d' % ('right' if right else 'wrong', response.status_code)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        if right and response.status_code == 200:
+            logged_in.add(user)
+    return outcomes, logged_in
+
+
+def run(args, processes):
+    """(logins/s, order latencies, outcomes, logins answered from the failure cache,
+    upgradable hashes left un-upgraded after their user logged in)."""
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.users, {"BTC": 1e6})
+        seed_passwords(user_ids, args.rounds, args.legacy)
+        seed_book(app, 'BTC', 1000, user_ids)
+        load_books(app)
+    app.passwords.close()
+    app.passwords = app.PasswordHasher(args.rounds, processes)
+
+    stop = threading.Event()
+    orders = list(taker_stream('BTC', 100000, user_ids[:1]))
+    with ThreadPoolExecutor(max_workers=args.clients + 1) as pool:
+        trader = pool.submit(trade, user_ids[0], stop, orders)
+        with Timer() as timer:
+            storms = [pool.submit(log_in, args.users, args.logins // args.clients, i)
+                      for i in range(args.clients)]
+            results = [storm.result() for storm in storms]
+        stop.set()
+        latencies = trader.result()
+
+    outcomes, logged_in = {}, set()
+    for result, users in results:
+        logged_in |= users
+        for outcome, count in result.items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + count
+    with app.app.app_context():
+        hashes = [password for (password,) in db.session.query(app.User.password).filter(
+            app.User.id <= args.legacy, app.User.id.in_(logged_in))]
+    stale = sum(app.passwords.needs_rehash(hashed) for hashed in hashes)
+    logins = sum(outcomes.values())
+    return logins / timer.elapsed, latencies, outcomes, app.passwords.cache_hits, stale
+
+
+def quiet(args):
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, 1, {"BTC": 1e6})
+        seed_book(app, 'BTC', 1000, user_ids)
+        load_books(app)
+    stop = threading.Event()
+    timer = threading.Timer(args.quiet, stop.set)
+    timer.start()
+    latencies = trade(user_ids[0], stop, taker_stream('BTC', 100000, user_ids))
+    timer.join()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=10, help='bcrypt work factor')
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 1, 2],
+                        help='password pool sizes; 0 hashes on threads')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent login clients')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--legacy', type=int, default=50, help='users whose hash needs upgrading')
+    parser.add_argument('--quiet', type=float, default=5.0, help='seconds of trading without logins')
+    args = parser.parse_args()
+
+    latencies = quiet(args)
+    print('bcrypt work factor %d, %d logins from %d clients' % (args.rounds, args.logins, args.clients))
+    print('%-10s %10s %14s %14s %8s' % ('pool', 'logins/s', 'order p50 ms', 'order p99 ms', 'cached'))
+    print('%-10s %10s %14.1f %14.1f %8s' % ('no logins', '-', 1000 * percentile(latencies, 0.5),
+                                            1000 * percentile(latencies, 0.99), '-'))
+    failures = 0
+    for processes in args.processes:
+        per_second, latencies, outcomes, cached, stale = run(args, processes)
+        print('%-10s %10.1f %14.1f %14.1f %8s' % (
+            '%d procs' % processes if processes else 'threads', per_second,
+            1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99),
+            '%d/%d' % (cached, outcomes.get('wrong 401', 0))))
+        problems = {outcome: count for outcome, count in outcomes.items()
+                    if outcome not in ('right 200', 'wrong 401')}
+        for outcome, count in sorted(problems.items()):
+            print('   FAIL %d logins with the %s password answered %s' % (count, *outcome.split()))
+        if stale:
+            print('   FAIL %d low-cost hashes were not upgraded' % stale)
+        failures += len(problems) + bool(stale)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Orders/sec through POST /api/orderbook/batch vs one create request per order.
+
+One client quotes the market maker's five currencies through the API,
+waiting for every order to be matched: one ?wait request per order on
+the single-order endpoint, then batches of each `--sizes`. Exits non-zero
+if any order is rejected or left queued.
+
+    python benchmarks/bench_batch.py --orders 1000 --sizes 1 10 100
+"""
+import argparse
+import sys
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+
+CURRENCIES = ['BTC', 'ETH', 'USDT', 'BNB', 'ADA']
+
+
+def request_orders(count, user_ids):
+    """`count` crossing orders as API request bodies, cycling through the currencies."""
+    from money import from_units, price_from_units
+    streams = [taker_stream(currency, count // len(CURRENCIES) + 1, user_ids, seed=i)
+               for i, currency in enumerate(CURRENCIES)]
+    orders = []
+    while len(orders) < count:
+        for stream in streams:
+            order = next(stream)
+            orders.append({
+                "currency": order["currency"],
+                "amount": from_units(order["amount"], order["currency"]),
+                "price": price_from_units(order["price"]),
+                "type": order["type"]
+            })
+    return orders[:count]
+
+
+def run(args, size):
+    """(orders/sec, statuses) with `size` orders per batch request, or per create request if None."""
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, 1, {currency: 1e9 for currency in CURRENCIES})
+        for currency in CURRENCIES:
+            seed_book(app, currency, args.resting, user_ids)
+        load_books(app)
+        headers = {'Authorization': 'Bearer ' + app.create_access_token(identity=user_ids[0])}
+    client = app.app.test_client()
+    orders = request_orders(args.orders, user_ids)
+
+    statuses = []
+    with Timer() as timer:
+        if size is None:
+            for order in orders:
+                response = client.post('/api/orderbook/create?wait=30', json=order, headers=headers)
+                statuses.append(response.get_json()["status"])
+        else:
+            for start in range(0, len(orders), size):
+                response = client.post('/api/orderbook/batch', json={"orders": orders[start:start + size]},
+                                       headers=headers)
+                statuses += [result["status"] for result in response.get_json()["results"]]
+    return len(orders) / timer.elapsed, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--resting', type=int, default=1000, help='resting orders per currency')
+    args = parser.parse_args()
+
+    print('%d orders over %s' % (args.orders, ', '.join(CURRENCIES)))
+    print('%-16s %12s %8s' % ('endpoint', 'orders/s', 'speedup'))
+    baseline, failures = None, 0
+    for size in [None] + args.sizes:
+        per_second, statuses = run(args, size)
+        baseline = baseline or per_second
+        print('%-16s %12.1f %7.1fx' % ('create' if size is None else 'batch of %d' % size,
+                                       per_second, per_second / baseline))
+        failed = sum(status not in ('active', 'filled') for status in statuses)
+        if failed:
+            print('   FAIL %d orders were rejected or left queued' % failed)
+            failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Memory per resting order and matching speed: array-backed book vs ORM rows.
+
+Builds the same seeded book of `--orders` resting orders twice: as the
+resident OrderBook, and as Order model instances kept in per-price queues
+(what the book held before it had its own representation). Reports the
+memory each holds per order, as traced by tracemalloc, then replays
+`--takers` crossing orders through both. Exits non-zero if the fills or
+the books left behind differ, or if the array book needs more than
+`--max-bytes` per order.
+
+    python benchmarks/bench_book_memory.py --orders 1000000 --takers 20000
+"""
+import argparse
+import gc
+import random
+import sys
+import tracemalloc
+from bisect import insort
+from collections import deque
+from datetime import datetime, timedelta
+
+from common import Timer, load_app
+
+app = load_app()
+
+from orderbook import BookOrder, OrderBook  # noqa: E402
+
+CURRENCY = 'BTC'
+MID = 10000000000
+START = datetime(2024, 1, 1)
+
+
+class ORMBook:
+    """Order rows in a FIFO per price, with an id index beside them."""
+
+    def __init__(self):
+        self.levels = {'buy': {}, 'sell': {}}
+        # best price last, as in OrderBook
+        self.keys = {'buy': [], 'sell': []}
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, order):
+        levels = self.levels[order.type]
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = deque()
+            insort(self.keys[order.type], order.price if order.type == 'buy' else -order.price)
+        level.append(order)
+        self.index[order.id] = order
+
+    def match(self, taker):
+        side = 'sell' if taker.type == 'buy' else 'buy'
+        levels, keys = self.levels[side], self.keys[side]
+        fills = []
+        while taker.amount > 0 and keys:
+            price = keys[-1] if side == 'buy' else -keys[-1]
+            if price > taker.price if side == 'sell' else price < taker.price:
+                break
+            level = levels[price]
+            while level and taker.amount > 0:
+                maker = level[0]
+                amount = min(taker.amount, maker.amount)
+                maker.amount -= amount
+                taker.amount -= amount
+                fills.append((maker.id, amount, price))
+                if maker.amount <= 0:
+                    level.popleft()
+                    del self.index[maker.id]
+            if not level:
+                del levels[price]
+                keys.pop()
+        return fills
+
+    def resting(self):
+        return sorted((order.id, order.type, order.price, order.amount) for order in self.index.values())
+
+
+def resting_orders(count, seed):
+    """(id, user id, type, price, amount, created_at) of a non-crossing book around MID."""
+    rng = random.Random(seed)
+    for i in range(1, count + 1):
+        order_type = 'buy' if i % 2 else 'sell'
+        offset = rng.randint(1, 2000) * 1000000
+        yield (i, rng.randint(1, 1000), order_type, MID - offset if order_type == 'buy' else MID + offset,
+               rng.randint(1, 200) * 1000000, START + timedelta(microseconds=i))
+
+
+def takers(count, first_id, seed):
+    rng = random.Random(seed)
+    for i in range(count):
+        order_type = rng.choice(['buy', 'sell'])
+        offset = rng.randint(0, 500) * 1000000
+        yield (first_id + i, rng.randint(1, 1000), order_type, MID + offset if order_type == 'buy' else MID - offset,
+               rng.randint(1, 400) * 1000000, START)
+
+
+def build_array(rows):
+    book = OrderBook(CURRENCY)
+    for id, user_id, order_type, price, amount, created_at in rows:
+        book.add(BookOrder(id, user_id, CURRENCY, order_type, price, amount, created_at))
+    return book
+
+
+def build_orm(rows):
+    book = ORMBook()
+    for id, user_id, order_type, price, amount, created_at in rows:
+        book.add(app.Order(id=id, user_id=user_id, currency=CURRENCY, type=order_type, price=price,
+                           amount=amount, status='active', created_at=created_at))
+    return book
+
+
+def traced(build, rows):
+    """The book `build` makes and the bytes it still holds afterwards."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    book = build(rows)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return book, held
+
+
+def replay_array(book, rows):
+    fills = []
+    for id, user_id, order_type, price, amount, created_at in rows:
+        taker = BookOrder(id, user_id, CURRENCY, order_type, price, amount, created_at)
+        fills += [(fill.maker.id, fill.amount, fill.price) for fill in book.match(taker)]
+        if taker.amount > 0:
+            book.add(taker)
+    return fills
+
+
+def replay_orm(book, rows):
+    fills = []
+    for id, user_id, order_type, price, amount, created_at in rows:
+        taker = app.Order(id=id, user_id=user_id, currency=CURRENCY, type=order_type, price=price,
+                          amount=amount, status='active', created_at=created_at)
+        fills += book.match(taker)
+        if taker.amount > 0:
+            book.add(taker)
+    return fills
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=200000, help='resting orders')
+    parser.add_argument('--takers', type=int, default=20000, help='crossing orders replayed')
+    parser.add_argument('--max-bytes', type=int, default=100, help='budget per order for the array book')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rows = lambda: resting_orders(args.orders, args.seed)  # noqa: E731
+    stream = list(takers(args.takers, args.orders + 1, args.seed + 1))
+    print('%d resting orders, %d takers' % (args.orders, args.takers))
+    print('%-8s %10s %10s %10s %12s' % ('book', 'MB', 'bytes/ord', 'build s', 'takers/s'))
+
+    results = {}
+    for name, build, replay in (('array', build_array, replay_array), ('orm', build_orm, replay_orm)):
+        book, held = traced(build, rows())
+        del book
+        gc.collect()
+        with Timer() as built:
+            book = build(rows())
+        with Timer() as matched:
+            fills = replay(book, stream)
+        if name == 'array':
+            left = sorted((order.id, order.type, order.price, order.amount) for order in book.resting())
+        else:
+            left = book.resting()
+        results[name] = (held, fills, left)
+        print('%-8s %10.1f %10.1f %10.2f %12.1f' % (name, held / 1e6, held / args.orders, built.elapsed,
+                                                   len(stream) / matched.elapsed))
+        del book
+        gc.collect()
+
+    failures = []
+    if results['array'][1] != results['orm'][1]:
+        failures.append('fills differ')
+    if results['array'][2] != results['orm'][2]:
+        failures.append('resting orders differ')
+    if results['array'][0] > args.max_bytes * args.orders:
+        failures.append('array book holds %.1f bytes per order, budget %d'
+                        % (results['array'][0] / args.orders, args.max_bytes))
+    print('%d fills, %.1fx less memory' % (len(results['array'][1]), results['orm'][0] / results['array'][0]))
+    for failure in failures:
+        print('FAIL %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
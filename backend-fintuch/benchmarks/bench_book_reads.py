@@ -0,0 +1,124 @@
+"""Order book reads/sec while orders match, on threads and on matching processes.
+
+A writer sends crossing orders and cancels resting ones while a reader
+keeps fetching /api/orderbook/<currency>. On threads the API serves the
+matcher's own book; with matching processes it serves a depth mirror kept
+from the levels the matcher publishes. Exits non-zero if, once the writer
+is done, the served depth differs from the book rebuilt from the orders
+table, also after the mirror is made to reload as it is on a resync.
+
+    python benchmarks/bench_book_reads.py --processes 0 1 --resting 20000
+"""
+import argparse
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+
+CURRENCY = 'BTC'
+
+
+def setup(args):
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.users, {CURRENCY: 1e6})
+        seed_book(app, CURRENCY, args.resting, user_ids)
+        load_books(app)
+        resting = [(order.id, order.user_id) for order in app.active_orders(CURRENCY)]
+        orders = list(taker_stream(CURRENCY, args.orders, user_ids, seed=args.seed))
+    return orders, resting
+
+
+def submit(ingest, currency, key, user_id, item):
+    while True:
+        try:
+            return app.submit_order(currency, key, user_id, item)
+        except queue.Full:
+            time.sleep(0.001)
+
+
+def write(ingest, orders, resting, args, tickets):
+    rng = random.Random(args.seed)
+    for order in orders:
+        order_id = next(app.order_ids)
+        tickets.append(submit(ingest, CURRENCY, order_id, order["user_id"],
+                              dict(order, command='order', id=order_id, points=1)))
+        if rng.random() < args.cancels:
+            order_id, user_id = resting.pop(rng.randrange(len(resting)))
+            key = 'cancel-%d' % next(app.command_ids)
+            tickets.append(submit(ingest, CURRENCY, key, user_id,
+                                  {"command": 'cancel', "user_id": user_id, "ids": [order_id]}))
+    for ticket in tickets:
+        ticket.wait(60)
+    # buyers' USD is settled by transfers the BTC matcher sends after the orders
+    ingest.join()
+
+
+def expected_depth():
+    """The depth view of the book rebuilt from the orders table."""
+    from orderbook import MatchingEngine
+    with app.app.app_context():
+        book = MatchingEngine().reload(CURRENCY, app.active_orders(CURRENCY))
+        app.db.session.close()
+    return json.loads(json.dumps(app.book_depth(book, app.MAX_DEPTH)))
+
+
+def run(args, processes):
+    orders, resting = setup(args)
+    app.ingest = ingest = app.matching_ingest(processes)
+    client = app.app.test_client()
+    url = '/api/orderbook/%s?depth=%d' % (CURRENCY, app.MAX_DEPTH)
+    tickets = []
+    writer = threading.Thread(target=write, args=(ingest, orders, resting, args, tickets))
+    reads = 0
+    with Timer() as timer:
+        writer.start()
+        while writer.is_alive():
+            assert client.get(url).status_code == 200
+            reads += 1
+        writer.join()
+
+    problems = []
+    expected = expected_depth()
+    if client.get(url).get_json() != expected:
+        problems.append('served depth differs from the orders table')
+    if processes:
+        app.resync_market_data(CURRENCY)
+        if client.get(url).get_json() != expected:
+            problems.append('depth served after a resync differs from the orders table')
+        ingest.close()
+    rejected = sum(ticket.status == 'rejected' for ticket in tickets)
+    return reads / timer.elapsed, len(tickets) / timer.elapsed, rejected, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 1],
+                        help='matching process counts; 0 matches on threads of this process')
+    parser.add_argument('--resting', type=int, default=20000)
+    parser.add_argument('--orders', type=int, default=1000, help='taker orders sent while reading')
+    parser.add_argument('--cancels', type=float, default=0.3, help='chance of a cancel after each order')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=4)
+    args = parser.parse_args()
+
+    print('%d resting %s orders, %d takers' % (args.resting, CURRENCY, args.orders))
+    print('%-10s %10s %12s %9s' % ('processes', 'reads/s', 'commands/s', 'rejected'))
+    failures = 0
+    for processes in args.processes:
+        reads, commands, rejected, problems = run(args, processes)
+        print('%-10s %10.1f %12.1f %9d' % (processes or 'threads', reads, commands, rejected))
+        for problem in problems:
+            print('   FAIL %s' % problem)
+        failures += len(problems)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
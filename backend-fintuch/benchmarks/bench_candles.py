@@ -0,0 +1,114 @@
+"""Candle backfill time, ticker latency, and live candles checked against a backfill.
+
+Seeds `--history` older trades straight into the transactions table, then
+matches `--orders` crossing orders so live candles build up as they
+settle. `flask backfill-candles` then rebuilds the table from the
+transactions; exits non-zero if the backfilled candles of the live period
+differ from the live ones. The ticker is timed from memory and as a SQL
+aggregate over the transactions, which is what it would cost without
+candles.
+
+    python benchmarks/bench_candles.py --history 1000000 --orders 2000
+"""
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+db = app.db
+
+CHUNK = 10000
+
+
+def seed_history(count, user_ids, currency='BTC', days=30):
+    """Insert `count` trades as buy/sell transaction pairs, spread over `days` ending two days ago."""
+    from money import price_to_units, to_units
+    rng = random.Random(5)
+    end = datetime.now() - timedelta(days=2)
+    moments = sorted(end - timedelta(seconds=rng.uniform(0, days * 86400)) for _ in range(count))
+    rows = []
+    for moment in moments:
+        date = moment.strftime("%Y-%m-%d %H:%M:%S")
+        price = price_to_units(round(rng.uniform(90, 110), 2))
+        amount = to_units(round(rng.uniform(0.01, 2.0), 4), currency)
+        for order_type in ('buy', 'sell'):
+            rows.append({"user_id": rng.choice(user_ids), "currency": currency, "amount": amount,
+                         "price": price, "type": order_type, "date": date})
+        if len(rows) >= CHUNK:
+            db.session.execute(db.insert(app.Transaction), rows)
+            rows = []
+    if rows:
+        db.session.execute(db.insert(app.Transaction), rows)
+    db.session.commit()
+
+
+def series(currency, since):
+    """{(interval, start): candle} from the in-memory store, for candles starting at `since` or later."""
+    found = {}
+    for seconds in app.INTERVALS.values():
+        for candle in app.candles.candles(currency, seconds, app.candles.capacity):
+            if candle[0] >= since - since % seconds:
+                found[(seconds, candle[0])] = tuple(candle)
+    return found
+
+
+def sql_ticker(currency):
+    since = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    T = app.Transaction
+    return db.session.query(db.func.max(T.price), db.func.min(T.price), db.func.sum(T.amount)).filter(
+        T.currency == currency, T.date >= since).one()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--history', type=int, default=200000, help='older trades seeded into transactions')
+    parser.add_argument('--orders', type=int, default=2000, help='crossing orders matched live')
+    parser.add_argument('--resting', type=int, default=2000)
+    parser.add_argument('--reads', type=int, default=200, help='ticker reads to time')
+    args = parser.parse_args()
+
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, 100, {"BTC": 1e9})
+        seed_history(args.history, user_ids)
+        seed_book(app, 'BTC', args.resting, user_ids)
+        load_books(app)
+
+        started = app.wall_clock()
+        for order in taker_stream('BTC', args.orders, user_ids):
+            app.place_order('BTC', dict(order, id=next(app.order_ids), points=1))
+        live = series('BTC', started)
+
+        client = app.app.test_client()
+        with Timer() as memory:
+            for _ in range(args.reads):
+                assert client.get('/api/ticker?currency=BTC').status_code == 200
+        with Timer() as scan:
+            for _ in range(args.reads):
+                sql_ticker('BTC')
+
+        transactions = db.session.query(db.func.count(app.Transaction.id)).scalar()
+        db.session.close()
+        with Timer() as backfill:
+            result = app.app.test_cli_runner().invoke(args=['backfill-candles'])
+        if result.exception is not None:
+            raise result.exception
+        app.load_candles('BTC')
+        backfilled = series('BTC', started)
+
+    print('%d transactions, %d live candles' % (transactions, len(live)))
+    print('%-32s %10.3f' % ('backfill-candles seconds', backfill.elapsed))
+    print('%-32s %10.3f' % ('ticker from candles, ms/read', 1000 * memory.elapsed / args.reads))
+    print('%-32s %10.3f' % ('ticker as SQL aggregate, ms/read', 1000 * scan.elapsed / args.reads))
+    if backfilled != live:
+        differing = sorted(set(live.items()) ^ set(backfilled.items()))
+        print('FAIL %d candles differ between live and backfill, e.g. %s' % (len(differing), differing[:2]))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""Retried order submissions with client order ids, hammered from concurrent clients.
+
+Every order gets a client_order_id and is sent several times, the copies
+shuffled across the clients so retries of one order race each other, some
+waiting for the match and some not. Reports requests/sec and how many
+retries were answered as duplicates. Then clears the in-memory index and
+retries every order once more, which must be answered from the order rows.
+With --batch N the orders go N at a time to /api/orderbook/batch and whole
+batches are retried, as a market maker resends a timed out quote round.
+With --time-in-force IOC orders that find nothing to trade are cancelled,
+and their retries must still be answered from their rows.
+
+Exits non-zero if an order was answered with more than one order id, if a
+retry was matched again (more order rows than orders) or if a retry after
+the index was cleared got a different id.
+
+    python benchmarks/bench_idempotency.py --orders 500 --retries 4 --clients 16
+    python benchmarks/bench_idempotency.py --orders 500 --retries 4 --batch 10
+    python benchmarks/bench_idempotency.py --orders 500 --retries 4 --time-in-force IOC
+"""
+import argparse
+import random
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users
+
+app = load_app()
+
+CURRENCY = 'BTC'
+
+
+def setup(args):
+    """Fresh database and book; user id -> auth headers."""
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.users, {CURRENCY: 1e6})
+        seed_book(app, CURRENCY, args.resting, user_ids)
+        load_books(app)
+        app.client_orders.clear()
+        return {user_id: {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+                for user_id in user_ids}
+
+
+def order_rows():
+    with app.app.app_context():
+        count = app.db.session.query(app.db.func.count(app.Order.id)).scalar()
+        app.db.session.close()
+        return count
+
+
+def drain():
+    for pending, worker in app.ingest.shards.values():
+        pending.join()
+
+
+def order_stream(args, user_ids):
+    """(user id, request body) for each order, crossing the book near its mid."""
+    rng = random.Random(args.seed)
+    for _ in range(args.orders):
+        order_type = rng.choice(['buy', 'sell'])
+        reach = rng.uniform(-0.2, 0.2)
+        yield rng.choice(user_ids), {
+            "currency": CURRENCY,
+            "amount": round(rng.uniform(0.1, 2.0), 4),
+            "price": round(100.0 + (reach if order_type == 'buy' else -reach), 2),
+            "type": order_type,
+            "time_in_force": args.time_in_force,
+            "client_order_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        }
+
+
+def send(client, headers, user_id, body, wait):
+    """[(client order id, status code, response)] for one create, or one batch when `body` is a list."""
+    if isinstance(body, list):
+        response = client.post('/api/orderbook/batch', json={"orders": body}, headers=headers[user_id])
+        if "results" not in response.get_json():
+            return [(order["client_order_id"], response.status_code, response.get_json()) for order in body]
+        return [(order["client_order_id"], response.status_code, result)
+                for order, result in zip(body, response.get_json()["results"])]
+    url = '/api/orderbook/create?wait=30' if wait else '/api/orderbook/create'
+    response = client.post(url, json=body, headers=headers[user_id])
+    return [(body["client_order_id"], response.status_code, response.get_json())]
+
+
+def batches(orders, size):
+    """(user id, [bodies]) with up to `size` of one user's orders each."""
+    by_user = {}
+    for user_id, body in orders:
+        by_user.setdefault(user_id, []).append(body)
+    return [(user_id, bodies[start:start + size]) for user_id, bodies in by_user.items()
+            for start in range(0, len(bodies), size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=500)
+    parser.add_argument('--retries', type=int, default=4, help='times each order is sent')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--resting', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=0, help='orders per batch request; 0 sends each on its own')
+    parser.add_argument('--time-in-force', choices=['GTC', 'IOC'], default='GTC')
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    headers = setup(args)
+    orders = list(order_stream(args, list(headers)))
+    requests = batches(orders, args.batch) if args.batch else orders
+    sends = [(user_id, body, attempt % 2 == 0) for user_id, body in requests for attempt in range(args.retries)]
+    random.Random(args.seed).shuffle(sends)
+    client = app.app.test_client()
+    rows = order_rows()
+
+    with Timer() as timer:
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            responses = [answer for answers in pool.map(lambda sent: send(client, headers, *sent), sends)
+                         for answer in answers]
+        drain()
+
+    failures = []
+    answered, statuses = {}, {}
+    for client_order_id, status_code, body in responses:
+        if status_code not in (200, 201, 202, 400) or "order_id" not in body:
+            failures.append('%s answered %d: %s' % (client_order_id, status_code, body))
+            continue
+        answered.setdefault(client_order_id, set()).add(body["order_id"])
+        statuses[status_code] = statuses.get(status_code, 0) + 1
+    duplicates = sum(bool(body.get("duplicate")) for _, _, body in responses)
+    split = sum(len(ids) > 1 for ids in answered.values())
+    if split:
+        failures.append('%d orders were answered with more than one order id' % split)
+    # every accepted order rests, trades or is cancelled with its client id, writing exactly one row
+    with app.app.app_context():
+        accepted = app.db.session.query(app.db.func.count(app.Order.id)).filter(
+            app.Order.client_order_id.isnot(None)).scalar()
+        app.db.session.close()
+    if order_rows() - rows != accepted or accepted > len(orders):
+        failures.append('%d order rows written for %d orders' % (order_rows() - rows, len(orders)))
+
+    app.client_orders.clear()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        late = [answer for answers in pool.map(lambda sent: send(client, headers, *sent, True), requests)
+                for answer in answers]
+    changed = sum(body.get("order_id") not in answered.get(client_order_id, ())
+                  for client_order_id, _, body in late)
+    if changed:
+        failures.append('%d retries after the index was cleared got a different order id' % changed)
+    if order_rows() - rows != accepted:
+        failures.append('retries after the index was cleared wrote %d order rows' % (order_rows() - rows - accepted))
+
+    print('%d %s orders%s x %d sends from %d clients' % (
+        len(orders), args.time_in_force, ' in %d batches' % len(requests) if args.batch else '',
+        args.retries, args.clients))
+    print('%10s %10s %10s %12s  %s' % ('requests/s', 'requests', 'rows', 'duplicates', 'statuses'))
+    print('%10.1f %10d %10d %12d  %s' % (len(sends) / timer.elapsed, len(sends), accepted, duplicates, statuses))
+    for failure in failures:
+        print('FAIL %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""Accepted orders/sec and acknowledge latency with 100 concurrent clients.
+
+Compares the queued path (202 as soon as the order is queued) with clients
+that wait for matching (?wait=30), which behaves like the old synchronous
+create_order.
+
+    python benchmarks/bench_ingest.py --clients 100 --orders 20
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users
+
+app = load_app()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def client_run(user_id, orders, url, seed):
+    client = app.app.test_client()
+    with app.app.app_context():
+        headers = {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+    rng = random.Random(seed)
+    latencies, statuses = [], []
+    for _ in range(orders):
+        order_type = rng.choice(['buy', 'sell'])
+        order = {
+            "currency": rng.choice(['BTC', 'ETH', 'USDC']),
+            "amount": round(rng.uniform(0.1, 2.0), 4),
+            "price": round(rng.uniform(99.5, 100.5), 2),
+            "type": order_type
+        }
+        started = time.perf_counter()
+        response = client.post(url, json=order, headers=headers)
+        latencies.append(time.perf_counter() - started)
+        statuses.append(response.status_code)
+    return latencies, statuses
+
+
+def run(args, url):
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.clients, {"BTC": 1e6, "ETH": 1e6, "USDC": 1e6})
+        for currency in ('BTC', 'ETH', 'USDC'):
+            seed_book(app, currency, args.resting, user_ids)
+        load_books(app)
+
+    with Timer() as acked:
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            results = list(pool.map(lambda i: client_run(user_ids[i], args.orders, url, i),
+                                    range(args.clients)))
+        ack_elapsed = time.perf_counter() - acked.start
+        for pending, worker in app.ingest.shards.values():
+            pending.join()
+
+    latencies = [latency for result in results for latency in result[0]]
+    statuses = [status for result in results for status in result[1]]
+    accepted = sum(status in (201, 202) for status in statuses)
+    return {
+        "accepted_per_sec": accepted / ack_elapsed,
+        "matched_per_sec": accepted / acked.elapsed,
+        "p50_ms": 1000 * percentile(latencies, 0.5),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "rejected": len(statuses) - accepted,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--orders', type=int, default=20, help='orders per client')
+    parser.add_argument('--resting', type=int, default=2000, help='resting orders per currency')
+    args = parser.parse_args()
+
+    print('%d clients x %d orders' % (args.clients, args.orders))
+    print('%-18s %12s %12s %10s %10s %9s' % ('mode', 'accepted/s', 'matched/s', 'p50 ms', 'p99 ms', 'rejected'))
+    for name, url in (('wait for match', '/api/orderbook/create?wait=30'),
+                      ('queued (202)', '/api/orderbook/create')):
+        result = run(args, url)
+        print('%-18s %12.1f %12.1f %10.2f %10.2f %9d' % (
+            name, result["accepted_per_sec"], result["matched_per_sec"],
+            result["p50_ms"], result["p99_ms"], result["rejected"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Leaderboard and profile-rank latency: window-function queries vs the in-memory ranking.
+
+    python benchmarks/bench_leaderboard.py --users 1000000
+"""
+import argparse
+import random
+
+from common import Timer, load_app, reset
+
+app = load_app()
+db, User, UserPoints = app.db, app.User, app.UserPoints
+
+
+def legacy_leaderboard():
+    return db.session.query(
+        User.id, User.email.label('name'), UserPoints.points, UserPoints.total_trades,
+        db.func.rank().over(order_by=UserPoints.points.desc()).label('rank')
+    ).outerjoin(UserPoints, User.id == UserPoints.user_id) \
+        .order_by(UserPoints.points.desc().nullslast()).limit(100).all()
+
+
+def sql_rank(user_id):
+    """A correct SQL rank for comparison (the old get_user_rank always returned 1)."""
+    points = db.session.query(UserPoints.points).filter_by(user_id=user_id).scalar() or 0
+    return db.session.query(db.func.count()).filter(UserPoints.points > points).scalar() + 1
+
+
+def seed(count, seed=1):
+    rng = random.Random(seed)
+    for start in range(1, count + 1, 50000):
+        ids = range(start, min(start + 50000, count + 1))
+        db.session.execute(db.insert(User), [
+            {"id": i, "email": 'user%d@example.com' % i, "password": 'x'} for i in ids])
+        db.session.execute(db.insert(UserPoints), [
+            {"user_id": i, "points": int(rng.paretovariate(1.2) * 10), "total_trades": rng.randrange(100)}
+            for i in ids if i % 10])
+    db.session.commit()
+
+
+def latency(func, args_list):
+    with Timer() as timer:
+        for args in args_list:
+            func(*args)
+    return 1000 * timer.elapsed / len(args_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    client = app.app.test_client()
+    with app.app.app_context():
+        reset(app)
+        with Timer() as timer:
+            seed(args.users)
+        print('seeded %d users in %.1fs' % (args.users, timer.elapsed))
+
+        with Timer() as timer:
+            app.ranking.load(db.session.query(User.id, UserPoints.points)
+                             .outerjoin(UserPoints, User.id == UserPoints.user_id))
+        print('ranking rebuilt in %.2fs' % timer.elapsed)
+
+        rng = random.Random(3)
+        users = [(rng.randrange(1, args.users + 1),) for _ in range(args.requests)]
+        awards = [(user_id, rng.randrange(1, 50)) for user_id, in users]
+        rows = [
+            ('leaderboard, window query', latency(legacy_leaderboard, [()] * max(1, args.requests // 10))),
+            ('leaderboard, ranking', latency(lambda: client.get('/api/leaderboard'), [()] * args.requests)),
+            ('user rank, SQL count', latency(sql_rank, users)),
+            ('user rank, ranking', latency(app.ranking.rank, users)),
+            ('award points, ranking', latency(app.ranking.award, awards)),
+        ]
+    print('%-28s %10s' % ('operation', 'ms/op'))
+    for name, ms in rows:
+        print('%-28s %10.3f' % (name, ms))
+
+
+if __name__ == '__main__':
+    main()
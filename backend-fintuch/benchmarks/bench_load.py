@@ -0,0 +1,255 @@
+"""Deterministic load run with per-endpoint latency, reported as JSON.
+
+Seeds `--users` users with wallets in every traded currency and quote, then has
+`--clients` threads replay a seeded stream of operations: new orders
+(price drawn from `--prices` around `--mid`, buys with probability
+`--buy-ratio`), cancels of the client's own resting orders
+(`--cancel-ratio`) and wallet/book reads (`--read-ratio`). Runs in-process
+through the Flask test client on a throwaway SQLite file, or against a
+live server with `--url`, where users are registered and funded through
+the API. Currencies default to the backend's /api/popular_currencies.
+
+Prints orders/sec, fills/sec (from /api/stats/settlement) and p50, p99
+and p999 latency per endpoint as JSON, also written to `--output`. With
+`--baseline` a previous report is compared: exits non-zero if
+throughput drops or a p99 rises by more than `--tolerance`, or if any
+request failed with a server error.
+
+    python benchmarks/bench_load.py --users 50 --clients 10 --orders 200 --output load.json
+    python benchmarks/bench_load.py --url http://localhost:5000 --baseline load.json
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD = 'load-test-password'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+class TestClientTarget:
+    """The backend imported in this process, on a fresh SQLite file."""
+
+    def __init__(self, args):
+        from common import load_app, load_books, reset, seed_book, seed_users
+        self.app = app = load_app()
+        self.local = threading.local()
+        with app.app.app_context():
+            reset(app)
+        self.currencies = args.currencies or self.request('GET', '/api/popular_currencies')[1]
+        with app.app.app_context():
+            self.user_ids = seed_users(app, args.users, {currency: args.balance for currency in self.currencies})
+            for currency in self.currencies:
+                seed_book(app, currency, args.resting, self.user_ids, mid=args.mid)
+            load_books(app)
+
+    def users(self):
+        with self.app.app.app_context():
+            return [{'Authorization': 'Bearer ' + self.app.create_access_token(identity=user_id)}
+                    for user_id in self.user_ids]
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpTarget:
+    """A running server; users are registered, logged in and funded through the API."""
+
+    def __init__(self, args):
+        import requests
+        self.requests = requests
+        self.url = args.url.rstrip('/')
+        self.local = threading.local()
+        self.currencies = args.currencies or self.request('GET', '/api/popular_currencies')[1]
+        self.args = args
+
+    def users(self):
+        args = self.args
+        # buys are paid in the pairs' quote currencies, so those are funded too
+        quotes = {pair["quote"] for pair in self.request('GET', '/api/pairs')[1] if pair["symbol"] in self.currencies}
+        headers = []
+        for i in range(args.users):
+            email = 'load-%d-%d@example.com' % (args.seed, i)
+            self.request('POST', '/api/auth/register', {"email": email, "password": PASSWORD})
+            status, body = self.request('POST', '/api/auth/login', {"email": email, "password": PASSWORD})
+            if status != 200:
+                raise RuntimeError('login of %s failed: %s' % (email, body))
+            user = {'Authorization': 'Bearer ' + body["token"]}
+            for currency in self.currencies + sorted(quotes):
+                self.request('POST', '/api/wallet/deposit', {"currency": currency, "amount": args.balance}, user)
+            headers.append(user)
+        return headers
+
+    def request(self, method, path, body=None, headers=None):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        response = session.request(method, self.url + path, json=body, headers=headers, timeout=60)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+def operations(args, currencies, seed):
+    """The client's seeded stream of ('order', body), ('cancel', None) and ('read', path) steps."""
+    rng = random.Random(seed)
+    for _ in range(args.orders):
+        roll = rng.random()
+        if roll < args.read_ratio:
+            yield 'read', rng.choice(['/api/wallet', '/api/orderbook/%s' % rng.choice(currencies)])
+            continue
+        if roll < args.read_ratio + args.cancel_ratio:
+            yield 'cancel', None
+            continue
+        if args.prices == 'normal':
+            price = rng.gauss(args.mid, args.spread)
+        else:
+            price = rng.uniform(args.mid - args.spread, args.mid + args.spread)
+        yield 'order', {
+            "currency": rng.choice(currencies),
+            "amount": round(rng.uniform(0.1, 2.0), 4),
+            "price": round(max(price, 0.01), 2),
+            "type": 'buy' if rng.random() < args.buy_ratio else 'sell'
+        }
+
+
+def run_client(target, args, headers, seed, latencies, statuses):
+    """Replay one client's stream; latencies and status counts are added per endpoint."""
+    resting = []
+    placed = 0
+    create = '/api/orderbook/create' + ('?wait=30' if args.wait else '')
+    for kind, payload in operations(args, target.currencies, seed):
+        if kind == 'order':
+            endpoint, method, path, body = 'POST /api/orderbook/create', 'POST', create, payload
+        elif kind == 'cancel':
+            if not resting:
+                continue
+            endpoint, method, path, body = 'DELETE /api/orderbook/order', 'DELETE', \
+                '/api/orderbook/order/%d' % resting.pop(0), None
+        else:
+            endpoint = 'GET /api/orderbook/<currency>' if payload.startswith('/api/orderbook') else 'GET ' + payload
+            method, path, body = 'GET', payload, None
+        started = time.perf_counter()
+        try:
+            status, result = target.request(method, path, body, headers)
+        except Exception:
+            status, result = 'error', None
+        latencies.setdefault(endpoint, []).append(time.perf_counter() - started)
+        counts = statuses.setdefault(endpoint, {})
+        counts[str(status)] = counts.get(str(status), 0) + 1
+        if kind == 'order' and status in (201, 202):
+            placed += 1
+            if result and result.get("status") in ('active', 'queued'):
+                resting.append(result["order_id"])
+    return placed
+
+
+def run(args):
+    target = HttpTarget(args) if args.url else TestClientTarget(args)
+    headers = target.users()
+    fills_before = target.request('GET', '/api/stats/settlement')[1]["fills"]
+
+    per_client = [({}, {}) for _ in range(args.clients)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        placed = sum(pool.map(
+            lambda i: run_client(target, args, headers[i % len(headers)], args.seed * 1000 + i, *per_client[i]),
+            range(args.clients)))
+    elapsed = time.perf_counter() - started
+    fills = target.request('GET', '/api/stats/settlement')[1]["fills"] - fills_before
+
+    latencies, statuses = {}, {}
+    for client_latencies, client_statuses in per_client:
+        for endpoint, values in client_latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for endpoint, counts in client_statuses.items():
+            merged = statuses.setdefault(endpoint, {})
+            for status, count in counts.items():
+                merged[status] = merged.get(status, 0) + count
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    config["currencies"] = target.currencies
+    return {
+        "config": config,
+        "elapsed": elapsed,
+        "orders": placed,
+        "orders_per_sec": placed / elapsed,
+        "fills_per_sec": fills / elapsed,
+        "endpoints": {endpoint: {
+            "count": len(values),
+            "statuses": statuses.get(endpoint, {}),
+            "mean_ms": 1000 * sum(values) / len(values),
+            "p50_ms": 1000 * percentile(values, 0.5),
+            "p99_ms": 1000 * percentile(values, 0.99),
+            "p999_ms": 1000 * percentile(values, 0.999),
+        } for endpoint, values in sorted(latencies.items())},
+    }
+
+
+def regressions(report, baseline, tolerance):
+    """Descriptions of the ways `report` is worse than `baseline` by more than `tolerance`."""
+    found = []
+    for key in ('orders_per_sec', 'fills_per_sec'):
+        if baseline.get(key) and report[key] < baseline[key] * (1 - tolerance):
+            found.append('%s fell from %.1f to %.1f' % (key, baseline[key], report[key]))
+    for endpoint, stats in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(endpoint)
+        if before and before["p99_ms"] and stats["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            found.append('%s p99 rose from %.2f ms to %.2f ms' % (endpoint, before["p99_ms"], stats["p99_ms"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='base URL of a running server; default runs the app in-process')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--orders', type=int, default=200, help='operations per client')
+    parser.add_argument('--currencies', nargs='+', help='default: the backend\'s popular currencies')
+    parser.add_argument('--balance', type=float, default=1e6, help='starting balance per wallet')
+    parser.add_argument('--resting', type=int, default=500, help='resting orders seeded per currency (in-process only)')
+    parser.add_argument('--prices', choices=['normal', 'uniform'], default='normal')
+    parser.add_argument('--mid', type=float, default=100.0)
+    parser.add_argument('--spread', type=float, default=0.5, help='standard deviation, or half-width when uniform')
+    parser.add_argument('--buy-ratio', type=float, default=0.5)
+    parser.add_argument('--cancel-ratio', type=float, default=0.1)
+    parser.add_argument('--read-ratio', type=float, default=0.2)
+    parser.add_argument('--no-wait', dest='wait', action='store_false', help='do not wait for orders to match')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    failures = ['%s answered %s %d times' % (endpoint, status, count)
+                for endpoint, stats in report["endpoints"].items()
+                for status, count in stats["statuses"].items() if status[0] not in '234']
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += regressions(report, json.load(f), args.tolerance)
+    for failure in failures:
+        print('FAIL %s' % failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Orders/sec of the in-memory matching engine vs the per-order SQL scan.
+
+    python benchmarks/bench_matching.py --sizes 1000 10000 100000 --orders 300
+"""
+import argparse
+from datetime import datetime
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+db, Order, Wallet, Transaction = app.db, app.Order, app.Wallet, app.Transaction
+
+
+# The matching path as it was before the engine: one SQL scan of the
+# opposite side per order plus wallet lookups and a commit per fill.
+def legacy_match_orders(new_order):
+    try:
+        opposite_type = 'sell' if new_order.type == 'buy' else 'buy'
+
+        if new_order.type == 'buy':
+            matching_orders = Order.query.filter_by(
+                currency=new_order.currency, type=opposite_type, status='active'
+            ).filter(Order.price <= new_order.price).order_by(Order.price.asc()).all()
+        else:
+            matching_orders = Order.query.filter_by(
+                currency=new_order.currency, type=opposite_type, status='active'
+            ).filter(Order.price >= new_order.price).order_by(Order.price.desc()).all()
+
+        remaining_amount = new_order.amount
+
+        for matching_order in matching_orders:
+            if remaining_amount <= 0:
+                break
+
+            seller_id = matching_order.user_id if new_order.type == 'buy' else new_order.user_id
+            seller_wallet = Wallet.query.filter_by(user_id=seller_id, currency=new_order.currency).first()
+            if not seller_wallet or seller_wallet.balance < matching_order.amount:
+                continue
+            trade_amount = min(remaining_amount, matching_order.amount)
+            trade_price = matching_order.price
+
+            if not legacy_can_execute_trade(seller_id, new_order.currency, trade_amount):
+                continue
+
+            remaining_amount -= trade_amount
+            matching_order.amount -= trade_amount
+            if matching_order.amount == 0:
+                matching_order.status = 'filled'
+
+            date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            transaction1 = Transaction(user_id=new_order.user_id, currency=new_order.currency,
+                                       amount=trade_amount, price=trade_price,
+                                       type=new_order.type, date=date)
+            transaction2 = Transaction(user_id=matching_order.user_id, currency=matching_order.currency,
+                                       amount=trade_amount, price=trade_price,
+                                       type=opposite_type, date=date)
+
+            if new_order.type == 'buy':
+                buyer_id = new_order.user_id
+            else:
+                buyer_id = matching_order.user_id
+
+            if not legacy_update_wallets(buyer_id, seller_id, new_order.currency, trade_amount):
+                db.session.rollback()
+                continue
+
+            db.session.add(transaction1)
+            db.session.add(transaction2)
+
+        new_order.amount = remaining_amount
+        if remaining_amount == 0:
+            new_order.status = 'filled'
+
+        db.session.commit()
+        return True
+
+    except Exception:
+        db.session.rollback()
+        return False
+
+
+def legacy_can_execute_trade(seller_id, currency, trade_amount):
+    seller_wallet = Wallet.query.filter_by(user_id=seller_id, currency=currency).first()
+    return bool(seller_wallet and seller_wallet.balance >= trade_amount)
+
+
+def legacy_update_wallets(buyer_id, seller_id, currency, amount):
+    seller_wallet = Wallet.query.filter_by(user_id=seller_id, currency=currency).first()
+    if not seller_wallet or seller_wallet.balance < amount:
+        return False
+    buyer_wallet = Wallet.query.filter_by(user_id=buyer_id, currency=currency).first()
+    buyer_wallet.balance += amount
+    seller_wallet.balance -= amount
+    db.session.commit()
+    return True
+
+
+def run(size, orders, match):
+    reset(app)
+    user_ids = seed_users(app, 100, {"BTC": 1e9})
+    seed_book(app, 'BTC', size, user_ids)
+    load_books(app)
+
+    stream = list(taker_stream('BTC', orders, user_ids))
+    with Timer() as timer:
+        for data in stream:
+            order = Order(status='active', **data)
+            db.session.add(order)
+            db.session.commit()
+            if not match(order):
+                raise RuntimeError('matching failed')
+    return orders / timer.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--orders', type=int, default=300)
+    args = parser.parse_args()
+
+    print('%10s %14s %14s %8s' % ('resting', 'sql orders/s', 'engine orders/s', 'speedup'))
+    with app.app.app_context():
+        for size in args.sizes:
+            legacy = run(size, args.orders, legacy_match_orders)
+            engine = run(size, args.orders, app.match_orders)
+            print('%10d %14.1f %14.1f %7.1fx' % (size, legacy, engine, engine / legacy))
+
+
+if __name__ == '__main__':
+    main()
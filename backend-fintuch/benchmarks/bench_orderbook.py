@@ -0,0 +1,67 @@
+"""Requests/sec of GET /api/orderbook/<currency> before and after depth snapshots.
+
+    python benchmarks/bench_orderbook.py --resting 10000 --requests 200
+"""
+import argparse
+
+from flask import jsonify
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users
+
+app = load_app()
+Order = app.Order
+
+
+# The endpoint as it was before: every active order of both sides, one JSON
+# entry per order, on every request.
+def legacy_get_orderbook(currency):
+    buy_orders = Order.query.filter_by(currency=currency, type='buy', status='active') \
+        .order_by(Order.price.desc()).all()
+    sell_orders = Order.query.filter_by(currency=currency, type='sell', status='active') \
+        .order_by(Order.price.asc()).all()
+    return jsonify({
+        "buy_orders": [{"price": o.price, "amount": o.amount, "total": o.price * o.amount} for o in buy_orders],
+        "sell_orders": [{"price": o.price, "amount": o.amount, "total": o.price * o.amount} for o in sell_orders]
+    }), 200
+
+
+app.app.add_url_rule('/bench/legacy_orderbook/<currency>', view_func=legacy_get_orderbook)
+
+
+def rate(client, url, count, headers=None, expect=200):
+    with Timer() as timer:
+        for _ in range(count):
+            response = client.get(url, headers=headers)
+            assert response.status_code == expect, response.status_code
+    return count / timer.elapsed, len(response.data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resting', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=20)
+    args = parser.parse_args()
+
+    client = app.app.test_client()
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, 100, {"BTC": 1e9})
+        seed_book(app, 'BTC', args.resting, user_ids)
+        load_books(app)
+
+    url = '/api/orderbook/BTC?depth=%d' % args.depth
+    etag = client.get(url).headers['ETag']
+    results = [
+        ('legacy (all orders)', rate(client, '/bench/legacy_orderbook/BTC', args.requests)),
+        ('depth snapshot, 200', rate(client, url, args.requests)),
+        ('depth snapshot, 304', rate(client, url, args.requests, {'If-None-Match': etag}, 304)),
+    ]
+    print('%d resting orders, depth=%d' % (args.resting, args.depth))
+    print('%-22s %12s %12s' % ('endpoint', 'requests/s', 'bytes'))
+    for name, (per_second, size) in results:
+        print('%-22s %12.1f %12d' % (name, per_second, size))
+
+
+if __name__ == '__main__':
+    main()
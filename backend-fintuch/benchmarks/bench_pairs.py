@@ -0,0 +1,128 @@
+"""Price levels with and without a tick size, and settlement of both legs of a pair.
+
+Sends the same seeded orders, priced at full float precision around a mid,
+through /api/orderbook/create for BTC (tick 0.01, lot 0.0001) and for a
+pair registered with the smallest tick and lot. Reports orders/sec and how
+many distinct price levels each book ends up with. Exits non-zero if a
+resting BTC order is off its tick or lot, if any currency's wallets no
+longer add up to what was seeded (buyers pay sellers in the quote
+currency, so USD must be conserved as well as the base currencies), if a
+balance went negative or if a wallet backs more resting orders than it
+holds.
+
+    python benchmarks/bench_pairs.py --orders 2000
+"""
+import argparse
+import random
+import sys
+
+from common import Timer, load_app, load_books, reset, seed_users
+
+app = load_app()
+db = app.db
+
+TICKED = 'BTC'
+RAW = 'RAW'
+BALANCE = 1e6
+QUOTE_BALANCE = 1e9
+
+
+def setup(args):
+    """Fresh database with the raw pair registered; (API client, user id -> auth headers, funding)."""
+    with app.app.app_context():
+        reset(app)
+        db.session.execute(db.insert(app.TradingPair), [
+            {"symbol": RAW, "base": RAW, "quote": 'USD', "tick_size": 1, "lot_size": 1}])
+        db.session.commit()
+        app.pairs.reload()
+        funding = {TICKED: BALANCE, RAW: BALANCE, 'USD': QUOTE_BALANCE}
+        user_ids = seed_users(app, args.users, funding)
+        load_books(app)
+        headers = {user_id: {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+                   for user_id in user_ids}
+    return app.app.test_client(), headers, funding
+
+
+def order_stream(args, user_ids):
+    rng = random.Random(args.seed)
+    for _ in range(args.orders):
+        yield rng.choice(user_ids), {
+            "amount": rng.uniform(0.01, 2.0),
+            "price": rng.gauss(args.mid, args.spread),
+            "type": rng.choice(['buy', 'sell'])
+        }
+
+
+def run(client, headers, currency, args):
+    statuses = {}
+    with Timer() as timer:
+        for user_id, body in order_stream(args, list(headers)):
+            response = client.post('/api/orderbook/create?wait=30', json=dict(body, currency=currency),
+                                   headers=headers[user_id])
+            status = response.get_json().get("status", response.status_code)
+            statuses[status] = statuses.get(status, 0) + 1
+    book = app.engine.book(currency)
+    return {
+        "orders_per_sec": args.orders / timer.elapsed,
+        "levels": len(book.bids) + len(book.asks),
+        "resting": len(book),
+        "statuses": statuses,
+    }
+
+
+def check(funding, user_count):
+    """Problems with the BTC book's steps, wallet totals and holds."""
+    from money import to_units
+    problems = []
+    pair = app.pairs.get(TICKED)
+    off = [order.id for order in app.engine.book(TICKED).resting()
+           if order.price % pair.tick or order.amount % pair.lot]
+    if off:
+        problems.append('%d resting %s orders are off the tick or lot' % (len(off), TICKED))
+    held = {}
+    for currency in (TICKED, RAW):
+        pair = app.pairs.pair(currency)
+        for order in app.engine.book(currency).resting():
+            key = (pair.base, order.user_id) if order.type == 'sell' else (pair.quote, order.user_id)
+            amount = order.amount if order.type == 'sell' else pair.cost(order.price, order.amount)
+            held[key] = held.get(key, 0) + amount
+    with app.app.app_context():
+        for currency, balance in funding.items():
+            balances = dict(db.session.query(app.Wallet.user_id, app.Wallet.balance).filter_by(currency=currency))
+            if sum(balances.values()) != user_count * to_units(balance, currency):
+                problems.append('%s: wallets hold %d units, expected %d' % (
+                    currency, sum(balances.values()), user_count * to_units(balance, currency)))
+            if any(amount < 0 for amount in balances.values()):
+                problems.append('%s: negative balances' % currency)
+            over = sum(amount > balances.get(user_id, 0) for (held_currency, user_id), amount in held.items()
+                       if held_currency == currency)
+            if over:
+                problems.append('%s: %d wallets back more resting orders than they hold' % (currency, over))
+        db.session.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=2000, help='orders per pair')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--mid', type=float, default=100.0)
+    parser.add_argument('--spread', type=float, default=0.5, help='standard deviation of the prices')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    client, headers, funding = setup(args)
+    print('%d orders per pair around %.2f' % (args.orders, args.mid))
+    print('%-6s %10s %8s %8s  %s' % ('pair', 'orders/s', 'levels', 'resting', 'statuses'))
+    for currency in (TICKED, RAW):
+        result = run(client, headers, currency, args)
+        print('%-6s %10.1f %8d %8d  %s' % (currency, result["orders_per_sec"], result["levels"],
+                                          result["resting"], result["statuses"]))
+    failures = check(funding, len(headers))
+    for failure in failures:
+        print('FAIL %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""Matching throughput with currencies sharded across matching processes.
+
+Runs crossing orders on threads of one process (0) and on 1, 2, 4 ...
+forked matching processes, while a client keeps depositing and withdrawing
+through the API, for two sets of pairs:
+
+  default     the registered default pairs, all quoted in USD. Each book
+              matches on its own matcher; buyers reserve USD on the USD
+              matcher first, and the books pay the quote leg over to it
+              in transfers.
+  own quotes  synthetic pairs quoted in a currency of their own, so
+              orders only go through a second matcher for that quote.
+
+Scaling needs a core per matching process. So far the script has only
+run on a single-core machine, where the processes only add overhead, so
+whether sharding speeds matching up is unverified.
+
+Exits non-zero if any currency's wallets do not add up once every transfer
+is applied, a wallet backs more resting orders than it holds, or a book is
+left crossed.
+
+    python benchmarks/bench_shards.py --processes 0 1 2 4 --synthetic 6
+"""
+import argparse
+import queue
+import random
+import sys
+import threading
+import time
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+db = app.db
+
+BALANCE = 1e6
+QUOTE_BALANCE = 1e9
+
+
+def interleave(streams):
+    streams = [iter(stream) for stream in streams]
+    while streams:
+        for stream in list(streams):
+            order = next(stream, None)
+            if order is None:
+                streams.remove(stream)
+            else:
+                yield order
+
+
+def move_funds(user_ids, currencies, stop, moved):
+    """Deposit and withdraw through the API until `stop` is set, adding successes to `moved`."""
+    from money import to_units
+    client = app.app.test_client()
+    with app.app.app_context():
+        headers = {user_id: {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+                   for user_id in user_ids}
+    rng = random.Random(3)
+    while not stop.is_set():
+        user_id, currency = rng.choice(user_ids), rng.choice(currencies)
+        amount = round(rng.uniform(0.1, 5.0), 4)
+        if rng.random() < 0.5:
+            response = client.post('/api/wallet/deposit', json={"currency": currency, "amount": amount},
+                                   headers=headers[user_id])
+            sign = 1
+        else:
+            response = client.post('/api/wallet/withdraw', json={"currency": currency, "amount": amount},
+                                   headers=headers[user_id])
+            sign = -1
+        if response.status_code == 200:
+            moved[currency] = moved.get(currency, 0) + sign * to_units(amount, currency)
+
+
+def register_synthetic(currencies):
+    """A pair per currency not yet registered, each quoted in a currency of its own."""
+    from money import price_to_units
+    rows = [{"symbol": currency, "base": currency, "quote": 'Q' + currency, "tick_size": price_to_units(0.01),
+             "lot_size": 1} for currency in currencies if app.pairs.get(currency) is None]
+    if rows:
+        db.session.execute(db.insert(app.TradingPair), rows)
+        db.session.commit()
+    app.pairs.reload()
+
+
+def check_wallets(currencies, funding, user_count, moved):
+    """Problems found in balances and books after a run."""
+    from money import to_units
+    problems = []
+    held = {}
+    for currency in currencies:
+        pair = app.pairs.pair(currency)
+        for order in app.active_orders(currency):
+            if order.type == 'sell':
+                key, amount = (pair.base, order.user_id), order.amount
+            else:
+                key, amount = (pair.quote, order.user_id), pair.cost(order.price, order.amount)
+            held[key] = held.get(key, 0) + amount
+        book = app.engine.reload(currency, app.active_orders(currency))
+        if book.best_bid() is not None and book.best_ask() is not None and book.best_bid() >= book.best_ask():
+            problems.append('%s: book left crossed' % currency)
+    for currency, balance in funding.items():
+        total = db.session.query(db.func.sum(app.Wallet.balance)).filter_by(currency=currency).scalar()
+        expected = user_count * to_units(balance, currency) + moved.get(currency, 0)
+        if total != expected:
+            problems.append('%s: wallets hold %d units, expected %d' % (currency, total, expected))
+        negative = app.Wallet.query.filter(app.Wallet.currency == currency, app.Wallet.balance < 0).count()
+        if negative:
+            problems.append('%s: %d negative balances' % (currency, negative))
+        balances = dict(db.session.query(app.Wallet.user_id, app.Wallet.balance).filter_by(currency=currency))
+        overcommitted = sum(amount > balances.get(user_id, 0) for (held_currency, user_id), amount in held.items()
+                            if held_currency == currency)
+        if overcommitted:
+            problems.append('%s: %d wallets back more resting orders than they hold' % (currency, overcommitted))
+    return problems
+
+
+def run(args, processes, currencies):
+    with app.app.app_context():
+        reset(app)
+        register_synthetic(currencies)
+        funding = {currency: BALANCE for currency in currencies}
+        for currency in currencies:
+            funding[app.pairs.pair(currency).quote] = QUOTE_BALANCE
+        user_ids = seed_users(app, args.users, funding)
+        for currency in currencies:
+            seed_book(app, currency, args.resting, user_ids)
+        load_books(app)
+        orders = list(interleave(taker_stream(currency, args.orders, user_ids, seed=i)
+                                 for i, currency in enumerate(currencies)))
+
+    app.ingest = ingest = app.matching_ingest(processes)
+    stop, moved = threading.Event(), {}
+    mover = threading.Thread(target=move_funds, args=(user_ids[:10], sorted(funding), stop, moved))
+    mover.start()
+    tickets = []
+    with Timer() as timer:
+        for order in orders:
+            order_id = next(app.order_ids)
+            item = dict(order, command='order', id=order_id, points=1)
+            while True:
+                try:
+                    tickets.append(app.submit_order(order["currency"], order_id, order["user_id"], item))
+                    break
+                except queue.Full:
+                    time.sleep(0.001)
+        for ticket in tickets:
+            ticket.wait(60)
+        ingest.join()
+    stop.set()
+    mover.join()
+    ingest.join()
+    if processes:
+        ingest.close()
+
+    with app.app.app_context():
+        problems = check_wallets(currencies, funding, len(user_ids), moved)
+    rejected = sum(ticket.status == 'rejected' for ticket in tickets)
+    return len(orders) / timer.elapsed, rejected, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='matching process counts; 0 matches on threads of this process')
+    parser.add_argument('--synthetic', type=int, default=6, help='synthetic pairs with quotes of their own')
+    parser.add_argument('--orders', type=int, default=300, help='taker orders per currency')
+    parser.add_argument('--resting', type=int, default=500, help='resting orders per currency')
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app.app_context():
+        reset(app)
+        default = app.pairs.symbols()
+    scenarios = [('default', default), ('own quotes', ['SYN%d' % i for i in range(1, args.synthetic + 1)])]
+    print('%d orders per pair' % args.orders)
+    print('%-12s %6s %-10s %12s %9s' % ('pairs', 'count', 'processes', 'orders/s', 'rejected'))
+    failures = 0
+    for name, currencies in scenarios:
+        for processes in args.processes:
+            per_second, rejected, problems = run(args, processes, currencies)
+            print('%-12s %6d %-10s %12.1f %9d' % (name, len(currencies), processes or 'threads',
+                                                per_second, rejected))
+            for problem in problems:
+                print('   FAIL %s' % problem)
+            failures += len(problems)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""Time to ready order books at startup: orders table vs journal snapshot + tail.
+
+Seeds a database with `--orders` orders, of which `--active` still rest on
+the books, journals `--tail` crossing orders on top of a snapshot, then
+rebuilds the books both ways. A clean restart must take every book from
+the journal. Before the last restart the journal loses its last batch:
+an amend that moved a resting order's price and kept its amount, which
+recovery has to notice from the journal marks and take from the
+database. Exits non-zero if the recovered books differ from the ones
+loaded from the database, or the clean restart reloaded any book.
+
+    python benchmarks/bench_startup.py --orders 1000000 --active 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+
+CURRENCIES = ['BTC', 'ETH', 'USDC']
+CHUNK = 100000
+
+
+def book_state(books):
+    return {currency: sorted((order.id, order.type, order.price, order.amount) for order in book.resting())
+            for currency, book in books.items() if len(book)}
+
+
+def restart():
+    """Load the books from a fresh journal on the same directory; the currencies it reloaded from the table."""
+    from journal import BookJournal
+    generations = dict(app.journal.generations)
+    app.journal = BookJournal(app.journal.directory)
+    app.load_books()
+    return {currency for currency, generation in app.journal.generations.items()
+            if generation != generations.get(currency)}
+
+
+def lose_amend(book):
+    """Amend a resting buy to a lower price, then cut the amend's records off the journal."""
+    log = app.journal._log_path(book.currency, app.journal.generations.get(book.currency, 0))
+    size = os.path.getsize(log) if os.path.exists(log) else 0
+    order = next(book.resting('buy'))
+    tick = app.pairs.pair(book.currency).tick
+    app.amend_order(book.currency, {"id": order.id, "user_id": order.user_id, "type": order.type,
+                                    "amount": None, "price": order.price - 100 * tick})
+    os.truncate(log, size)
+
+
+def main():
+    from journal import BookJournal
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=1000000, help='orders in the table, filled or resting')
+    parser.add_argument('--active', type=int, default=100000, help='resting orders across %s' % ', '.join(CURRENCIES))
+    parser.add_argument('--tail', type=int, default=5000, help='orders journaled after the last snapshot')
+    args = parser.parse_args()
+
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, 100, {currency: 1e9 for currency in CURRENCIES})
+        history = args.orders - args.active
+        for i, start in enumerate(range(0, history, CHUNK)):
+            seed_book(app, CURRENCIES[i % len(CURRENCIES)], min(CHUNK, history - start), user_ids,
+                      seed=100 + i, status='filled')
+        for i, currency in enumerate(CURRENCIES):
+            seed_book(app, currency, args.active // len(CURRENCIES), user_ids, seed=i)
+        load_books(app)
+
+        app.journal = BookJournal(tempfile.mkdtemp(prefix='cex-journal-'))
+        with Timer() as first:
+            app.load_books()
+        for order in taker_stream('BTC', args.tail, user_ids):
+            order_id = next(app.order_ids)
+            app.place_order(order["currency"], dict(order, id=order_id, points=1))
+
+        with Timer() as table:
+            app.engine.load(app.active_orders())
+        expected = book_state(app.engine.books)
+        with Timer() as clean:
+            clean_reloads = restart()
+        clean_state = book_state(app.engine.books)
+        tail = sum(app.journal.records.values())
+
+        lose_amend(app.engine.book('ETH'))
+        app.engine.load(app.active_orders())
+        expected_after_loss = book_state(app.engine.books)
+        with Timer() as recovered:
+            reloads = restart()
+
+    print('%d orders, %d resting, %d journaled records after the snapshot' % (
+        args.orders, sum(len(book) for book in app.engine.books.values()), tail))
+    print('%-34s %10s' % ('books from', 'seconds'))
+    print('%-34s %10.3f' % ('orders table', table.elapsed))
+    print('%-34s %10.3f' % ('journal, first start (snapshots)', first.elapsed))
+    print('%-34s %10.3f' % ('journal snapshot + tail', clean.elapsed))
+    print('%-34s %10.3f   reloaded %s' % ('journal, lost last batch', recovered.elapsed,
+                                            ', '.join(sorted(reloads)) or 'nothing'))
+    failures = 0
+    if clean_state != expected or book_state(app.engine.books) != expected_after_loss:
+        print('FAIL recovered books differ from the orders table')
+        failures += 1
+    if clean_reloads:
+        print('FAIL a clean restart reloaded %s from the orders table' % ', '.join(sorted(clean_reloads)))
+        failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
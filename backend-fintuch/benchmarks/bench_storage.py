@@ -0,0 +1,129 @@
+"""The same order flow against each storage configuration.
+
+Every configuration runs in its own process, since the engine is set up
+when the backend is imported: SQLite as it was before storage settings
+(rollback journal, synchronous FULL, default pool), SQLite in WAL mode with
+the default settings, and a server database if `--server-uri` names one
+(its tables are dropped). Clients place orders with ?wait and read their
+wallet and transaction history in between. Exits non-zero if a run fails,
+rejects orders, or SQLite is not in the journal mode asked for.
+
+    python benchmarks/bench_storage.py --clients 20 --orders 50
+    python benchmarks/bench_storage.py --server-uri postgresql+psycopg2://cex@localhost/cex_bench
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+CONFIGS = [
+    ('sqlite default', {"CEX_SQLITE_JOURNAL_MODE": 'DELETE', "CEX_SQLITE_SYNCHRONOUS": 'FULL',
+                        "CEX_DB_POOL_SIZE": '5', "CEX_DB_MAX_OVERFLOW": '10', "CEX_DB_STATEMENT_CACHE": '128'}),
+    ('sqlite wal', {}),
+]
+CURRENCIES = ['BTC', 'ETH', 'USDC']
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def order_flow(args):
+    """Run the clients against a fresh schema and return the results as a dict."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from common import Timer, load_app, load_books, reset, seed_book, seed_users
+    app = load_app(uri=args.uri)
+
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.clients, {currency: 1e6 for currency in CURRENCIES})
+        for currency in CURRENCIES:
+            seed_book(app, currency, args.resting, user_ids)
+        load_books(app)
+        journal_mode = None
+        if app.storage.is_sqlite(args.uri or 'sqlite'):
+            journal_mode = app.db.session.execute(app.db.text('PRAGMA journal_mode')).scalar().upper()
+        app.db.session.close()
+
+    def client_run(i):
+        client = app.app.test_client()
+        with app.app.app_context():
+            headers = {'Authorization': 'Bearer ' + app.create_access_token(identity=user_ids[i])}
+        rng = random.Random(i)
+        latencies, rejected = [], 0
+        for _ in range(args.orders):
+            order = {"currency": rng.choice(CURRENCIES), "amount": round(rng.uniform(0.1, 2.0), 4),
+                     "price": round(rng.uniform(99.5, 100.5), 2), "type": rng.choice(['buy', 'sell'])}
+            started = time.perf_counter()
+            response = client.post('/api/orderbook/create?wait=30', json=order, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            rejected += response.status_code != 201
+            client.get('/api/wallet', headers=headers)
+            client.get('/api/transactions?limit=20', headers=headers)
+        return latencies, rejected
+
+    with Timer() as timer:
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            results = list(pool.map(client_run, range(args.clients)))
+    latencies = [latency for result in results for latency in result[0]]
+    return {
+        "orders_per_sec": len(latencies) / timer.elapsed,
+        "p50_ms": 1000 * percentile(latencies, 0.5),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "rejected": sum(result[1] for result in results),
+        "journal_mode": journal_mode,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--orders', type=int, default=50, help='orders per client')
+    parser.add_argument('--resting', type=int, default=1000, help='resting orders per currency')
+    parser.add_argument('--server-uri', help='SQLAlchemy URI of a scratch server database')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--uri', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(order_flow(args)))
+        return 0
+
+    configs = [(name, settings, None) for name, settings in CONFIGS]
+    if args.server_uri:
+        configs.append(('server', {}, args.server_uri))
+    print('%d clients x %d orders' % (args.clients, args.orders))
+    print('%-16s %10s %10s %10s %9s' % ('storage', 'orders/s', 'p50 ms', 'p99 ms', 'rejected'))
+    failures = 0
+    for name, settings, uri in configs:
+        command = [sys.executable, os.path.abspath(__file__), '--child', '--clients', str(args.clients),
+                   '--orders', str(args.orders), '--resting', str(args.resting)]
+        if uri:
+            command += ['--uri', uri]
+        child = subprocess.run(command, env=dict(os.environ, **settings), capture_output=True, text=True)
+        if child.returncode != 0:
+            print('%-16s FAIL\n%s' % (name, child.stderr.strip()[-2000:]))
+            failures += 1
+            continue
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        print('%-16s %10.1f %10.2f %10.2f %9d' % (name, result["orders_per_sec"], result["p50_ms"],
+                                                 result["p99_ms"], result["rejected"]))
+        expected = settings.get('CEX_SQLITE_JOURNAL_MODE', 'WAL') if uri is None else None
+        if result["journal_mode"] != expected:
+            print('   FAIL journal mode is %s, expected %s' % (result["journal_mode"], expected))
+            failures += 1
+        if result["rejected"]:
+            print('   FAIL %d orders rejected' % result["rejected"])
+            failures += 1
+    if not args.server_uri:
+        print('(no --server-uri given, server database not run)')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
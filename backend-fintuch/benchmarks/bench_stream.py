@@ -0,0 +1,102 @@
+"""Fan-out latency of the market-data feed with hundreds of subscribers.
+
+Subscribers are threads reading from the same queues the SSE endpoint uses;
+a few of them are deliberately slow to show they resync instead of
+stalling matching.
+
+    python benchmarks/bench_stream.py --subscribers 500 --slow 10 --orders 300
+"""
+import argparse
+import threading
+import time
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+db, Order = app.db, app.Order
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def consume(subscriber, latencies, stats, stop, delay):
+    while not stop.is_set():
+        lagging, events = subscriber.get(timeout=0.1)
+        received = time.time()
+        if lagging:
+            stats['resyncs'] += 1
+        latencies.extend(received - event['ts'] for event in events)
+        if delay:
+            time.sleep(delay)
+
+
+def submit(stream):
+    latencies = []
+    for data in stream:
+        order = Order(status='active', **data)
+        db.session.add(order)
+        db.session.flush()
+        with Timer() as timer:
+            if not app.match_orders(order):
+                raise RuntimeError('matching failed')
+        latencies.append(timer.elapsed)
+    return latencies
+
+
+def run(args, subscribers, slow):
+    reset(app)
+    user_ids = seed_users(app, 100, {"BTC": 1e9})
+    seed_book(app, 'BTC', args.resting, user_ids)
+    load_books(app)
+
+    stop = threading.Event()
+    threads, results = [], []
+    for i in range(subscribers):
+        latencies, stats = [], {'resyncs': 0}
+        results.append((i < slow, latencies, stats))
+        thread = threading.Thread(target=consume, daemon=True, args=(
+            app.feed.subscribe('BTC'), latencies, stats, stop, args.slow_delay if i < slow else 0))
+        thread.start()
+        threads.append(thread)
+
+    matching = submit(taker_stream('BTC', args.orders, user_ids))
+    time.sleep(0.5)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    app.feed.subscribers.clear()
+    return matching, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=500)
+    parser.add_argument('--slow', type=int, default=10)
+    parser.add_argument('--slow-delay', type=float, default=0.5)
+    parser.add_argument('--resting', type=int, default=10000)
+    parser.add_argument('--orders', type=int, default=300)
+    args = parser.parse_args()
+    app.feed.max_pending = 50
+
+    with app.app.app_context():
+        baseline, _ = run(args, 0, 0)
+        matching, results = run(args, args.subscribers, args.slow)
+
+    fast = [latency for is_slow, latencies, _ in results if not is_slow for latency in latencies]
+    resyncs = sum(stats['resyncs'] for is_slow, _, stats in results if is_slow)
+    print('%d subscribers (%d slow), %d orders, %d events delivered to fast subscribers'
+          % (args.subscribers, args.slow, args.orders, len(fast)))
+    print('fan-out latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(
+        1000 * percentile(fast, f) for f in (0.5, 0.9, 0.99, 1.0)))
+    print('slow subscriber resyncs: %d' % resyncs)
+    for name, values in (('no subscribers', baseline), ('with subscribers', matching)):
+        print('match_orders ms (%s): p50 %.2f  p99 %.2f' % (
+            name, 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.99)))
+
+
+if __name__ == '__main__':
+    main()
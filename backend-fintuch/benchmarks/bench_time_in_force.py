@@ -0,0 +1,157 @@
+"""A taker flow as resting limit orders vs IOC, plus FOK, post-only and market checks.
+
+Runs the same crossing orders through /api/orderbook/create twice, once as
+GTC limit orders, whose remainders rest, and once as IOC orders, whose
+remainders are cancelled. Reports orders/sec, how much the book grew and
+how many order rows were written. Then checks the other kinds of order
+against the IOC run's book:
+  - a FOK order larger than the book is rejected and leaves the book alone
+  - a post-only order that would cross is rejected, and one that would not rests
+  - a market order fills and its row records the average fill price
+
+Exits non-zero if an IOC order rests or writes a row without trading, or
+if a check fails.
+
+    python benchmarks/bench_time_in_force.py --takers 500 --resting 1000
+"""
+import argparse
+import sys
+
+from common import Timer, load_app, load_books, reset, seed_book, seed_users, taker_stream
+
+app = load_app()
+
+CURRENCY = 'BTC'
+
+
+def setup(args):
+    """Fresh database and book; (API client, user id -> auth headers)."""
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.users, {CURRENCY: 1e6})
+        seed_book(app, CURRENCY, args.resting, user_ids)
+        load_books(app)
+        headers = {user_id: {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+                   for user_id in user_ids}
+    return app.app.test_client(), headers
+
+
+def order_rows():
+    with app.app.app_context():
+        count = app.db.session.query(app.db.func.count(app.Order.id)).scalar()
+        app.db.session.close()
+        return count
+
+
+def request_body(order, **extra):
+    from money import from_units, price_from_units
+    return dict({"currency": CURRENCY, "amount": from_units(order["amount"], CURRENCY),
+                 "price": price_from_units(order["price"]), "type": order["type"]}, **extra)
+
+
+def run(args, time_in_force):
+    client, headers = setup(args)
+    takers = list(taker_stream(CURRENCY, args.takers, list(headers), seed=args.seed))
+    book = app.engine.book(CURRENCY)
+    resting, rows = len(book), order_rows()
+    statuses, requested = {}, {}
+    with Timer() as timer:
+        for order in takers:
+            response = client.post('/api/orderbook/create?wait=30', json=request_body(order, time_in_force=time_in_force),
+                                   headers=headers[order["user_id"]])
+            body = response.get_json()
+            statuses[body["status"]] = statuses.get(body["status"], 0) + 1
+            requested[body["order_id"]] = order["amount"]
+    with app.app.app_context():
+        # rows that did not trade: resting remainders, or cancelled without a fill
+        idle = app.db.session.query(app.Order).filter(app.Order.id.in_(requested)).all()
+        idle = sum(row.status == 'active' or row.amount == requested[row.id] for row in idle)
+        app.db.session.close()
+    return client, headers, {
+        "orders_per_sec": len(takers) / timer.elapsed,
+        "growth": len(app.engine.book(CURRENCY)) - resting,
+        "rows": order_rows() - rows,
+        "idle": idle,
+        "statuses": statuses,
+    }
+
+
+def check_orders(client, headers):
+    """Failures of the FOK, post-only and market order checks, as descriptions."""
+    from money import from_units, price_from_units
+    failures = []
+    user = next(iter(headers.values()))
+    book = app.engine.book(CURRENCY)
+
+    best_ask = book.best_ask()
+    asks = sum(level.total for level in book.asks.levels.values())
+    version, rows = book.version, order_rows()
+    response = client.post('/api/orderbook/create?wait=30', headers=user, json={
+        "currency": CURRENCY, "type": 'buy', "amount": from_units(asks, CURRENCY) + 1,
+        "order_type": 'market', "time_in_force": 'FOK'})
+    if response.status_code != 400 or book.version != version or order_rows() != rows:
+        failures.append('oversized FOK answered %d, book version %d -> %d, rows %d -> %d'
+                        % (response.status_code, version, book.version, rows, order_rows()))
+
+    level = book.asks.best()
+    response = client.post('/api/orderbook/create?wait=30', headers=user, json={
+        "currency": CURRENCY, "type": 'buy', "amount": from_units(level.total, CURRENCY),
+        "price": price_from_units(best_ask), "time_in_force": 'FOK'})
+    if response.get_json()["status"] != 'filled':
+        failures.append('FOK for the best level came back %s' % response.get_json())
+
+    best_ask = book.best_ask()
+    response = client.post('/api/orderbook/create?wait=30', headers=user, json={
+        "currency": CURRENCY, "type": 'buy', "amount": 0.1, "price": price_from_units(best_ask),
+        "time_in_force": 'POST_ONLY'})
+    if response.status_code != 400:
+        failures.append('crossing post-only order came back %s' % response.get_json())
+    response = client.post('/api/orderbook/create?wait=30', headers=user, json={
+        "currency": CURRENCY, "type": 'buy', "amount": 0.1, "price": price_from_units(book.best_bid()),
+        "time_in_force": 'POST_ONLY'})
+    if response.get_json()["status"] != 'active' or response.get_json()["order_id"] not in book:
+        failures.append('post-only order at the bid came back %s' % response.get_json())
+
+    first, second = book.best_ask(), book.asks.best().total
+    response = client.post('/api/orderbook/create?wait=30', headers=user, json={
+        "currency": CURRENCY, "type": 'buy', "amount": from_units(second, CURRENCY) * 2, "order_type": 'market'})
+    body = response.get_json()
+    with app.app.app_context():
+        row = app.db.session.get(app.Order, body["order_id"])
+        price = row.price if row else None
+        app.db.session.close()
+    if body["status"] != 'filled' or price is None or not first < price <= book.best_ask():
+        failures.append('market buy came back %s with row price %s' % (body, price))
+    if client.post('/api/orderbook/create', headers=user, json={
+            "currency": CURRENCY, "type": 'buy', "amount": 1, "price": 100, "order_type": 'market'}).status_code != 400:
+        failures.append('market order with a price was accepted')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--takers', type=int, default=500)
+    parser.add_argument('--resting', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=2)
+    args = parser.parse_args()
+
+    print('%d takers against %d resting orders' % (args.takers, args.resting))
+    print('%-6s %10s %12s %8s %10s  %s' % ('mode', 'orders/s', 'book growth', 'rows', 'idle rows', 'statuses'))
+    failures = []
+    for time_in_force in ('GTC', 'IOC'):
+        client, headers, result = run(args, time_in_force)
+        print('%-6s %10.1f %12d %8d %10d  %s' % (time_in_force, result["orders_per_sec"], result["growth"],
+                                                result["rows"], result["idle"], result["statuses"]))
+    if result["growth"] > 0:
+        failures.append('IOC orders grew the book by %d' % result["growth"])
+    if result["idle"]:
+        failures.append('%d IOC orders rest or wrote a row without trading' % result["idle"])
+    failures += check_orders(client, headers)
+    for failure in failures:
+        print('FAIL %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
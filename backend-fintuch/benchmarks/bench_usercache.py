@@ -0,0 +1,82 @@
+"""Per-request cost of resolving the caller, with and without the user cache.
+
+Times authenticated GETs of /api/check (token decoding only, the floor),
+/api/wallet and /api/user/profile for `--users` users, first with the
+cache disabled and then enabled, and prints the cache's hit rate. Then
+interleaves deposits and wallet reads; exits non-zero if a read after a
+deposit shows a stale balance.
+
+    python benchmarks/bench_usercache.py --users 100 --requests 5000
+"""
+import argparse
+import random
+import sys
+
+from common import Timer, load_app, load_books, reset, seed_users
+
+app = load_app()
+
+ENDPOINTS = ['/api/check', '/api/wallet', '/api/user/profile']
+
+
+def time_requests(client, headers, count, seed=1):
+    """{endpoint: microseconds per request} over `count` requests each, by random users."""
+    rng = random.Random(seed)
+    timings = {}
+    for endpoint in ENDPOINTS:
+        with Timer() as timer:
+            for _ in range(count):
+                assert client.get(endpoint, headers=rng.choice(headers)).status_code == 200
+        timings[endpoint] = 1e6 * timer.elapsed / count
+    return timings
+
+
+def check_fresh(client, headers, rounds):
+    """Number of wallet reads that missed the deposit made just before them."""
+    stale = 0
+    for i in range(rounds):
+        user = headers[i % len(headers)]
+        before = {item["currency"]: item["balance"] for item in client.get('/api/wallet', headers=user).get_json()}
+        client.post('/api/wallet/deposit', json={"currency": "ETH", "amount": 1}, headers=user)
+        after = {item["currency"]: item["balance"] for item in client.get('/api/wallet', headers=user).get_json()}
+        stale += after.get("ETH") != before.get("ETH", 0) + 1
+    return stale
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per endpoint')
+    parser.add_argument('--deposits', type=int, default=200)
+    args = parser.parse_args()
+
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, args.users, {"BTC": 10, "ETH": 10, "USDC": 10})
+        load_books(app)
+        headers = [{'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+                   for user_id in user_ids]
+    client = app.app.test_client()
+
+    cache = app.user_contexts
+    app.user_contexts = app.UserCache(app.load_user_context, capacity=0)
+    uncached = time_requests(client, headers, args.requests)
+    app.user_contexts = cache
+    cached = time_requests(client, headers, args.requests)
+
+    print('%d users, %d requests per endpoint' % (args.users, args.requests))
+    print('%-20s %12s %12s' % ('endpoint', 'no cache us', 'cache us'))
+    for endpoint in ENDPOINTS:
+        print('%-20s %12.1f %12.1f' % (endpoint, uncached[endpoint], cached[endpoint]))
+    stats = cache.stats()
+    print('hit rate %.3f (%d hits, %d misses)' % (stats["hitRate"], stats["hits"], stats["misses"]))
+
+    stale = check_fresh(client, headers, args.deposits)
+    if stale:
+        print('FAIL %d of %d wallet reads missed the deposit before them' % (stale, args.deposits))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def load_app(path=None, uri=None):
+    """Import the backend against a throwaway SQLite file instead of cex.db.
+
+    With `uri` it uses that database instead; its tables are dropped by `reset`.
+    """
+    if uri is None:
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='cex-bench-', suffix='.db')
+            os.close(fd)
+        uri = 'sqlite:///' + path
+    os.environ['CEX_DATABASE_URI'] = uri
+    import app
+    return app
+
+
+def reset(app):
+    """Drop every table and rebuild an empty schema with the default pairs, empty books, no candles
+    and no cached users."""
+    with app.app.app_context():
+        app.db.drop_all()
+        app.db.create_all()
+        app.load_pairs()
+        app.load_books()
+        app.load_all_candles()
+        app.user_contexts.clear()
+
+
+def seed_users(app, count, balances, quote_balance=1e9):
+    """Insert `count` users holding `balances` ({currency: amount}) each.
+
+    The quote currency of every pair in `balances` is funded with
+    `quote_balance` unless `balances` names it, so the users can buy.
+    """
+    from money import to_units
+    db = app.db
+    balances = dict(balances)
+    for currency in list(balances):
+        balances.setdefault(app.pairs.pair(currency).quote, quote_balance)
+    users = [{"id": i, "email": 'bench%d@example.com' % i, "password": 'x'}
+             for i in range(1, count + 1)]
+    db.session.execute(db.insert(app.User), users)
+    db.session.execute(db.insert(app.Wallet), [
+        {"user_id": user["id"], "currency": currency, "balance": to_units(balance, currency)}
+        for user in users for currency, balance in balances.items()
+    ])
+    db.session.commit()
+    return [user["id"] for user in users]
+
+
+def seed_book(app, currency, count, user_ids, mid=100.0, spread=0.01, width=10.0, seed=1, status='active'):
+    """Insert `count` resting orders split evenly around `mid` without crossing.
+
+    With another `status` (e.g. 'filled') the rows are history instead.
+    """
+    from money import price_to_units, to_units
+    rng = random.Random(seed)
+    db = app.db
+    orders = []
+    for i in range(count):
+        order_type = 'buy' if i % 2 == 0 else 'sell'
+        offset = spread + rng.random() * width
+        price = round(mid - offset if order_type == 'buy' else mid + offset, 2)
+        orders.append({
+            "user_id": rng.choice(user_ids),
+            "currency": currency,
+            "amount": to_units(round(rng.uniform(0.1, 2.0), 4), currency),
+            "price": price_to_units(price),
+            "type": order_type,
+            "status": status
+        })
+    for start in range(0, len(orders), 10000):
+        db.session.execute(db.insert(app.Order), orders[start:start + 10000])
+    db.session.commit()
+
+
+def load_books(app):
+    """Rebuild the resident books and ledger and continue order ids after the seeded rows."""
+    db = app.db
+    app.load_books()
+    app.order_ids = itertools.count((db.session.query(db.func.max(app.Order.id)).scalar() or 0) + 1)
+
+
+def taker_stream(currency, count, user_ids, mid=100.0, reach=0.05, seed=2):
+    """Crossing orders (as Order column values) that each sweep a few levels near the top of the book."""
+    from money import price_to_units, to_units
+    rng = random.Random(seed)
+    for _ in range(count):
+        order_type = rng.choice(['buy', 'sell'])
+        price = mid + reach if order_type == 'buy' else mid - reach
+        yield {
+            "user_id": rng.choice(user_ids),
+            "currency": currency,
+            "amount": to_units(round(rng.uniform(0.1, 2.0), 4), currency),
+            "price": price_to_units(round(price + rng.uniform(0, 0.2) * (1 if order_type == 'buy' else -1), 2)),
+            "type": order_type
+        }
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
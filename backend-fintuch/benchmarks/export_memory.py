@@ -0,0 +1,74 @@
+"""Export 1M transactions through /api/transactions/export and check memory stays flat.
+
+Exits non-zero if resident memory grows by more than --max-growth MB while
+streaming, or if any row is missing.
+
+    python benchmarks/export_memory.py --rows 1000000 --format ndjson
+"""
+import argparse
+import os
+import sys
+
+from common import Timer, load_app, reset, seed_users
+
+app = load_app()
+db, Transaction = app.db, app.Transaction
+
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def seed(user_id, count):
+    for start in range(0, count, 50000):
+        db.session.execute(db.insert(Transaction), [{
+            "user_id": user_id,
+            "currency": 'BTC',
+            "amount": 10 ** 7 + i,
+            "price": 10 ** 10,
+            "type": 'buy' if i % 2 else 'sell',
+            "date": '2024-11-%02d 12:00:00' % (1 + i % 28)
+        } for i in range(start, min(start + 50000, count))])
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--max-growth', type=float, default=50.0)
+    args = parser.parse_args()
+
+    client = app.app.test_client()
+    with app.app.app_context():
+        reset(app)
+        user_id = seed_users(app, 1, {"BTC": 1})[0]
+        seed(user_id, args.rows)
+        headers = {'Authorization': 'Bearer ' + app.create_access_token(identity=user_id)}
+
+    response = client.get('/api/transactions/export?format=%s' % args.format,
+                          headers=headers, buffered=False)
+    start = peak = rss_mb()
+    lines = size = 0
+    with Timer() as timer:
+        for chunk in response.response:
+            lines += chunk.count(b'\n')
+            size += len(chunk)
+            peak = max(peak, rss_mb())
+    response.close()
+
+    rows = lines - (1 if args.format == 'csv' else 0)
+    growth = peak - start
+    print('%d rows, %.1f MB exported in %.1fs (%.0f rows/s)' % (
+        rows, size / 2 ** 20, timer.elapsed, rows / timer.elapsed))
+    print('RSS at start %.1f MB, peak %.1f MB, growth %.1f MB' % (start, peak, growth))
+    if rows != args.rows or growth > args.max_growth:
+        print('FAIL')
+        return 1
+    print('ok')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
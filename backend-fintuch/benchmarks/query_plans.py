@@ -0,0 +1,123 @@
+"""Fail if a hot-path query falls back to a full table scan.
+
+Drives match_orders, get_orderbook, get_transactions, export_transactions,
+get_user_profile and retried client order ids, alone and in batches, through the Flask test client, captures every SELECT/UPDATE/DELETE they
+issue and runs EXPLAIN QUERY PLAN on it.
+
+    python benchmarks/query_plans.py
+"""
+import re
+import sys
+
+from sqlalchemy import event
+
+from common import load_app, load_books, reset, seed_book, seed_users
+
+app = load_app()
+db = app.db
+
+TABLES = {'users', 'wallets', 'orders', 'transactions', 'user_points'}
+TABLE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+
+def capture(statements):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            params = parameters[0] if executemany else parameters
+            statements.append((statement, params))
+    return before_cursor_execute
+
+
+def table_scans(conn, statement, params):
+    plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, params).fetchall()
+    scans = []
+    for row in plan:
+        match = TABLE_SCAN.match(row[-1])
+        if match and match.group(1) in TABLES:
+            scans.append(row[-1])
+    return scans
+
+
+def exercise(client, headers):
+    for order in [
+        {"currency": 'BTC', "amount": 1, "price": 120, "type": 'buy'},
+        {"currency": 'BTC', "amount": 1, "price": 80, "type": 'sell'},
+        {"currency": 'BTC', "amount": 1, "price": 99, "type": 'buy'},
+    ]:
+        response = client.post('/api/orderbook/create?wait=10', json=order, headers=headers)
+        assert response.status_code == 201, response.get_json()
+    yield 'match_orders'
+    app.engine.reload('BTC', app.active_orders('BTC'))
+    app.engine.load(app.active_orders())
+    yield 'engine reload'
+    assert client.get('/api/orderbook/BTC').status_code == 200
+    yield 'get_orderbook'
+    for query in ('', '?limit=1&cursor=1000', '?currency=BTC&type=buy', '?since=2024-01-01&until=2030-01-01'):
+        assert client.get('/api/transactions' + query, headers=headers).status_code == 200
+    yield 'get_transactions'
+    for query in ('?format=csv', '?currency=BTC'):
+        assert client.get('/api/transactions/export' + query, headers=headers).status_code == 200
+    yield 'export'
+    assert client.get('/api/user/profile', headers=headers).status_code == 200
+    yield 'get_user_profile'
+    for price in (1, 2):
+        response = client.post('/api/orderbook/create?wait=10', json={
+            "currency": 'BTC', "amount": 1, "price": price, "type": 'buy'}, headers=headers)
+        assert response.status_code == 201, response.get_json()
+    order_id = response.get_json()["order_id"]
+    assert client.patch('/api/orderbook/order/%d' % order_id, json={"amount": 0.5}, headers=headers).status_code == 200
+    assert client.patch('/api/orderbook/order/%d' % order_id, json={"price": 3}, headers=headers).status_code == 200
+    yield 'amend'
+    assert client.delete('/api/orderbook/order/%d' % order_id, headers=headers).status_code == 200
+    assert client.delete('/api/orderbook/orders', headers=headers).status_code == 200
+    yield 'cancel'
+    order = {"currency": 'BTC', "amount": 1, "price": 1, "type": 'buy', "client_order_id": 'plan-1'}
+    assert client.post('/api/orderbook/create?wait=10', json=order, headers=headers).status_code == 201
+    app.client_orders.clear()
+    assert client.post('/api/orderbook/create?wait=10', json=order, headers=headers).get_json()["duplicate"]
+    yield 'client order id'
+    batch = {"orders": [order, dict(order, client_order_id='plan-2')]}
+    app.client_orders.clear()
+    results = client.post('/api/orderbook/batch', json=batch, headers=headers).get_json()["results"]
+    assert results[0]["duplicate"] and not results[1].get("duplicate"), results
+    yield 'batch client order ids'
+
+
+def main():
+    client = app.app.test_client()
+    with app.app.app_context():
+        reset(app)
+        user_ids = seed_users(app, 50, {"BTC": 1e6})
+        seed_book(app, 'BTC', 2000, user_ids)
+        load_books(app)
+        token = app.create_access_token(identity=user_ids[0])
+        headers = {'Authorization': 'Bearer ' + token}
+
+        statements = []
+        listener = capture(statements)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        captured = {}
+        try:
+            for name in exercise(client, headers):
+                captured[name] = statements[:]
+                del statements[:]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        failures = 0
+        with db.engine.connect() as conn:
+            for name, queries in captured.items():
+                for statement, params in queries:
+                    scans = table_scans(conn, statement, params)
+                    status = 'FAIL' if scans else 'ok'
+                    failures += bool(scans)
+                    print('%-4s %-16s %s' % (status, name, ' '.join(statement.split())[:110]))
+                    for scan in scans:
+                        print('       -> %s' % scan)
+
+    print('%d queries, %d table scans' % (sum(map(len, captured.values())), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""OHLCV candles and rolling 24h tickers built from trades as they settle.
+
+A candle is [start, open, high, low, close, volume], prices and volume in
+integer units. Starts are seconds on the server's wall clock, the same
+naive local time transactions are dated with, so candles backfilled from
+the transactions table and live ones land in the same buckets.
+"""
+import calendar
+import threading
+from collections import deque
+from datetime import datetime
+
+INTERVALS = {'1m': 60, '5m': 300, '1h': 3600, '1d': 86400}
+TICKER_WINDOW = 86400
+
+
+def wall_clock(moment=None):
+    return calendar.timegm((moment or datetime.now()).timetuple())
+
+
+def _merge(candle, high, low, close, volume):
+    candle[2] = max(candle[2], high)
+    candle[3] = min(candle[3], low)
+    candle[4] = close
+    candle[5] += volume
+
+
+def rollup(minutes):
+    """(interval seconds, candle) for every interval, from 1m candles sorted by start."""
+    open_candles = {}
+    for start, open, high, low, close, volume in minutes:
+        for seconds in INTERVALS.values():
+            bucket = start - start % seconds
+            candle = open_candles.get(seconds)
+            if candle is not None and candle[0] == bucket:
+                _merge(candle, high, low, close, volume)
+                continue
+            if candle is not None:
+                yield seconds, candle
+            open_candles[seconds] = [bucket, open, high, low, close, volume]
+    for seconds, candle in open_candles.items():
+        yield seconds, candle
+
+
+class CandleStore:
+    """The newest `capacity` candles of every currency and interval.
+
+    Each series is a ring buffer. Candles changed since the last
+    `take_changes` are tracked so their owner can write just those.
+    """
+
+    def __init__(self, capacity=1440):
+        self.capacity = capacity
+        self.series = {}
+        self.created = {}
+        self.updated = {}
+        self.tickers = {}
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def _series(self, currency, seconds):
+        series = self.series.get((currency, seconds))
+        if series is None:
+            series = self.series[(currency, seconds)] = deque(maxlen=self.capacity)
+        return series
+
+    def clear(self):
+        with self._lock:
+            self.series = {}
+            self.created = {}
+            self.updated = {}
+            self.tickers = {}
+
+    def currencies(self):
+        return sorted({currency for currency, seconds in self.series})
+
+    def load(self, currency, rows):
+        """Replace the currency's candles with `rows` of (interval seconds, candle), oldest first."""
+        with self._lock:
+            for seconds in INTERVALS.values():
+                self.series.pop((currency, seconds), None)
+            for seconds, candle in rows:
+                self._series(currency, seconds).append(list(candle))
+            self.created.pop(currency, None)
+            self.updated.pop(currency, None)
+            self.versions[currency] = self.versions.get(currency, 0) + 1
+
+    def refresh(self, currency, seconds, rows):
+        """Overlay stored candles from the newest one held onwards; see `latest`."""
+        with self._lock:
+            series = self._series(currency, seconds)
+            for candle in rows:
+                if series and series[-1][0] == candle[0]:
+                    series[-1] = list(candle)
+                elif not series or series[-1][0] < candle[0]:
+                    series.append(list(candle))
+            self.versions[currency] = self.versions.get(currency, 0) + 1
+
+    def latest(self, currency, seconds):
+        series = self.series.get((currency, seconds))
+        return series[-1][0] if series else None
+
+    def add_trades(self, currency, trades, at):
+        """Fold (price, amount) trades made at wall-clock second `at` into every interval."""
+        with self._lock:
+            created = self.created.setdefault(currency, {})
+            updated = self.updated.setdefault(currency, {})
+            for seconds in INTERVALS.values():
+                series = self._series(currency, seconds)
+                bucket = at - at % seconds
+                for price, amount in trades:
+                    # a clock stepping back folds into the newest candle
+                    if series and series[-1][0] >= bucket:
+                        candle = series[-1]
+                        _merge(candle, price, price, price, amount)
+                        if (seconds, candle[0]) not in created:
+                            updated[(seconds, candle[0])] = candle
+                    else:
+                        candle = [bucket, price, price, price, price, amount]
+                        series.append(candle)
+                        created[(seconds, bucket)] = candle
+            self.versions[currency] = self.versions.get(currency, 0) + 1
+
+    def take_changes(self, currency):
+        """(created, updated) lists of (interval seconds, candle copy) since the last call."""
+        with self._lock:
+            created = self.created.pop(currency, {})
+            updated = self.updated.pop(currency, {})
+            return ([(seconds, list(candle)) for (seconds, start), candle in created.items()],
+                    [(seconds, list(candle)) for (seconds, start), candle in updated.items()])
+
+    def candles(self, currency, seconds, limit, since=None):
+        """Up to `limit` newest candles, oldest first, optionally only those starting at `since` or later."""
+        with self._lock:
+            series = self.series.get((currency, seconds), ())
+            result = []
+            for candle in reversed(series):
+                if len(result) >= limit or (since is not None and candle[0] < since):
+                    break
+                result.append(list(candle))
+        result.reverse()
+        return result
+
+    def ticker(self, currency, now):
+        """Last price and the high, low, volume and change of the 1m candles in the last 24h.
+
+        None for a currency that never traded. Cached until the next trade
+        or the next minute.
+        """
+        key = (self.versions.get(currency, 0), now - now % 60)
+        cached = self.tickers.get(currency)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with self._lock:
+            series = self.series.get((currency, INTERVALS['1m']))
+            if not series:
+                return None
+            last = series[-1][4]
+            high = low = open = None
+            volume = 0
+            for candle in reversed(series):
+                if candle[0] <= now - TICKER_WINDOW:
+                    break
+                high = candle[2] if high is None else max(high, candle[2])
+                low = candle[3] if low is None else min(low, candle[3])
+                open = candle[1]
+                volume += candle[5]
+        ticker = {"last": last, "high": high, "low": low, "volume": volume,
+                  "open": open, "change": last - open if open is not None else 0}
+        self.tickers[currency] = (key, ticker)
+        return ticker
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ClientOrderIndex:
+    """(user id, client order id) -> the ticket of the order first submitted under it.
+
+    Retries of a submission find the original ticket here instead of
+    queuing the order again. Entries live for `ttl` seconds and each user
+    keeps at most `per_user`, oldest dropped first, with at most `capacity`
+    users tracked. An order that outlives its entry is still found through
+    its row, which carries the client order id under a unique constraint.
+    """
+
+    def __init__(self, ttl=3600, per_user=1000, capacity=100000):
+        self.ttl = ttl
+        self.per_user = per_user
+        self.capacity = capacity
+        # user_id -> OrderedDict(client_order_id -> (expires, ticket)), least recently active user first
+        self.users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id, client_order_id):
+        """The ticket kept for the id, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self.users.get(user_id, {}).get(client_order_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            return None
+
+    def claim(self, user_id, client_order_id, submit):
+        """(ticket, True) after running `submit()` for a new id, (original ticket, False) for a retry.
+
+        Runs under the index's lock, so concurrent retries submit once;
+        nothing is kept if `submit` raises.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = self.users.get(user_id)
+            if entries is not None:
+                entry = entries.get(client_order_id)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    return entry[1], False
+            self.misses += 1
+            ticket = submit()
+            self._keep(user_id, {client_order_id: ticket}, now)
+            return ticket, True
+
+    def claim_all(self, user_id, client_order_ids, submit):
+        """{client order id: (ticket, created)} for a batch of ids.
+
+        `submit(new_ids)` is run with the ids not seen before, possibly
+        none, since a batch may have other entries to queue, and returns
+        their tickets by id; retried ids get their original tickets. Runs
+        under the index's lock like `claim`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = self.users.get(user_id, {})
+            claimed = {}
+            for client_order_id in client_order_ids:
+                entry = entries.get(client_order_id)
+                if entry is not None and entry[0] > now:
+                    claimed[client_order_id] = (entry[1], False)
+            new_ids = [client_order_id for client_order_id in client_order_ids if client_order_id not in claimed]
+            self.hits += len(claimed)
+            self.misses += len(new_ids)
+            tickets = submit(new_ids)
+            if new_ids:
+                self._keep(user_id, tickets, now)
+            claimed.update((client_order_id, (tickets[client_order_id], True)) for client_order_id in new_ids)
+            return claimed
+
+    def _keep(self, user_id, tickets, now):
+        entries = self.users.get(user_id)
+        if entries is None:
+            entries = self.users[user_id] = OrderedDict()
+        self.users.move_to_end(user_id)
+        for client_order_id, ticket in tickets.items():
+            entries.pop(client_order_id, None)
+            entries[client_order_id] = (now + self.ttl, ticket)
+        while entries and (len(entries) > self.per_user or next(iter(entries.values()))[0] <= now):
+            entries.popitem(last=False)
+        while len(self.users) > self.capacity:
+            self.users.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.users.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = sum(map(len, self.users.values()))
+        return {"users": len(self.users), "entries": entries, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,288 @@
+import multiprocessing
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+
+
+# status of an item `process` passes on to another shard as (currency, item)
+FORWARDED = 'forwarded'
+
+
+class OrderRejected(Exception):
+    """Raised by `process` for orders refused for a reason the client may see."""
+
+
+class OrderTicket:
+    """What the API knows about a submitted order while it waits for the matcher."""
+
+    __slots__ = ('order_id', 'user_id', 'currency', 'status', 'result', 'error', 'done')
+
+    def __init__(self, order_id, user_id, currency):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.currency = currency
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout):
+        return self.done.wait(timeout)
+
+
+class BatchEntryTicket:
+    """One order of a batch command, read like an OrderTicket: its outcome is entry `index` of the batch's results."""
+
+    __slots__ = ('batch', 'index', 'order_id')
+
+    def __init__(self, batch, index, order_id):
+        self.batch = batch
+        self.index = index
+        self.order_id = order_id
+
+    @property
+    def done(self):
+        return self.batch.done
+
+    @property
+    def status(self):
+        if self.batch.result:
+            return self.batch.result[self.index][0]
+        return self.batch.status
+
+    @property
+    def error(self):
+        if self.batch.result:
+            return self.batch.result[self.index][1]
+        return self.batch.error
+
+    def wait(self, timeout):
+        return self.batch.wait(timeout)
+
+
+def _run_order(process, currency, item):
+    """(status, result, error) for one order, as the client will see them."""
+    try:
+        outcome = process(currency, item)
+    except OrderRejected as e:
+        return 'rejected', None, str(e)
+    except Exception:
+        return 'rejected', None, 'Internal server error'
+    if isinstance(outcome, tuple):
+        return outcome[0], outcome[1], None
+    return outcome, None, None
+
+
+class OrderIngest:
+    """Bounded per-currency queues, each drained by a single matching thread.
+
+    `process(currency, item)` runs on the shard's thread and returns the
+    order's final status, or a (status, result) pair; an exception marks the order rejected, and only an
+    OrderRejected message is shown to the client. Tickets for the most
+    recent `max_tickets` orders are kept for status polling. `route(currency)`
+    names the shard of a currency (default: a shard per currency).
+
+    `process` may return (FORWARDED, (currency, item)) to hand the item on
+    to another shard under the same ticket, and shards queue work for each
+    other with `send`. Neither is refused when a queue is full: only
+    `submit` is bounded, so matchers waiting on each other cannot deadlock.
+    """
+
+    def __init__(self, process, max_pending=10000, max_tickets=100000, route=None):
+        self.process = process
+        self.max_pending = max_pending
+        self.max_tickets = max_tickets
+        self.route = route or str
+        self.shards = {}
+        self.tickets = OrderedDict()
+        self._lock = threading.Lock()
+        # items queued and not yet finished, forwarded ones included, for `join`
+        self.outstanding = 0
+        self.idle = threading.Condition()
+
+    def _shard(self, currency):
+        key = self.route(currency)
+        shard = self.shards.get(key)
+        if shard is None:
+            with self._lock:
+                shard = self.shards.get(key)
+                if shard is None:
+                    pending = queue.Queue()
+                    worker = threading.Thread(target=self._run, args=(pending,),
+                                              name='matcher-%s' % key, daemon=True)
+                    shard = self.shards[key] = (pending, worker)
+                    worker.start()
+        return shard
+
+    def submit(self, currency, order_id, user_id, item, via=None):
+        """Queue `item` and return its ticket; raises queue.Full when the shard is saturated.
+
+        With `via` the item goes to that currency's shard first, which
+        forwards it once it has done its part.
+        """
+        ticket = OrderTicket(order_id, user_id, currency)
+        with self._lock:
+            self.tickets[order_id] = ticket
+            while len(self.tickets) > self.max_tickets:
+                self.tickets.popitem(last=False)
+        try:
+            self._put(via or currency, ticket, item, bounded=True)
+        except queue.Full:
+            with self._lock:
+                self.tickets.pop(order_id, None)
+            raise
+        return ticket
+
+    def send(self, currency, item):
+        """Queue `item` for `currency`'s shard with no ticket and no bound, for shards handing each other work."""
+        self._put(currency, OrderTicket(None, None, currency), item)
+
+    def _put(self, currency, ticket, item, bounded=False):
+        pending, worker = self._shard(currency)
+        if bounded and pending.qsize() >= self.max_pending:
+            raise queue.Full
+        self._started()
+        pending.put((ticket, currency, item))
+
+    def _started(self):
+        with self.idle:
+            self.outstanding += 1
+
+    def _finished(self):
+        with self.idle:
+            self.outstanding -= 1
+            self.idle.notify_all()
+
+    def ticket(self, order_id):
+        with self._lock:
+            return self.tickets.get(order_id)
+
+    def pending(self):
+        return {key: shard[0].qsize() for key, shard in self.shards.items()}
+
+    def join(self):
+        """Wait until every queued item has run, including those the shards queued for each other."""
+        with self.idle:
+            self.idle.wait_for(lambda: self.outstanding == 0)
+
+    def _run(self, pending):
+        while True:
+            ticket, currency, item = pending.get()
+            try:
+                status, result, error = _run_order(self.process, currency, item)
+                if status == FORWARDED:
+                    self._put(result[0], ticket, result[1])
+                else:
+                    ticket.status, ticket.result, ticket.error = status, result, error
+                    ticket.done.set()
+            finally:
+                pending.task_done()
+                self._finished()
+
+
+class RemoteCalls:
+    """Stand-in for API-process objects inside a matching process.
+
+    Any method call is sent back to the API process, where the listener
+    runs the handler registered under the method's name.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.results.put(('call', name, args, kwargs))
+        return call
+
+
+def _serve_shard(process, initializer, inbox, results):
+    # runs in the matching process; FORWARDED outcomes go back to the API process, which routes them
+    if initializer is not None:
+        initializer(RemoteCalls(results))
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        order_id, currency, item = message
+        results.put(('done', order_id, currency) + _run_order(process, currency, item))
+
+
+class ShardedIngest(OrderIngest):
+    """Order queues drained by a pool of forked matching processes.
+
+    Each currency maps to one process by a stable hash of its route, so a
+    process owns the books of its currencies and is the only one matching
+    and settling their orders. `initializer(calls)` runs first in every
+    process; `calls` forwards method calls to `handlers` in this process,
+    and `calls.send(currency, item)` queues an item for another shard.
+    `completed` counts finished orders per currency, for keeping local
+    read copies of the books fresh.
+    """
+
+    def __init__(self, process, processes, initializer=None, handlers=None,
+                 max_pending=10000, max_tickets=100000, route=None):
+        super().__init__(process, max_pending, max_tickets, route)
+        context = multiprocessing.get_context('fork')
+        self.handlers = dict(handlers or {}, send=self.send)
+        self.completed = {}
+        self.results = context.Queue()
+        self.inboxes = [context.Queue() for _ in range(processes)]
+        self.workers = [context.Process(target=_serve_shard, name='matcher-%d' % shard, daemon=True,
+                                        args=(process, initializer, inbox, self.results))
+                        for shard, inbox in enumerate(self.inboxes)]
+        for worker in self.workers:
+            worker.start()
+        self.listener = threading.Thread(target=self._listen, name='matcher-results', daemon=True)
+        self.listener.start()
+
+    def shard_of(self, currency):
+        return zlib.crc32(self.route(currency).encode()) % len(self.inboxes)
+
+    def _put(self, currency, ticket, item, bounded=False):
+        inbox = self.inboxes[self.shard_of(currency)]
+        if bounded and inbox.qsize() >= self.max_pending:
+            raise queue.Full
+        self._started()
+        inbox.put((ticket.order_id, currency, item))
+
+    def pending(self):
+        return {shard: inbox.qsize() for shard, inbox in enumerate(self.inboxes)}
+
+    def close(self):
+        """Let every process finish its work, then stop the pool."""
+        self.join()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.listener.join()
+
+    def _listen(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                return
+            if message[0] == 'call':
+                name, args, kwargs = message[1:]
+                try:
+                    self.handlers[name](*args, **kwargs)
+                except Exception:
+                    # a broken handler must not stop tickets from resolving
+                    pass
+                continue
+            order_id, currency, status, result, error = message[1:]
+            if status == FORWARDED:
+                ticket = self.ticket(order_id) or OrderTicket(order_id, None, currency)
+                self._put(result[0], ticket, result[1])
+            else:
+                self.completed[currency] = self.completed.get(currency, 0) + 1
+                ticket = self.ticket(order_id)
+                if ticket is not None:
+                    ticket.status = status
+                    ticket.result = result
+                    ticket.error = error
+                    ticket.done.set()
+            self._finished()
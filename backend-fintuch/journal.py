@@ -0,0 +1,239 @@
+"""Append-only journal of order book events, with per-book snapshots.
+
+Every currency has its own files in the journal directory: `<name>.snap`
+holds the book's resting orders, in book order, as of its last snapshot,
+and `<name>.<generation>.log` the events since. Both are runs of fixed-size
+little-endian records, so a file can be memory-mapped and unpacked in one
+pass.
+
+The records of one database commit are appended as one batch ahead of it
+and, unless fsync is turned off, are on disk before the commit starts, so
+no committed change is missing from the journal. Each batch ends with the
+book's next batch sequence number, which the caller commits with the
+batch. A batch whose commit then fails or never happens is in the journal
+but not in the database, and a batch lost from an unsynced tail is in the
+database only: either way the recovered sequence differs from the one the
+database has, which is how callers tell a book to rebuild from the
+database, which stays authoritative.
+"""
+import mmap
+import os
+import struct
+import zlib
+
+from orderbook import BookOrder, OrderBook, from_timestamp, to_timestamp
+
+ACCEPT, FILL, CANCEL, REDUCE, MARK = 1, 2, 3, 4, 5
+
+# flags
+END_OF_BATCH = 1
+SELL = 2
+
+# kind, flags, order id (maker id for fills), user id (taker id for fills),
+# price, amount, created_at as a UTC timestamp; then a crc32 of those bytes
+BODY = struct.Struct('<BB2xqqqqd')
+RECORD = struct.Struct('<BB2xqqqqdI')
+# magic, generation, batch sequence, order count, crc32 of the records that follow
+SNAPSHOT_HEADER = struct.Struct('<8sQQQI')
+SNAPSHOT_MAGIC = b'CEXSNAP2'
+
+
+def _pack(kind, flags, a, b, price, amount, created_at=0.0):
+    body = BODY.pack(kind, flags, a, b, price, amount, created_at)
+    return body + struct.pack('<I', zlib.crc32(body))
+
+
+def _accept(order, amount):
+    return (ACCEPT, SELL if order.type == 'sell' else 0, order.id, order.user_id,
+            order.price, amount, to_timestamp(order.created_at))
+
+
+def order_records(taker, amount, fills):
+    """Records for a taker accepted for `amount` and the fills it traded."""
+    records = [_accept(taker, amount)]
+    records += [(FILL, 0, fill.maker.id, taker.id, fill.price, fill.amount) for fill in fills]
+    return records
+
+
+def cancel_records(orders):
+    return [(CANCEL, 0, order.id, order.user_id, order.price, order.amount) for order in orders]
+
+
+def reduce_records(order, amount):
+    """Records for `amount` taken off a resting order that keeps its place."""
+    return [(REDUCE, 0, order.id, order.user_id, order.price, amount)]
+
+
+def _add(book, order_id, user_id, flags, price, amount, created_at):
+    book.add(BookOrder(order_id, user_id, book.currency, 'sell' if flags & SELL else 'buy',
+                       price, amount, from_timestamp(created_at)))
+
+
+def _apply(book, kind, flags, a, b, price, amount, created_at):
+    if kind == ACCEPT:
+        _add(book, a, b, flags, price, amount, created_at)
+    elif kind == FILL:
+        book.reduce(a, amount)
+        book.reduce(b, amount)
+    elif kind == CANCEL:
+        book.cancel(a)
+    elif kind == REDUCE:
+        book.reduce(a, amount)
+    # a MARK only carries the batch's sequence number, which replay reads itself
+
+
+class BookJournal:
+    """Event journal and snapshots for the resident order books.
+
+    Each currency must have a single writer at a time, which is what the
+    per-currency engine locks and matching shards already guarantee. A
+    book is snapshotted, and its log restarted, every `snapshot_every`
+    records. With `fsync` every batch is on disk before `append` returns.
+    `sequences` holds the sequence number of each book's last batch.
+    """
+
+    def __init__(self, directory, snapshot_every=100000, fsync=True):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.generations = {}
+        self.records = {}
+        self.sequences = {}
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, currency, suffix):
+        # currencies are client supplied, so they never become file names as is
+        return os.path.join(self.directory, currency.encode().hex() + suffix)
+
+    def _log_path(self, currency, generation):
+        return self._path(currency, '.%d.log' % generation)
+
+    def _file(self, currency):
+        fd = self.files.get(currency)
+        if fd is None:
+            path = self._log_path(currency, self.generations.get(currency, 0))
+            fd = self.files[currency] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return fd
+
+    def append(self, book, records):
+        """Write `records` as one batch and return its sequence number; replay ignores a batch cut short by a crash.
+
+        Nothing is written for no records, and None is returned.
+        """
+        if not records:
+            return None
+        sequence = self.sequences[book.currency] = self.sequences.get(book.currency, 0) + 1
+        records = records + [(MARK, 0, sequence, 0, 0, 0)]
+        last = len(records) - 1
+        data = b''.join(_pack(kind, flags | (END_OF_BATCH if i == last else 0), *fields)
+                        for i, (kind, flags, *fields) in enumerate(records))
+        fd = self._file(book.currency)
+        os.write(fd, data)
+        if self.fsync:
+            os.fsync(fd)
+        count = self.records[book.currency] = self.records.get(book.currency, 0) + len(records)
+        if count >= self.snapshot_every:
+            self.snapshot(book)
+        return sequence
+
+    def snapshot(self, book):
+        """Write `book` as the currency's new base and start an empty log after it."""
+        currency = book.currency
+        old = self.generations.get(currency, 0)
+        generation = old + 1
+        orders = list(book.resting())
+        payload = b''.join(_pack(*_accept(order, order.amount)) for order in orders)
+        path = self._path(currency, '.snap')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation, self.sequences.get(currency, 0), len(orders),
+                                         zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        fd = self.files.pop(currency, None)
+        if fd is not None:
+            os.close(fd)
+        self.generations[currency] = generation
+        self.records[currency] = 0
+        # the new generation's log may be left over from a book whose
+        # snapshot could not be read, and must not be replayed onto this one
+        for stale in (old, generation):
+            if os.path.exists(self._log_path(currency, stale)):
+                os.remove(self._log_path(currency, stale))
+
+    def currencies(self):
+        found = set()
+        for name in os.listdir(self.directory):
+            stem, _, suffix = name.partition('.')
+            if suffix == 'snap' or suffix.endswith('.log'):
+                found.add(bytes.fromhex(stem).decode())
+        return found
+
+    def recover(self):
+        """Books rebuilt from each currency's snapshot plus its log tail, with their `sequences`.
+
+        A currency whose snapshot cannot be read, e.g. one written by an
+        older version, is left out.
+        """
+        books = {}
+        for currency in self.currencies():
+            book = OrderBook(currency)
+            try:
+                generation, sequence = self._load_snapshot(book)
+            except ValueError:
+                continue
+            books[currency] = book
+            self.generations[currency] = generation
+            self.records[currency], self.sequences[currency] = self._replay(
+                book, self._log_path(currency, generation), sequence)
+        return books
+
+    def _load_snapshot(self, book):
+        path = self._path(book.currency, '.snap')
+        if not os.path.exists(path):
+            return 0, 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or len(data) < SNAPSHOT_HEADER.size:
+                raise ValueError('unreadable snapshot %s' % path)
+            magic, generation, sequence, count, crc = SNAPSHOT_HEADER.unpack_from(data)
+            payload = memoryview(data)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + count * RECORD.size]
+            try:
+                if magic != SNAPSHOT_MAGIC or len(payload) != count * RECORD.size or zlib.crc32(payload) != crc:
+                    raise ValueError('corrupt snapshot %s' % path)
+                for kind, flags, order_id, user_id, price, amount, created_at, _ in RECORD.iter_unpack(payload):
+                    _add(book, order_id, user_id, flags, price, amount, created_at)
+            finally:
+                payload.release()
+        return generation, sequence
+
+    def _replay(self, book, path, sequence):
+        """Apply every complete batch in the log and return (records applied, last sequence); a torn tail is cut off."""
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return 0, sequence
+        applied = end = 0
+        with open(path, 'r+b') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                view = memoryview(data)
+                batch = []
+                try:
+                    for offset in range(0, len(view) - RECORD.size + 1, RECORD.size):
+                        record = RECORD.unpack_from(view, offset)
+                        if zlib.crc32(view[offset:offset + BODY.size]) != record[-1]:
+                            break
+                        batch.append(record)
+                        if record[1] & END_OF_BATCH:
+                            for kind, flags, a, b, price, amount, created_at, _ in batch:
+                                _apply(book, kind, flags, a, b, price, amount, created_at)
+                                if kind == MARK:
+                                    sequence = a
+                            applied += len(batch)
+                            end = offset + RECORD.size
+                            batch = []
+                finally:
+                    view.release()
+            if end < os.fstat(f.fileno()).st_size:
+                f.truncate(end)
+        return applied, sequence
@@ -0,0 +1,147 @@
+import threading
+from bisect import bisect_left, insort
+
+
+class RankedList:
+    """Sorted list of ints with O(log n) positional lookups.
+
+    Values live in sorted buckets of bounded size; a Fenwick tree over the
+    bucket lengths turns "how many values are smaller than x" into a
+    bucket bisect plus a prefix sum.
+    """
+
+    LOAD = 1000
+
+    def __init__(self, values=()):
+        values = sorted(values)
+        self._lists = [values[i:i + self.LOAD] for i in range(0, len(values), self.LOAD)]
+        self._maxes = [bucket[-1] for bucket in self._lists]
+        self._len = len(values)
+        self._build_tree()
+
+    def __len__(self):
+        return self._len
+
+    def _build_tree(self):
+        tree = [0] + [len(bucket) for bucket in self._lists]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, pos, delta):
+        i = pos + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, pos):
+        """Number of values in the buckets before `pos`."""
+        total, i = 0, pos
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, value):
+        if not self._lists:
+            self._lists.append([value])
+            self._maxes.append(value)
+            self._len = 1
+            self._build_tree()
+            return
+        pos = min(bisect_left(self._maxes, value), len(self._lists) - 1)
+        bucket = self._lists[pos]
+        insort(bucket, value)
+        self._maxes[pos] = bucket[-1]
+        self._len += 1
+        if len(bucket) > 2 * self.LOAD:
+            self._lists[pos + 1:pos + 1] = [bucket[self.LOAD:]]
+            del bucket[self.LOAD:]
+            self._maxes[pos:pos + 1] = [bucket[-1], self._lists[pos + 1][-1]]
+            self._build_tree()
+        else:
+            self._tree_add(pos, 1)
+
+    def remove(self, value):
+        pos = bisect_left(self._maxes, value)
+        bucket = self._lists[pos] if pos < len(self._lists) else []
+        i = bisect_left(bucket, value)
+        if i == len(bucket) or bucket[i] != value:
+            raise ValueError('%r not in list' % value)
+        del bucket[i]
+        self._len -= 1
+        if bucket:
+            self._maxes[pos] = bucket[-1]
+            self._tree_add(pos, -1)
+        else:
+            del self._lists[pos]
+            del self._maxes[pos]
+            self._build_tree()
+
+    def count_below(self, value):
+        """Number of values strictly smaller than `value`."""
+        pos = bisect_left(self._maxes, value)
+        if pos == len(self._lists):
+            return self._len
+        return self._prefix(pos) + bisect_left(self._lists[pos], value)
+
+    def __iter__(self):
+        for bucket in self._lists:
+            yield from bucket
+
+
+class Leaderboard:
+    """Users ranked by points, kept in memory and updated as points are awarded.
+
+    Each user is one int key, (-points << 32) + user_id, so ascending key
+    order is points descending with ties broken by user id. Ranks follow
+    SQL rank(): one plus the number of users with strictly more points.
+    """
+
+    def __init__(self):
+        self.points = {}
+        self.ranking = RankedList()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(user_id, points):
+        return (-points << 32) + user_id
+
+    def load(self, rows):
+        """Rebuild from (user_id, points) rows; missing points count as 0."""
+        with self._lock:
+            self.points = {user_id: points or 0 for user_id, points in rows}
+            self.ranking = RankedList(self._key(user_id, points) for user_id, points in self.points.items())
+
+    def award(self, user_id, points):
+        with self._lock:
+            old = self.points.get(user_id)
+            if old is not None:
+                self.ranking.remove(self._key(user_id, old))
+            new = self.points[user_id] = (old or 0) + points
+            self.ranking.add(self._key(user_id, new))
+
+    def rank(self, user_id):
+        with self._lock:
+            points = self.points.get(user_id)
+            if points is None:
+                return 0
+            return self.ranking.count_below(-points << 32) + 1
+
+    def top(self, limit):
+        """[(user_id, points, rank)] for the best `limit` users."""
+        result = []
+        with self._lock:
+            for key in self.ranking:
+                if len(result) == limit:
+                    break
+                user_id = key & 0xFFFFFFFF
+                points = -(key >> 32)
+                if result and result[-1][1] == points:
+                    rank = result[-1][2]
+                else:
+                    rank = len(result) + 1
+                result.append((user_id, points, rank))
+        return result
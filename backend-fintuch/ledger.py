@@ -0,0 +1,91 @@
+# wallets loaded per query, below SQLite's limit on bound parameters
+FETCH_CHUNK = 10000
+
+
+class BalanceLedger:
+    """Wallet balances and holds kept in memory, per currency.
+
+    A balance mirrors wallets.balance and is read from the database the first
+    time the wallet is needed; None marks a user without a wallet row. The
+    held part backs the user's resting orders, the base currency of sells
+    and the quote currency of buys, and is rebuilt from the books rather
+    than stored. Each currency's entries have a single writer, the matcher
+    of the same name: it reserves what orders on other books will spend in
+    its currency and applies the transfers they settle. It applies changes
+    here as it writes them to the database, so later orders of the same
+    batch see them, and reverts them if the batch is rolled back.
+    """
+
+    def __init__(self, load, pair):
+        # load(currency, user_ids) -> {user_id: balance} for existing wallets
+        self.load = load
+        # pair(symbol) -> the book's Pair, for its currencies and costs
+        self.pair = pair
+        self.balances = {}
+        self.holds = {}
+
+    def fetch(self, currency, user_ids):
+        """Make sure the wallets of `user_ids` are cached, with one load for the missing ones."""
+        balances = self.balances.setdefault(currency, {})
+        missing = [user_id for user_id in user_ids if user_id not in balances]
+        for start in range(0, len(missing), FETCH_CHUNK):
+            chunk = missing[start:start + FETCH_CHUNK]
+            loaded = self.load(currency, chunk)
+            for user_id in chunk:
+                balances[user_id] = loaded.get(user_id)
+
+    def has_wallet(self, user_id, currency):
+        self.fetch(currency, [user_id])
+        return self.balances[currency][user_id] is not None
+
+    def balance(self, user_id, currency):
+        self.fetch(currency, [user_id])
+        return self.balances[currency][user_id] or 0
+
+    def held(self, user_id, currency):
+        return self.holds.get(currency, {}).get(user_id, 0)
+
+    def available(self, user_id, currency):
+        return self.balance(user_id, currency) - self.held(user_id, currency)
+
+    def apply(self, currency, balances=None, holds=None):
+        """Add committed balance and hold deltas, both {user_id: delta}."""
+        cached = self.balances.setdefault(currency, {})
+        for user_id, delta in (balances or {}).items():
+            cached[user_id] = (cached.get(user_id) or 0) + delta
+        held = self.holds.setdefault(currency, {})
+        for user_id, delta in (holds or {}).items():
+            amount = held.get(user_id, 0) + delta
+            if amount:
+                held[user_id] = amount
+            else:
+                held.pop(user_id, None)
+
+    def hold_books(self, books, currencies=None):
+        """Recompute the holds of `currencies` (default: all) from the resting orders of `books`."""
+        holds = {}
+        for book in books:
+            pair = self.pair(book.currency)
+            if currencies is None or pair.base in currencies:
+                held = holds.setdefault(pair.base, {})
+                for order in book.resting('sell'):
+                    held[order.user_id] = held.get(order.user_id, 0) + order.amount
+            if currencies is None or pair.quote in currencies:
+                held = holds.setdefault(pair.quote, {})
+                for order in book.resting('buy'):
+                    held[order.user_id] = held.get(order.user_id, 0) + pair.cost(order.price, order.amount)
+        for currency in currencies or ():
+            self.holds[currency] = {}
+        for currency, held in holds.items():
+            self.holds[currency] = {user_id: amount for user_id, amount in held.items() if amount}
+
+    def revert(self, changes):
+        """Undo the hold deltas of a rolled back batch, [(currency, holds)], and reload its currencies' balances."""
+        for currency, holds in changes:
+            self.apply(currency, holds={user_id: -delta for user_id, delta in holds.items()})
+            self.balances.pop(currency, None)
+
+    def reset(self, books):
+        self.balances = {}
+        self.holds = {}
+        self.hold_books(books)
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import deque
+
+
+class Subscriber:
+    """Bounded event queue for one streaming client.
+
+    Publishing never blocks: when the queue is full it is dropped and the
+    subscriber is flagged as lagging, so the consumer resyncs from a fresh
+    snapshot instead of slowing down matching.
+    """
+
+    def __init__(self, currency, max_pending):
+        self.currency = currency
+        self.max_pending = max_pending
+        self.events = deque()
+        self.lagging = False
+        self.dropped = 0
+        self._ready = threading.Condition(threading.Lock())
+
+    def push(self, event):
+        with self._ready:
+            if len(self.events) >= self.max_pending:
+                self.dropped += len(self.events)
+                self.events.clear()
+                self.lagging = True
+            else:
+                self.events.append(event)
+            self._ready.notify()
+
+    def resync(self):
+        with self._ready:
+            self.events.clear()
+            self.lagging = True
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Wait for events; returns (lagging, events) and resets both."""
+        with self._ready:
+            if not self.events and not self.lagging:
+                self._ready.wait(timeout)
+            lagging, self.lagging = self.lagging, False
+            events = list(self.events)
+            self.events.clear()
+        return lagging, events
+
+
+class MarketDataFeed:
+    """Fan-out of per-currency book diffs and trades with sequence numbers."""
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self.subscribers = {}
+        self.seq = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, currency):
+        subscriber = Subscriber(currency, self.max_pending)
+        with self._lock:
+            self.subscribers.setdefault(currency, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.get(subscriber.currency, set()).discard(subscriber)
+
+    def publish(self, currency, type, **data):
+        """Stamp an event with the next sequence number and hand it to every subscriber."""
+        seq = self.seq[currency] = self.seq.get(currency, 0) + 1
+        event = dict(data, type=type, seq=seq, ts=time.time())
+        with self._lock:
+            subscribers = list(self.subscribers.get(currency, ()))
+        for subscriber in subscribers:
+            subscriber.push(event)
+        return event
+
+    def resync(self, currency):
+        with self._lock:
+            subscribers = list(self.subscribers.get(currency, ()))
+        for subscriber in subscribers:
+            subscriber.resync()
@@ -0,0 +1,209 @@
+"""Counters and histograms for the hot paths, in Prometheus text format.
+
+Observations are a dict update under one lock, cheap enough for every
+request and every matcher stage. A matching process forwards what it
+observed to the API process after each command, so /metrics covers them
+all. Opt-in: a sampling profiler that writes the stacks of slow requests
+in the folded format flame graph tools read.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNTS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe('cex_stage_seconds', time.perf_counter() - self.started, stage=self.stage)
+
+
+class Metrics:
+    """Counters and histograms keyed by name and labels.
+
+    Histograms named *_seconds use time buckets, others count buckets.
+    `forward_to(sink)` turns this into a buffer whose observations `flush`
+    hands to `sink`, for another process's `merge`.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.pending = None
+        self.sink = None
+        self._queries = threading.local()
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        if self.pending is not None:
+            self.pending.append(('inc', key, amount))
+            return
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        if self.pending is not None:
+            self.pending.append(('observe', key, value))
+            return
+        self._observe(key, value)
+
+    def _observe(self, key, value):
+        buckets = SECONDS if key[0].endswith('_seconds') else COUNTS
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def span(self, stage):
+        """Context manager timing one stage into cex_stage_seconds."""
+        return _Span(self, stage)
+
+    def error(self, where, exception):
+        self.inc('cex_errors_total', where=where, type=type(exception).__name__)
+
+    def watch(self, engine):
+        """Count the SQL statements `engine` runs, per thread; see `take_queries`."""
+        from sqlalchemy import event
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count(*args):
+            self._queries.count = getattr(self._queries, 'count', 0) + 1
+
+    def take_queries(self):
+        """Statements run on this thread since the last call."""
+        count = getattr(self._queries, 'count', 0)
+        self._queries.count = 0
+        return count
+
+    def forward_to(self, sink):
+        self.sink = sink
+        self.pending = []
+
+    def flush(self):
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.sink(pending)
+
+    def merge(self, observations):
+        for kind, (name, labels), value in observations:
+            if kind == 'inc':
+                with self._lock:
+                    key = (name, labels)
+                    self.counters[key] = self.counters.get(key, 0) + value
+            else:
+                self._observe((name, labels), value)
+
+    def render(self, gauges=()):
+        """Exposition text; `gauges` adds (name, labels dict, value) samples read at scrape time."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+        lines, typed = [], set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+        for (name, labels), values in histograms:
+            declare(name, 'histogram')
+            buckets = SECONDS if name.endswith('_seconds') else COUNTS
+            cumulative = 0
+            for bound, count in zip(buckets, values):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', bound)]), cumulative))
+            cumulative += values[len(buckets)]
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', '+Inf')]), cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), values[-1]))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+        for name, labels, value in gauges:
+            declare(name, 'gauge')
+            lines.append('%s%s %s' % (name, _format_labels(_labels(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of requests in flight and keeps those of slow ones.
+
+    A daemon thread looks at every registered request thread each
+    `interval` seconds. A request that took `threshold` seconds or more
+    is written to `directory` as `stack;frames count` lines.
+    """
+
+    def __init__(self, directory, threshold, interval=0.005):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self.active = {}
+        self.sampler = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.sampler is None:
+            with self._lock:
+                if self.sampler is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self.sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+                    self.sampler.start()
+        self.active[threading.get_ident()] = {}
+
+    def finish(self, name, seconds):
+        """Stop sampling this thread's request; returns the file written, if it was slow."""
+        samples = self.active.pop(threading.get_ident(), None)
+        if not samples or seconds < self.threshold:
+            return None
+        path = os.path.join(self.directory, '%d-%s-%dms.folded' % (
+            time.time() * 1000, re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_'), seconds * 1000))
+        with open(path, 'w') as f:
+            for stack, count in sorted(samples.items()):
+                f.write('%s %d\n' % (stack, count))
+        return path
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, samples in list(self.active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    key = ';'.join(reversed(stack))
+                    samples[key] = samples.get(key, 0) + 1
@@ -0,0 +1,224 @@
+"""Schema changes for databases created before a model change.
+
+db.create_all() only creates missing tables, so anything that alters an
+existing table is a step here. Steps run once, in order, and the number of
+applied steps is recorded in the schema_migrations table.
+"""
+from sqlalchemy import inspect, text
+
+from money import DEFAULT_SCALE, PRICE_SCALE, SCALES, cost_units
+from pairs import default_pair, default_rows
+
+
+def dedupe_wallets(conn):
+    """Fold duplicate (user_id, currency) wallets into the oldest one."""
+    duplicates = conn.execute(text(
+        'SELECT user_id, currency, MIN(id), SUM(balance) FROM wallets '
+        'GROUP BY user_id, currency HAVING COUNT(*) > 1'
+    )).fetchall()
+    for user_id, currency, keep_id, balance in duplicates:
+        conn.execute(text('UPDATE wallets SET balance = :balance WHERE id = :id'),
+                     {"balance": balance, "id": keep_id})
+        conn.execute(text('DELETE FROM wallets WHERE user_id = :user_id AND currency = :currency AND id != :id'),
+                     {"user_id": user_id, "currency": currency, "id": keep_id})
+
+
+def add_hot_path_indexes(conn):
+    dedupe_wallets(conn)
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_wallets_user_currency ON wallets (user_id, currency)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_orders_book ON orders (currency, type, status, price)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_orders_status ON orders (status, currency)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_transactions_user_date ON transactions (user_id, date)'))
+
+
+def units_sql(column):
+    """SQL expression converting a float `column` to minor units of the row's currency."""
+    cases = ' '.join("WHEN '%s' THEN %d" % (currency, 10 ** places) for currency, places in SCALES.items())
+    return 'CAST(ROUND(%s * CASE currency %s ELSE %d END) AS INTEGER)' % (column, cases, 10 ** DEFAULT_SCALE)
+
+
+def price_sql(column):
+    return 'CAST(ROUND(%s * %d) AS INTEGER)' % (column, 10 ** PRICE_SCALE)
+
+
+FIXED_POINT_TABLES = [
+    ('wallets', """CREATE TABLE wallets_new (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        currency VARCHAR(10) NOT NULL,
+        balance BIGINT,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id)
+    )""", ['id', 'user_id', 'currency', units_sql('balance')], [
+        'CREATE UNIQUE INDEX uq_wallets_user_currency ON wallets (user_id, currency)',
+    ]),
+    ('transactions', """CREATE TABLE transactions_new (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        currency VARCHAR(10) NOT NULL,
+        amount BIGINT NOT NULL,
+        price BIGINT NOT NULL,
+        type VARCHAR(4) NOT NULL,
+        date VARCHAR(20) NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id)
+    )""", ['id', 'user_id', 'currency', units_sql('amount'), price_sql('price'), 'type', 'date'], [
+        'CREATE INDEX ix_transactions_user_date ON transactions (user_id, date)',
+    ]),
+    ('orders', """CREATE TABLE orders_new (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        currency VARCHAR(10) NOT NULL,
+        amount BIGINT NOT NULL,
+        price BIGINT NOT NULL,
+        type VARCHAR(4) NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id)
+    )""", ['id', 'user_id', 'currency', units_sql('amount'), price_sql('price'), 'type', 'status', 'created_at'], [
+        'CREATE INDEX ix_orders_book ON orders (currency, type, status, price)',
+        'CREATE INDEX ix_orders_status ON orders (status, currency)',
+    ]),
+]
+
+
+def fixed_point_amounts(conn):
+    """Rebuild the money tables with integer minor units instead of floats."""
+    for table, create, select, indexes in FIXED_POINT_TABLES:
+        conn.execute(text(create))
+        conn.execute(text('INSERT INTO %s_new SELECT %s FROM %s' % (table, ', '.join(select), table)))
+        conn.execute(text('DROP TABLE %s' % table))
+        conn.execute(text('ALTER TABLE %s_new RENAME TO %s' % (table, table)))
+        for index in indexes:
+            conn.execute(text(index))
+    # float dust left active orders that can never fill
+    conn.execute(text("UPDATE orders SET status = 'filled' WHERE status = 'active' AND amount <= 0"))
+
+
+def add_transaction_history_indexes(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_transactions_user_id ON transactions (user_id, id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_transactions_user_currency ON transactions (user_id, currency, id)'))
+
+
+def add_open_orders_index(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_orders_user_status ON orders (user_id, status, currency)'))
+
+
+def add_trading_pairs(conn):
+    """Register the default pairs and a default-quoted pair for every other currency with orders."""
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS trading_pairs (
+        symbol VARCHAR(10) NOT NULL,
+        base VARCHAR(10) NOT NULL,
+        quote VARCHAR(10) NOT NULL,
+        tick_size BIGINT NOT NULL,
+        lot_size BIGINT NOT NULL,
+        PRIMARY KEY (symbol)
+    )"""))
+    registered = {symbol for (symbol,) in conn.execute(text('SELECT symbol FROM trading_pairs'))}
+    rows = default_rows()
+    known = {row["symbol"] for row in rows}
+    for (currency,) in conn.execute(text('SELECT DISTINCT currency FROM orders')):
+        if currency not in known:
+            symbol, base, quote, tick, lot = default_pair(currency)
+            rows.append({"symbol": symbol, "base": base, "quote": quote, "tick_size": tick, "lot_size": lot})
+    rows = [row for row in rows if row["symbol"] not in registered]
+    if rows:
+        conn.execute(text('INSERT INTO trading_pairs (symbol, base, quote, tick_size, lot_size) '
+                          'VALUES (:symbol, :base, :quote, :tick_size, :lot_size)'), rows)
+
+
+def add_client_order_ids(conn):
+    if 'client_order_id' not in {column["name"] for column in inspect(conn).get_columns('orders')}:
+        conn.execute(text('ALTER TABLE orders ADD COLUMN client_order_id VARCHAR(64)'))
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_orders_user_client_order '
+                      'ON orders (user_id, client_order_id)'))
+
+
+UNBACKED = 'balance cannot back the order'
+
+
+def cancel_unbacked_orders(conn):
+    """Cancel resting orders their owners' balances cannot back, recording each in order_audit.
+
+    Orders that rested before holds covered them, such as buys from before
+    buys held their quote currency, can add up to more than their owner
+    has, and no fill against them would ever be allowed. Each user's orders
+    are backed oldest first out of the balance of the currency they spend;
+    those left over are cancelled.
+    """
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS order_audit (
+        id INTEGER NOT NULL,
+        order_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        currency VARCHAR(10) NOT NULL,
+        type VARCHAR(4) NOT NULL,
+        amount BIGINT NOT NULL,
+        price BIGINT NOT NULL,
+        action VARCHAR(20) NOT NULL,
+        reason VARCHAR(120) NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (id)
+    )"""))
+    pairs = {symbol: (base, quote) for symbol, base, quote in conn.execute(
+        text('SELECT symbol, base, quote FROM trading_pairs'))}
+    balances = {(user_id, currency): balance or 0 for user_id, currency, balance in conn.execute(
+        text('SELECT user_id, currency, balance FROM wallets'))}
+    unbacked = []
+    for order in conn.execute(text("SELECT id, user_id, currency, type, amount, price FROM orders "
+                                   "WHERE status = 'active' ORDER BY id")):
+        base, quote = pairs.get(order.currency) or default_pair(order.currency)[1:3]
+        if order.type == 'sell':
+            key, units = (order.user_id, base), order.amount
+        else:
+            key, units = (order.user_id, quote), cost_units(order.price, order.amount, base, quote)
+        if units <= balances.get(key, 0):
+            balances[key] = balances.get(key, 0) - units
+        else:
+            unbacked.append(order)
+    if not unbacked:
+        return
+    if 'journal_marks' in inspect(conn).get_table_names():
+        # journaled books still hold these orders; without marks startup reloads every book from the table
+        conn.execute(text('DELETE FROM journal_marks'))
+    conn.execute(text("UPDATE orders SET status = 'cancelled' WHERE id = :id"),
+                 [{"id": order.id} for order in unbacked])
+    conn.execute(text("INSERT INTO order_audit (order_id, user_id, currency, type, amount, price, action, reason, "
+                      "created_at) VALUES (:order_id, :user_id, :currency, :type, :amount, :price, 'cancelled', "
+                      ":reason, CURRENT_TIMESTAMP)"), [{
+        "order_id": order.id,
+        "user_id": order.user_id,
+        "currency": order.currency,
+        "type": order.type,
+        "amount": order.amount,
+        "price": order.price,
+        "reason": UNBACKED
+    } for order in unbacked])
+    print('Cancelled %d resting orders their owners cannot back; see order_audit' % len(unbacked))
+
+
+MIGRATIONS = [
+    add_hot_path_indexes,
+    fixed_point_amounts,
+    add_transaction_history_indexes,
+    add_open_orders_index,
+    add_trading_pairs,
+    add_client_order_ids,
+    cancel_unbacked_orders,
+]
+
+
+def migrate(engine):
+    """Bring an existing database up to date; a fresh one is just stamped."""
+    with engine.begin() as conn:
+        tables = inspect(conn).get_table_names()
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER NOT NULL)'))
+        version = conn.execute(text('SELECT MAX(version) FROM schema_migrations')).scalar()
+        if version is None:
+            version = 0 if 'users' in tables else len(MIGRATIONS)
+            conn.execute(text('INSERT INTO schema_migrations (version) VALUES (:version)'), {"version": version})
+
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            step(conn)
+            conn.execute(text('UPDATE schema_migrations SET version = :version'), {"version": number})
+    return len(MIGRATIONS)
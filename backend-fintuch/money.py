@@ -0,0 +1,79 @@
+"""Fixed-point amounts and prices.
+
+Balances, order amounts and trade amounts are stored as integer minor units
+of their currency (10 ** scale units per coin); prices are stored as integer
+units of 10 ** -PRICE_SCALE of the quote currency. Floats only appear at the
+API boundary. A trading pair symbol written BASE-QUOTE counts in its base
+currency.
+"""
+from decimal import ROUND_DOWN, Decimal, InvalidOperation
+
+SCALES = {
+    "BTC": 8,
+    "ETH": 8,
+    "USDC": 6,
+    "USD": 2,
+}
+DEFAULT_SCALE = 8
+PRICE_SCALE = 8
+# amounts and prices are stored as BIGINT
+MAX_UNITS = 2 ** 63 - 1
+
+
+def scale(currency):
+    return SCALES.get(currency.split('-', 1)[0], DEFAULT_SCALE)
+
+
+def _to_units(value, places):
+    """ValueError unless `value` is a finite number whose units fit a BIGINT."""
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError('Not a number: %r' % (value,))
+    if not number.is_finite():
+        raise ValueError('Not a finite number: %r' % (value,))
+    units = int(number.scaleb(places).to_integral_value(rounding=ROUND_DOWN))
+    if abs(units) > MAX_UNITS:
+        raise ValueError('Out of range: %r' % (value,))
+    return units
+
+
+def _from_units(units, places):
+    return float(Decimal(units).scaleb(-places))
+
+
+def to_units(value, currency):
+    """Decimal amount of `currency` to minor units, truncating extra precision."""
+    return _to_units(value, scale(currency))
+
+
+def from_units(units, currency):
+    return _from_units(units, scale(currency))
+
+
+def price_to_units(value):
+    return _to_units(value, PRICE_SCALE)
+
+
+def price_from_units(units):
+    return _from_units(units, PRICE_SCALE)
+
+
+def notional(price, amount, currency):
+    """Value of `amount` minor units of `currency` at `price` units, as a float."""
+    return _from_units(price * amount, PRICE_SCALE + scale(currency))
+
+
+def notional_units(price, amount, currency):
+    """Value of `amount` minor units of `currency` at `price` units, in price units."""
+    return price * amount // 10 ** scale(currency)
+
+
+def cost_units(price, amount, base, quote):
+    """What `amount` minor units of `base` cost at `price`, in minor units of `quote`, rounded down."""
+    return price * amount * 10 ** scale(quote) // 10 ** (scale(base) + PRICE_SCALE)
+
+
+def amount_for(price, budget, base, quote):
+    """The most minor units of `base` that `budget` minor units of `quote` buy at `price`."""
+    return budget * 10 ** (scale(base) + PRICE_SCALE) // (price * 10 ** scale(quote))
@@ -0,0 +1,528 @@
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+
+Fill = namedtuple('Fill', ['maker', 'taker', 'amount', 'price'])
+
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+
+# order flags
+SELL = 1
+LIVE = 2
+
+EMPTY = 0
+DELETED = -1
+# Knuth's multiplicative hash; odd, so consecutive ids never collide
+HASH = 2654435761
+
+
+def to_timestamp(created_at):
+    """A naive UTC datetime as seconds since the epoch; 0.0 for None."""
+    if created_at is None:
+        return 0.0
+    return (created_at - EPOCH) / SECOND
+
+
+def from_timestamp(timestamp):
+    if not timestamp:
+        return None
+    return EPOCH + timedelta(seconds=timestamp)
+
+
+class BookOrder:
+    """An order as the book sees it: a taker being matched, or a copy of a resting one.
+
+    Copies handed out by the book are detached from it; changes go through
+    the book's methods.
+    """
+    __slots__ = ('id', 'user_id', 'currency', 'type', 'price', 'amount', 'created_at')
+
+    def __init__(self, id, user_id, currency, type, price, amount, created_at=None):
+        self.id = id
+        self.user_id = user_id
+        self.currency = currency
+        self.type = type
+        self.price = price
+        self.amount = amount
+        self.created_at = created_at
+
+    @classmethod
+    def from_row(cls, order):
+        return cls(order.id, order.user_id, order.currency, order.type,
+                   order.price, order.amount, order.created_at)
+
+
+class SlotIndex:
+    """Order id -> slot, open addressing over two typed arrays.
+
+    Ids must be positive; 0 marks an empty bucket and -1 a deleted one.
+    """
+
+    def __init__(self, capacity=8):
+        self.keys = array('q', bytes(8 * capacity))
+        self.values = array('i', bytes(4 * capacity))
+        self.mask = capacity - 1
+        self.used = 0
+        self.filled = 0
+
+    def _find(self, key):
+        keys = self.keys
+        mask = self.mask
+        i = (key * HASH) & mask
+        while True:
+            found = keys[i]
+            if found == key or found == EMPTY:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, key):
+        i = self._find(key)
+        return self.values[i] if self.keys[i] == key else -1
+
+    def put(self, key, value):
+        keys = self.keys
+        mask = self.mask
+        i = (key * HASH) & mask
+        reuse = -1
+        while True:
+            found = keys[i]
+            if found == key:
+                self.values[i] = value
+                return
+            if found == EMPTY:
+                break
+            if found == DELETED and reuse < 0:
+                reuse = i
+            i = (i + 1) & mask
+        if reuse >= 0:
+            i = reuse
+        else:
+            self.filled += 1
+        keys[i] = key
+        self.values[i] = value
+        self.used += 1
+        if 4 * self.filled >= 3 * (mask + 1):
+            self._resize()
+
+    def remove(self, key):
+        i = self._find(key)
+        if self.keys[i] == key:
+            self.keys[i] = DELETED
+            self.used -= 1
+
+    def _resize(self):
+        keys, values = self.keys, self.values
+        capacity = self.mask + 1
+        while 2 * self.used >= capacity:
+            capacity *= 2
+        self.__init__(capacity)
+        new_keys, new_values, mask = self.keys, self.values, self.mask
+        for key, value in zip(keys, values):
+            if key > 0:
+                i = (key * HASH) & mask
+                while new_keys[i]:
+                    i = (i + 1) & mask
+                new_keys[i] = key
+                new_values[i] = value
+                self.used += 1
+        self.filled = self.used
+
+
+class PriceLevel:
+    """Orders at one price, oldest first, linked through the book's slot arrays."""
+    __slots__ = ('price', 'total', 'count', 'head', 'tail')
+
+    def __init__(self, price):
+        self.price = price
+        self.total = 0
+        self.count = 0
+        self.head = -1
+        self.tail = -1
+
+
+class BookSide:
+    """One side of a book: price levels keyed so that the best price is last."""
+
+    def __init__(self, type):
+        self.type = type
+        self.levels = {}
+        # bids are kept ascending, asks are stored negated, so the best
+        # level is always at keys[-1] and can be popped without a memmove
+        self.sign = 1 if type == 'buy' else -1
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def best(self):
+        if not self.keys:
+            return None
+        return self.levels[self.keys[-1] * self.sign]
+
+    def level(self, price):
+        """The level at `price`, created if missing."""
+        level = self.levels.get(price)
+        if level is None:
+            level = self.levels[price] = PriceLevel(price)
+            insort(self.keys, price * self.sign)
+        return level
+
+    def drop(self, level):
+        key = level.price * self.sign
+        if self.keys and self.keys[-1] == key:
+            self.keys.pop()
+        else:
+            del self.keys[bisect_left(self.keys, key)]
+        del self.levels[level.price]
+
+    def crosses(self, level, price):
+        """Whether a taker on the other side at `price` can trade at `level`."""
+        if self.type == 'sell':
+            return level.price <= price
+        return level.price >= price
+
+    def iter_levels(self):
+        for key in reversed(self.keys):
+            yield self.levels[key * self.sign]
+
+    def depth(self, levels):
+        """(price, amount, order count) for the best `levels` levels."""
+        return [(level.price, level.total, level.count)
+                for level in islice(self.iter_levels(), levels)]
+
+
+class OrderBook:
+    """Price-time priority limit order book for a single currency.
+
+    Resting orders live in parallel typed arrays, one slot per order: id,
+    user id, price, amount, creation time, flags (side, live) and the
+    previous and next slot at the same price. Slots of orders that leave
+    the book are chained into a free list and reused, so a resting order
+    costs a few dozen bytes instead of a Python object per field. Readers
+    get BookOrder copies.
+    """
+
+    def __init__(self, currency, version=0):
+        self.currency = currency
+        self.bids = BookSide('buy')
+        self.asks = BookSide('sell')
+        self.ids = array('q')
+        self.user_ids = array('q')
+        self.prices = array('q')
+        self.amounts = array('q')
+        self.created = array('d')
+        self.flags = array('b')
+        self.prev = array('i')
+        self.next = array('i')
+        self.free = -1
+        self.index = SlotIndex()
+        self.count = 0
+        # bumped on every change so readers can cache derived views
+        self.version = version
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, order_id):
+        return self.index.get(order_id) >= 0
+
+    def side(self, type):
+        return self.bids if type == 'buy' else self.asks
+
+    def opposite(self, type):
+        return self.asks if type == 'buy' else self.bids
+
+    def best_bid(self):
+        level = self.bids.best()
+        return level.price if level else None
+
+    def best_ask(self):
+        level = self.asks.best()
+        return level.price if level else None
+
+    def _order(self, slot):
+        return BookOrder(self.ids[slot], self.user_ids[slot], self.currency,
+                         'sell' if self.flags[slot] & SELL else 'buy', self.prices[slot],
+                         self.amounts[slot], from_timestamp(self.created[slot]))
+
+    def _level(self, slot):
+        side = self.asks if self.flags[slot] & SELL else self.bids
+        return side, side.levels[self.prices[slot]]
+
+    def _unlink(self, level, slot):
+        prev, next = self.prev[slot], self.next[slot]
+        if prev >= 0:
+            self.next[prev] = next
+        else:
+            level.head = next
+        if next >= 0:
+            self.prev[next] = prev
+        else:
+            level.tail = prev
+        level.count -= 1
+
+    def _release(self, slot):
+        self.index.remove(self.ids[slot])
+        self.flags[slot] = 0
+        self.next[slot] = self.free
+        self.free = slot
+        self.count -= 1
+
+    def get(self, order_id):
+        """A copy of the resting order, or None."""
+        slot = self.index.get(order_id)
+        return self._order(slot) if slot >= 0 else None
+
+    def resting(self, type=None):
+        """Copies of the resting orders, bids then asks, best price and oldest first."""
+        sides = (self.bids, self.asks) if type is None else (self.side(type),)
+        for side in sides:
+            for level in side.iter_levels():
+                slot = level.head
+                while slot >= 0:
+                    yield self._order(slot)
+                    slot = self.next[slot]
+
+    def add(self, order):
+        level = self.side(order.type).level(order.price)
+        flags = LIVE | SELL if order.type == 'sell' else LIVE
+        slot = self.free
+        if slot >= 0:
+            self.free = self.next[slot]
+            self.ids[slot] = order.id
+            self.user_ids[slot] = order.user_id
+            self.prices[slot] = order.price
+            self.amounts[slot] = order.amount
+            self.created[slot] = to_timestamp(order.created_at)
+            self.flags[slot] = flags
+            self.prev[slot] = level.tail
+            self.next[slot] = -1
+        else:
+            slot = len(self.ids)
+            self.ids.append(order.id)
+            self.user_ids.append(order.user_id)
+            self.prices.append(order.price)
+            self.amounts.append(order.amount)
+            self.created.append(to_timestamp(order.created_at))
+            self.flags.append(flags)
+            self.prev.append(level.tail)
+            self.next.append(-1)
+        if level.tail >= 0:
+            self.next[level.tail] = slot
+        else:
+            level.head = slot
+        level.tail = slot
+        level.count += 1
+        level.total += order.amount
+        self.index.put(order.id, slot)
+        self.count += 1
+        self.version += 1
+
+    def cancel(self, order_id):
+        slot = self.index.get(order_id)
+        if slot < 0:
+            return None
+        order = self._order(slot)
+        side, level = self._level(slot)
+        self._unlink(level, slot)
+        level.total -= order.amount
+        if not level.count:
+            side.drop(level)
+        self._release(slot)
+        self.version += 1
+        return order
+
+    def reduce(self, order_id, amount):
+        """Take `amount` off a resting order, removing it once nothing is left."""
+        slot = self.index.get(order_id)
+        if slot < 0:
+            return None
+        self.amounts[slot] -= amount
+        self._level(slot)[1].total -= amount
+        order = self._order(slot)
+        if order.amount <= 0:
+            self.cancel(order_id)
+        else:
+            self.version += 1
+        return order
+
+    def crossing(self, type, price):
+        """Copies of the resting orders a `type` taker at `price` would hit, best first."""
+        side = self.opposite(type)
+        for level in side.iter_levels():
+            if not side.crosses(level, price):
+                return
+            slot = level.head
+            while slot >= 0:
+                yield self._order(slot)
+                slot = self.next[slot]
+
+    def match(self, taker, can_fill=None):
+        """Match `taker` against the book and return the list of fills.
+
+        `can_fill(maker, amount)` may veto a fill (e.g. an unfunded seller);
+        vetoed makers keep their place in the book. The taker's remaining
+        amount is updated in place but it is never added to the book here.
+        Fill makers are copies holding what is left of the maker.
+        """
+        side = self.opposite(taker.type)
+        amounts, next = self.amounts, self.next
+        fills = []
+        i = len(side.keys)
+        while taker.amount > 0 and i > 0:
+            i -= 1
+            level = side.levels[side.keys[i] * side.sign]
+            if not side.crosses(level, taker.price):
+                break
+            slot = level.head
+            while slot >= 0 and taker.amount > 0:
+                following = next[slot]
+                amount = min(taker.amount, amounts[slot])
+                maker = self._order(slot)
+                if can_fill is not None and not can_fill(maker, amount):
+                    slot = following
+                    continue
+                taker.amount -= amount
+                maker.amount -= amount
+                amounts[slot] = maker.amount
+                level.total -= amount
+                if maker.amount <= 0:
+                    self._unlink(level, slot)
+                    self._release(slot)
+                fills.append(Fill(maker, taker, amount, level.price))
+                slot = following
+            if not level.count:
+                side.drop(level)
+        if fills:
+            self.version += 1
+        return fills
+
+
+class DepthMirror:
+    """The price levels of a book that lives in another process, kept from its level updates.
+
+    Reads like an OrderBook's sides (`bids`, `asks`, `version`) but holds
+    no orders. `load` installs every level of the book at a version;
+    `update` sets the levels a change touched, given the book's version
+    after it, and skips updates older than what is held. Updates that
+    arrive while a load is pending are kept and replayed over it.
+    """
+
+    def __init__(self, currency):
+        self.currency = currency
+        self.bids = BookSide('buy')
+        self.asks = BookSide('sell')
+        # -1 until loaded
+        self.version = -1
+        # bumped by reset, so a load started before one is not installed
+        self.generation = 0
+        self.pending = None
+        self.loading = threading.Lock()
+
+    def side(self, type):
+        return self.bids if type == 'buy' else self.asks
+
+    def loaded(self):
+        return self.version >= 0
+
+    def begin_load(self):
+        """Start keeping updates for a load; returns the generation to pass to `load`."""
+        self.pending = []
+        return self.generation
+
+    def load(self, generation, version, levels):
+        """Install all levels as of `version`; False if the mirror was reset since `begin_load`."""
+        if generation != self.generation:
+            return False
+        self.bids, self.asks = BookSide('buy'), BookSide('sell')
+        self._set(levels)
+        self.version = version
+        pending, self.pending = self.pending or [], None
+        for version, levels in pending:
+            self.update(version, levels)
+        return True
+
+    def update(self, version, levels):
+        if self.version < 0:
+            if self.pending is not None:
+                self.pending.append((version, levels))
+            return
+        # one commit can publish several updates, all at its final version
+        if version < self.version:
+            return
+        self._set(levels)
+        self.version = version
+
+    def reset(self):
+        self.bids, self.asks = BookSide('buy'), BookSide('sell')
+        self.version = -1
+        self.generation += 1
+        self.pending = None
+
+    def _set(self, levels):
+        for type, price, total, count in levels:
+            side = self.side(type)
+            if count > 0:
+                level = side.level(price)
+                level.total = total
+                level.count = count
+            elif price in side.levels:
+                side.drop(side.levels[price])
+
+
+def book_levels(book):
+    """Every level of `book` as (side, price, total, count), as DepthMirror.load takes them."""
+    return [(side.type, level.price, level.total, level.count)
+            for side in (book.bids, book.asks) for level in side.iter_levels()]
+
+
+class MatchingEngine:
+    """Resident order books, one per currency."""
+
+    def __init__(self):
+        self.books = {}
+        self.locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, currency):
+        """Lock guarding `currency`'s book; it survives reloads of the book."""
+        lock = self.locks.get(currency)
+        if lock is None:
+            lock = self.locks.setdefault(currency, threading.Lock())
+        return lock
+
+    def book(self, currency):
+        """`currency`'s book, created empty if missing; readers use `peek`."""
+        book = self.books.get(currency)
+        if book is None:
+            with self._lock:
+                book = self.books.get(currency)
+                if book is None:
+                    book = self.books[currency] = OrderBook(currency)
+        return book
+
+    def peek(self, currency):
+        """`currency`'s book, or a detached empty one; never adds a book."""
+        book = self.books.get(currency)
+        return book if book is not None else OrderBook(currency)
+
+    def load(self, orders):
+        """Rebuild the books from active order rows, oldest first."""
+        self.books = {}
+        for order in orders:
+            self.book(order.currency).add(BookOrder.from_row(order))
+
+    def restore(self, books):
+        """Replace the books with already built ones, keyed by currency."""
+        self.books = dict(books)
+
+    def reload(self, currency, orders):
+        old = self.books.get(currency)
+        book = self.books[currency] = OrderBook(currency, old.version + 1 if old else 0)
+        for order in orders:
+            book.add(BookOrder.from_row(order))
+        return book
@@ -0,0 +1,102 @@
+"""Trading pairs: which currency a book trades, what it is paid in, and its price and size steps.
+
+A pair's book trades its base currency against its quote currency. Prices
+are quote per base in PRICE_SCALE units and must be a multiple of the
+pair's tick; amounts are base minor units and a multiple of its lot. Pairs
+are looked up by symbol, which is the base currency's name for pairs in the
+default quote and BASE-QUOTE for the others.
+
+Each book has a matcher of its own, and each currency's wallets are kept
+by the matcher of the same name: a default pair's book settles its base
+currency in place, while what its buyers spend in USD is reserved on the
+USD matcher before the order reaches the book and paid over from there by
+transfers once the trade commits.
+"""
+import threading
+
+from money import amount_for, cost_units, price_to_units, to_units
+
+DEFAULT_QUOTE = 'USD'
+
+# (symbol, base, quote, tick in quote, lot in base)
+DEFAULT_PAIRS = [
+    ('BTC', 'BTC', DEFAULT_QUOTE, 0.01, 0.0001),
+    ('ETH', 'ETH', DEFAULT_QUOTE, 0.01, 0.001),
+    ('USDC', 'USDC', DEFAULT_QUOTE, 0.0001, 0.01),
+    ('USDT', 'USDT', DEFAULT_QUOTE, 0.0001, 0.01),
+    ('BNB', 'BNB', DEFAULT_QUOTE, 0.01, 0.001),
+    ('ADA', 'ADA', DEFAULT_QUOTE, 0.0001, 0.1),
+]
+
+
+def default_pair(symbol):
+    """(symbol, base, quote, tick units, lot units) of a default-quoted pair with no configured steps."""
+    return symbol, symbol, DEFAULT_QUOTE, 1, 1
+
+
+def default_rows():
+    return [{"symbol": symbol, "base": base, "quote": quote, "tick_size": price_to_units(tick),
+             "lot_size": to_units(lot, base)} for symbol, base, quote, tick, lot in DEFAULT_PAIRS]
+
+
+class Pair:
+    __slots__ = ('symbol', 'base', 'quote', 'tick', 'lot')
+
+    def __init__(self, symbol, base, quote, tick, lot):
+        self.symbol = symbol
+        self.base = base
+        self.quote = quote
+        self.tick = tick
+        self.lot = lot
+
+    def cost(self, price, amount):
+        """What `amount` base units cost at `price`, in quote units, rounded down."""
+        return cost_units(price, amount, self.base, self.quote)
+
+    def amount_for(self, price, budget):
+        """The most whole lots that `budget` quote units pay for at `price`."""
+        return self.lots(amount_for(price, budget, self.base, self.quote))
+
+    def lots(self, amount):
+        """`amount` rounded down to whole lots."""
+        return amount - amount % self.lot
+
+    def spends(self, type):
+        """The currency an order of `type` pays with: the quote for buys, the base for sells."""
+        return self.quote if type == 'buy' else self.base
+
+    def limit(self, type, price):
+        """`price` on the tick grid, rounded away from crossing: buys down, sells up."""
+        if type == 'buy':
+            return price - price % self.tick
+        return -(-price // self.tick) * self.tick
+
+
+class PairRegistry:
+    """Trading pairs by symbol, loaded once and kept until `reload`.
+
+    `load()` returns (symbol, base, quote, tick, lot) tuples. A symbol
+    that is not registered, e.g. a book left from before pairs, trades in
+    the default quote with no steps; `get` only returns registered pairs.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.pairs = {}
+        self._lock = threading.Lock()
+
+    def reload(self):
+        pairs = {row[0]: Pair(*row) for row in self.load()}
+        with self._lock:
+            self.pairs = pairs
+        return self
+
+    def get(self, symbol):
+        return self.pairs.get(symbol)
+
+    def pair(self, symbol):
+        pair = self.pairs.get(symbol)
+        return pair if pair is not None else Pair(*default_pair(symbol))
+
+    def symbols(self):
+        return sorted(self.pairs)
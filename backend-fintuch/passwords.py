@@ -0,0 +1,133 @@
+"""Password hashing and checks off the request threads.
+
+bcrypt is slow on purpose, so a login storm hashing on the API's own
+threads holds up every other request it serves. Hashes are computed by a
+small pool of forked worker processes instead (or threads, with 0
+processes; bcrypt releases the GIL), behind a bounded number of pending
+jobs. Failed logins are remembered for a short while so a client retrying
+the same wrong password is answered without hashing again.
+"""
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import bcrypt
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def hash_rounds(hashed):
+    """The log2 work factor a bcrypt hash was made with, or None if it is not one."""
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Bounded bcrypt pipeline with rehash-on-login and a failed-attempt cache.
+
+    At most `max_pending` hashes queue or run at once; more raise
+    queue.Full. Hashes made with a work factor other than `rounds` are
+    reported by `needs_rehash` so logins can upgrade them. Failed
+    (email, password) pairs are kept for `failure_ttl` seconds, keyed by
+    an HMAC under a per-process key so no password is held in memory.
+    """
+
+    def __init__(self, rounds=12, processes=1, max_pending=64, failure_ttl=30, max_failures=100000):
+        self.rounds = rounds
+        self.processes = processes
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self.failures = OrderedDict()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        # failed attempts answered from the cache
+        self.cache_hits = 0
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # created on first use, so matching processes forked at startup
+        # do not inherit the pool
+        with self._lock:
+            if self.executor is None:
+                if self.processes:
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        self.processes, mp_context=multiprocessing.get_context('fork'))
+                else:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(
+                        os.cpu_count() or 1, thread_name_prefix='passwords')
+            return self.executor
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise queue.Full
+        try:
+            try:
+                future = self._executor().submit(fn, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died; start a fresh pool for this and later jobs
+                with self._lock:
+                    self.executor = None
+                future = self._executor().submit(fn, *args)
+            return future.result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def _failure_key(self, email, password):
+        return hmac.new(self._key, ('%s\0%s' % (email, password)).encode('utf-8'), hashlib.sha256).digest()
+
+    def failed_recently(self, email, password):
+        with self._lock:
+            attempts = self.failures.get(email)
+            if not attempts:
+                return False
+            expires = attempts.get(self._failure_key(email, password))
+            if expires is None or expires <= time.monotonic():
+                return False
+            self.cache_hits += 1
+            return True
+
+    def record_failure(self, email, password):
+        key = self._failure_key(email, password)
+        with self._lock:
+            attempts = self.failures.pop(email, None) or {}
+            now = time.monotonic()
+            attempts = {k: expires for k, expires in attempts.items() if expires > now}
+            attempts[key] = now + self.failure_ttl
+            self.failures[email] = attempts
+            while len(self.failures) > self.max_failures:
+                self.failures.popitem(last=False)
+
+    def forget(self, email):
+        """Drop the failed attempts for `email`, e.g. once it is registered."""
+        with self._lock:
+            self.failures.pop(email, None)
+
+    def close(self):
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
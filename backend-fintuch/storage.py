@@ -0,0 +1,84 @@
+"""Database engine settings, read from the environment.
+
+CEX_DATABASE_URI picks the backend: SQLite for a single node, or any
+server database SQLAlchemy has a driver for. Pooling and statement
+caching apply to both:
+
+    CEX_DB_POOL_SIZE        connections kept open (10)
+    CEX_DB_MAX_OVERFLOW     extra connections under load (20)
+    CEX_DB_POOL_TIMEOUT     seconds to wait for a free connection (30)
+    CEX_DB_POOL_RECYCLE     reopen connections older than this, seconds (1800; SQLite never)
+    CEX_DB_STATEMENT_CACHE  compiled statements cached per engine, and per SQLite connection (500)
+
+SQLite connections also get pragmas when they open:
+
+    CEX_SQLITE_JOURNAL_MODE WAL (default) lets readers run beside the writer; DELETE is SQLite's own default
+    CEX_SQLITE_SYNCHRONOUS  NORMAL in WAL mode, FULL otherwise
+    CEX_DB_BUSY_TIMEOUT_MS  how long a writer waits for the file lock (5000)
+    CEX_SQLITE_CACHE_KB     page cache per connection (65536)
+"""
+import os
+
+from sqlalchemy import event
+
+MEMORY_URIS = ('sqlite://', 'sqlite:///:memory:')
+
+
+def _setting(environ, name, default):
+    return type(default)(environ.get(name, default))
+
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite')
+
+
+def engine_options(uri, environ=os.environ):
+    """SQLALCHEMY_ENGINE_OPTIONS for `uri`."""
+    statements = _setting(environ, 'CEX_DB_STATEMENT_CACHE', 500)
+    options = {"query_cache_size": statements}
+    if uri in MEMORY_URIS:
+        # one shared connection; there is no pool to size
+        return options
+    options.update({
+        "pool_size": _setting(environ, 'CEX_DB_POOL_SIZE', 10),
+        "max_overflow": _setting(environ, 'CEX_DB_MAX_OVERFLOW', 20),
+        "pool_timeout": _setting(environ, 'CEX_DB_POOL_TIMEOUT', 30),
+    })
+    if is_sqlite(uri):
+        options["pool_recycle"] = _setting(environ, 'CEX_DB_POOL_RECYCLE', -1)
+        options["connect_args"] = {
+            "timeout": _setting(environ, 'CEX_DB_BUSY_TIMEOUT_MS', 5000) / 1000,
+            "cached_statements": statements,
+        }
+    else:
+        options["pool_recycle"] = _setting(environ, 'CEX_DB_POOL_RECYCLE', 1800)
+        options["pool_pre_ping"] = True
+    return options
+
+
+def sqlite_pragmas(environ=os.environ):
+    """PRAGMA name -> value run on every new SQLite connection, in order."""
+    journal_mode = environ.get('CEX_SQLITE_JOURNAL_MODE', 'WAL').upper()
+    return {
+        "journal_mode": journal_mode,
+        "synchronous": environ.get('CEX_SQLITE_SYNCHRONOUS', 'NORMAL' if journal_mode == 'WAL' else 'FULL').upper(),
+        "busy_timeout": _setting(environ, 'CEX_DB_BUSY_TIMEOUT_MS', 5000),
+        "cache_size": -_setting(environ, 'CEX_SQLITE_CACHE_KB', 65536),
+        "temp_store": 'MEMORY',
+    }
+
+
+def attach(engine, environ=os.environ):
+    """Set up `engine`'s connections as they open; call before its first connection."""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(environ)
+    if engine.url.database in (None, '', ':memory:'):
+        pragmas.pop('journal_mode')
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
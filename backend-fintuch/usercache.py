@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """What the API needs to know about a JWT identity, kept for `ttl` seconds.
+
+    `load(user_id)` builds a user's context from the database, or returns
+    None for an unknown id, which is not cached. At most `capacity`
+    contexts are kept, least recently used dropped first. Writers call
+    `invalidate` once their change is committed; a load that raced such a
+    write is returned but not kept, so the cache never holds a context
+    older than the newest invalidation.
+    """
+
+    def __init__(self, load, capacity=10000, ttl=60):
+        self.load = load
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # user_id -> [loads in flight, invalidated since they started]
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            pending = self.loading.setdefault(user_id, [0, False])
+            pending[0] += 1
+        context = None
+        try:
+            context = self.load(user_id)
+        finally:
+            with self._lock:
+                pending[0] -= 1
+                if not pending[0]:
+                    self.loading.pop(user_id, None)
+                if context is not None and not pending[1]:
+                    self.entries[user_id] = (now + self.ttl, context)
+                    self.entries.move_to_end(user_id)
+                    while len(self.entries) > self.capacity:
+                        self.entries.popitem(last=False)
+        return context
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self.invalidations += 1
+                self.entries.pop(user_id, None)
+                pending = self.loading.get(user_id)
+                if pending is not None:
+                    pending[1] = True
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            for pending in self.loading.values():
+                pending[1] = True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations, "hitRate": self.hits / lookups if lookups else 0}
@@ -32,7 +32,7 @@ const OrderBook = () => {
   const fetchOrderBook = async () => {
     try {
       setLoading(true);
-      const response = await fetch(`http://localhost:5000/api/orderbook/${selectedCurrency}`);
+      const response = await fetch(`http://localhost:5000/api/orderbook/${selectedCurrency}?depth=10`);
       const data = await response.json();
       setOrderBook(data);
     } catch (error) {
@@ -1,6 +1,17 @@
 import React, { useState } from 'react';
 import axios from 'axios';
 
+// seconds each request waits for the matcher, and how often to ask again while queued
+const ORDER_WAIT = 5;
+const MAX_STATUS_POLLS = 6;
+
+const STATUS_MESSAGES: Record<string, string> = {
+    active: 'Order placed on the book',
+    filled: 'Order filled',
+    cancelled: 'Order cancelled: nothing left to trade',
+    queued: 'Order queued; check your orders for its status',
+};
+
 const OrderForm: React.FC = () => {
     const [currency, setCurrency] = useState('');
     const [amount, setAmount] = useState<number | ''>('');
@@ -21,16 +32,28 @@ const OrderForm: React.FC = () => {
                 return;
             }
 
-            const response = await axios.post('http://localhost:5000/api/orderbook/create', {
+            const headers = { Authorization: `Bearer ${token}` };
+            // wait for the matcher, so a rejected order is reported as one
+            const response = await axios.post(`http://localhost:5000/api/orderbook/create?wait=${ORDER_WAIT}`, {
                 currency,
                 amount,
                 price,
                 type: orderType,
-            }, {
-                headers: { Authorization: `Bearer ${token}` }
-            });
+            }, { headers });
 
-            setMessage(response.data.message);
+            const orderId = response.data.order_id;
+            let { status, error: reason } = response.data;
+            for (let attempt = 0; status === 'queued' && attempt < MAX_STATUS_POLLS; attempt++) {
+                const poll = await axios.get(
+                    `http://localhost:5000/api/orderbook/order/${orderId}?wait=${ORDER_WAIT}`, { headers });
+                ({ status, error: reason } = poll.data);
+            }
+
+            if (status === 'rejected') {
+                setError(reason || 'Order rejected');
+                return;
+            }
+            setMessage(STATUS_MESSAGES[status] || `Order ${orderId} is ${status}`);
             setCurrency('');
             setAmount('');
             setPrice('');
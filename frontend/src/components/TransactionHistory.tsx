@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import axios from "axios";
 
 interface Transaction {
@@ -10,17 +10,35 @@ interface Transaction {
   date: string;
 }
 
+const TRANSACTIONS_URL = "http://localhost:5000/api/transactions";
+
+// newest first, a page at a time; the cursor for the next (older) page comes in X-Next-Cursor
+const fetchPage = async (cursor?: string) => {
+  const response = await axios.get<Transaction[]>(TRANSACTIONS_URL, {
+    headers: { Authorization: `Bearer ${localStorage.getItem("token")}` },
+    params: cursor ? { cursor } : {},
+  });
+  return { rows: response.data, cursor: (response.headers["x-next-cursor"] as string | undefined) ?? null };
+};
+
 const TransactionHistory: React.FC = () => {
   const [transactions, setTransactions] = useState<Transaction[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [loading, setLoading] = useState<boolean>(true);
+  const [loadingMore, setLoadingMore] = useState<boolean>(false);
+  // once older pages are loaded, the cursor follows them rather than the refreshed newest page
+  const loadedOlder = useRef<boolean>(false);
 
   useEffect(() => {
     const fetchTransactions = async () => {
       try {
-        const response = await axios.get("http://localhost:5000/api/transactions", {
-          headers: { Authorization: `Bearer ${localStorage.getItem("token")}` },
-        });
-        setTransactions(response.data);
+        const page = await fetchPage();
+        const oldest = page.rows.length ? page.rows[page.rows.length - 1].id : Infinity;
+        // refresh the newest page, keeping older pages already loaded below it
+        setTransactions((current) => [...page.rows, ...current.filter((row) => row.id < oldest)]);
+        if (!loadedOlder.current) {
+          setNextCursor(page.cursor);
+        }
       } catch (error) {
         console.error("Failed to fetch transactions", error);
       } finally {
@@ -34,6 +52,23 @@ const TransactionHistory: React.FC = () => {
     return () => clearInterval(interval);
   }, []);
 
+  const loadMore = async () => {
+    if (!nextCursor) {
+      return;
+    }
+    setLoadingMore(true);
+    try {
+      const page = await fetchPage(nextCursor);
+      setTransactions((current) => [...current, ...page.rows]);
+      loadedOlder.current = true;
+      setNextCursor(page.cursor);
+    } catch (error) {
+      console.error("Failed to fetch more transactions", error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   return (
     <div className="text-gray-100">
       <h2 className="text-xl font-bold text-blue-400 mb-4">Transaction History</h2>
@@ -72,6 +107,16 @@ const TransactionHistory: React.FC = () => {
               ))}
             </tbody>
           </table>
+          {nextCursor && (
+            <button
+              type="button"
+              onClick={loadMore}
+              disabled={loadingMore}
+              className="w-full mt-2 py-2 rounded-lg bg-gray-700 text-gray-300 hover:bg-gray-600 disabled:opacity-50"
+            >
+              {loadingMore ? "Loading..." : "Load more"}
+            </button>
+          )}
         </div>
       ) : (
         <div className="text-center text-gray-400 py-8">No transactions found</div>
@@ -5,6 +5,7 @@ import json
 from datetime import datetime
 import threading
 import logging
+import uuid
 
 # Configure logging
 logging.basicConfig(
@@ -16,7 +17,10 @@ logger = logging.getLogger(__name__)
 class MarketMaker:
     def __init__(self):
         self.base_url = "http://localhost:5000/api"
+        self.order_timeout = 10  # seconds before an order or batch request is retried
+        self.order_attempts = 3
         self.tokens = {}  # Store tokens for multiple bot accounts
+        self.quotes = {}  # Resting order ids per bot account, replaced every round
         self.currencies = ["BTC", "ETH", "USDT", "BNB", "ADA"]
         self.price_ranges = {
             "BTC": (35000, 45000),
@@ -68,8 +72,11 @@ class MarketMaker:
         """Make initial deposits for bot accounts"""
         headers = {'Authorization': f'Bearer {self.tokens[email]}'}
         
-        for currency in self.currencies:
-            deposit_amount = self.volume_ranges[currency][1] * 10  # Deposit 10x max volume
+        deposits = {currency: self.volume_ranges[currency][1] * 10  # Deposit 10x max volume
+                    for currency in self.currencies}
+        # buys are paid in USD, the quote currency of every pair
+        deposits["USD"] = sum(self.price_ranges[currency][1] * amount for currency, amount in deposits.items())
+        for currency, deposit_amount in deposits.items():
             try:
                 response = requests.post(
                     f"{self.base_url}/wallet/deposit",
@@ -84,6 +91,47 @@ class MarketMaker:
             except Exception as e:
                 logger.error(f"Error making deposit for {email}: {str(e)}")
 
+    def random_order(self, currency):
+        """Random buy or sell order parameters around the currency's mid price"""
+        order_type = random.choice(['buy', 'sell'])
+        base_price = sum(self.price_ranges[currency]) / 2
+        price_spread = 0.02  # 2% spread
+        
+        if order_type == 'buy':
+            price = base_price * (1 - random.uniform(0, price_spread))
+        else:
+            price = base_price * (1 + random.uniform(0, price_spread))
+            
+        amount = random.uniform(*self.volume_ranges[currency])
+        
+        return {
+            "currency": currency,
+            "amount": amount,
+            "price": price,
+            "type": order_type,
+            # Retries carry the same id, so a timed out order is never placed twice
+            "client_order_id": str(uuid.uuid4())
+        }
+
+    def post_order(self, path, headers, body, label):
+        """POST an order or batch, resending it on a timeout or dropped connection
+
+        Every new order carries a client_order_id, so a resent request is answered
+        with the first one's outcome instead of placing the orders again.
+        """
+        for attempt in range(1, self.order_attempts + 1):
+            try:
+                return requests.post(
+                    f"{self.base_url}{path}",
+                    headers=headers,
+                    json=body,
+                    timeout=self.order_timeout
+                )
+            except (requests.Timeout, requests.ConnectionError) as e:
+                if attempt == self.order_attempts:
+                    raise
+                logger.warning(f"{label} attempt {attempt} failed: {str(e)}")
+
     def create_random_order(self, currency):
         """Create a random buy or sell order"""
         try:
@@ -91,55 +139,75 @@ class MarketMaker:
             email = random.choice(list(self.tokens.keys()))
             headers = {'Authorization': f'Bearer {self.tokens[email]}'}
             
-            # Generate random order parameters
-            order_type = random.choice(['buy', 'sell'])
-            base_price = sum(self.price_ranges[currency]) / 2
-            price_spread = 0.02  # 2% spread
-            
-            if order_type == 'buy':
-                price = base_price * (1 - random.uniform(0, price_spread))
-            else:
-                price = base_price * (1 + random.uniform(0, price_spread))
-                
-            amount = random.uniform(*self.volume_ranges[currency])
-            
-            order_data = {
-                "currency": currency,
-                "amount": amount,
-                "price": price,
-                "type": order_type
-            }
-            
-            response = requests.post(
-                f"{self.base_url}/orderbook/create",
-                headers=headers,
-                json=order_data
-            )
+            order_data = self.random_order(currency)
+            response = self.post_order("/orderbook/create", headers, order_data,
+                                       f"Order {order_data['client_order_id']}")
             
-            if response.status_code in [200, 201]:
-                logger.info(f"Created {order_type} order: {amount} {currency} @ {price}")
+            if response.status_code in [200, 201, 202]:
+                logger.info(f"Created {order_data['type']} order: {order_data['amount']} {currency} @ {order_data['price']}")
             else:
                 logger.warning(f"Failed to create order: {response.text}")
                 
         except Exception as e:
             logger.error(f"Error creating order: {str(e)}")
 
+    def quote_round(self):
+        """Replace every bot's quotes: a buy and a sell per currency, one batch request per bot"""
+        batches = {email: [{"cancel": order_id} for order_id in self.quotes.get(email, [])]
+                   for email in self.tokens}
+        for currency in self.currencies:
+            for _ in range(2):
+                batches[random.choice(list(self.tokens.keys()))].append(self.random_order(currency))
+        
+        for email, orders in batches.items():
+            if not orders:
+                continue
+            try:
+                response = self.post_order("/orderbook/batch",
+                                           {'Authorization': f'Bearer {self.tokens[email]}'},
+                                           {"orders": orders}, f"Quotes for {email}")
+                if response.status_code in [200, 202]:
+                    results = response.json()['results']
+                    # only resting orders are worth cancelling next round
+                    self.quotes[email] = [result['order_id'] for order, result in zip(orders, results)
+                                          if 'cancel' not in order and result['status'] == 'active']
+                    logger.info(f"Quoted {len(orders)} orders and cancels for {email}")
+                else:
+                    self.quotes[email] = []
+                    logger.warning(f"Failed to submit batch: {response.text}")
+            except Exception as e:
+                logger.error(f"Error quoting for {email}: {str(e)}")
+
+    def cancel_quotes(self, currency):
+        """Cancel the bots' resting orders so each round quotes fresh prices"""
+        for email, token in self.tokens.items():
+            try:
+                response = requests.delete(
+                    f"{self.base_url}/orderbook/orders",
+                    headers={'Authorization': f'Bearer {token}'},
+                    params={"currency": currency}
+                )
+                if response.status_code == 200:
+                    cancelled = response.json()['cancelled']
+                    if cancelled:
+                        logger.info(f"Cancelled {len(cancelled)} {currency} orders for {email}")
+                else:
+                    logger.warning(f"Failed to cancel orders: {response.text}")
+            except Exception as e:
+                logger.error(f"Error cancelling orders for {email}: {str(e)}")
+
     def run(self):
         """Main market making loop"""
         logger.info("Starting market maker...")
         self.setup_accounts()
+        # Quotes left over from an earlier run are not tracked
+        for currency in self.currencies:
+            self.cancel_quotes(currency)
         
         while True:
             try:
-                # Create orders for each currency
-                for currency in self.currencies:
-                    # Create a buy order
-                    self.create_random_order(currency)
-                    time.sleep(0.2)  # Small delay between orders
-                    
-                    # Create a sell order
-                    self.create_random_order(currency)
-                    time.sleep(0.2)  # Small delay between orders
+                # Replace last round's quotes instead of piling up new ones
+                self.quote_round()
                     
                 # Wait before next round
                 time.sleep(1)
@@ -1,9 +1,12 @@
 import requests
 import random
 import time
+import uuid
 from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = 'http://localhost:5000/api'
+ORDER_TIMEOUT = 10
+ORDER_ATTEMPTS = 3
 
 def login(email, password):
     print(f"Attempting to login as {email}...")
@@ -34,6 +37,12 @@ def deposit_funds(token, bot_number):
         
         print(f'Bot {bot_number} deposited {deposit_data["amount"]} {currency}: {response.json()}')
 
+    # buys are paid for in the pairs' quote currency
+    response = requests.post(f'{BASE_URL}/wallet/deposit',
+                           json={'currency': 'USD', 'amount': 1000000},
+                           headers=headers)
+    print(f'Bot {bot_number} deposited 1000000 USD: {response.json()}')
+
 def create_random_order(token, bot_number):
     currencies = ['BTC', 'ETH', 'USDC']
     headers = {'Authorization': f'Bearer {token}'}
@@ -42,19 +51,35 @@ def create_random_order(token, bot_number):
         'currency': random.choice(currencies),
         'amount': round(random.uniform(0.1, 2.0), 4),
         'price': round(random.uniform(100, 1000), 2),
-        'type': 'buy' if random.random() > 0.5 else 'sell'
+        'type': 'buy' if random.random() > 0.5 else 'sell',
+        # retries carry the same id, so a timed out order is never placed twice
+        'client_order_id': str(uuid.uuid4())
     }
     
     print(f'\nBot {bot_number} attempting to create {order["type"]} order:')
     print(f'Currency: {order["currency"]}, Amount: {order["amount"]}, Price: {order["price"]}')
     
-    response = requests.post(f'{BASE_URL}/orderbook/create', 
-                           json=order, 
-                           headers=headers)
+    for attempt in range(1, ORDER_ATTEMPTS + 1):
+        try:
+            response = requests.post(f'{BASE_URL}/orderbook/create', 
+                                   json=order, 
+                                   headers=headers,
+                                   timeout=ORDER_TIMEOUT)
+            break
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if attempt == ORDER_ATTEMPTS:
+                raise
+            print(f'Bot {bot_number} order {order["client_order_id"]} attempt {attempt} failed ({e}), retrying...')
     
     print(f'Response: {response.json()}')
     return response.status_code
 
+def print_settlement_stats():
+    response = requests.get(f'{BASE_URL}/stats/settlement')
+    stats = response.json()
+    print(f"Settlement: {stats['orders']} orders, {stats['fills']} fills, "
+          f"{stats['fillsPerSecond']:.1f} fills/sec, {stats['commitsPerOrder']:.2f} commits/order")
+
 def bot_trading(bot_email, bot_password, bot_number):
     print(f"\n=== Starting Bot {bot_number} ===")
     token = login(bot_email, bot_password)
@@ -72,6 +97,8 @@ def bot_trading(bot_email, bot_password, bot_number):
             order_count += 1
             print(f"\n--- Bot {bot_number} Order #{order_count} ---")
             create_random_order(token, bot_number)
+            if order_count % 10 == 0:
+                print_settlement_stats()
             delay = random.uniform(1, 3)
             print(f"Waiting {delay:.2f} seconds before next order...")
             time.sleep(delay)